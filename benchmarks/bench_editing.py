@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks of the config parsing and file editing hot paths.
+
+Each benchmark runs one function against a large, realistic fixture (see benchmarks.fixtures) for at
+least --min-time seconds and reports the ops/sec, the mean time per call and the peak memory of one
+call.  Peak memory comes from tracemalloc when the interpreter has it, and otherwise from the growth of
+the max RSS of the process (which only ever goes up, so a 0 means "no more than an earlier benchmark").
+
+    python -m benchmarks.bench_editing --keys 5000 --hosts 5000 --rules 2000
+"""
+
+import os
+import gc
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+from benchmarks import fixtures
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+NOVA_EDITS = [("state_path", "/openstack"),
+              ("live_migration_flag", "VIR_MIGRATE_UNDEFINE_SOURCE, VIR_MIGRATE_PEER2PEER, VIR_MIGRATE_LIVE"),
+              ("libvirt_option_3", "True"),
+              ("neutron_option_7", "http://controller:9696"),
+              ("brand_new_option", "1")]
+
+
+def peak_memory(fn):
+    """Returns (peak bytes allocated by one call of fn, how it was measured)"""
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            fn()
+            return tracemalloc.get_traced_memory()[1], "tracemalloc"
+        finally:
+            tracemalloc.stop()
+    if resource is not None:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return (after - before) * 1024, "maxrss"
+    fn()
+    return None, "-"
+
+
+def measure(fn, setup=None, min_time=1.0):
+    """
+    Calls setup() then fn() until fn has run for min_time seconds in total.  Only fn is timed
+
+    :return: (ops/sec, mean seconds per call, peak bytes, memory source)
+    """
+    if setup is not None:
+        setup()
+    peak, source = peak_memory(fn)
+    calls, spent = 0, 0.0
+    while spent < min_time:
+        if setup is not None:
+            setup()
+        start = time.time()
+        fn()
+        spent += time.time() - start
+        calls += 1
+    return calls / spent, spent / calls, peak, source
+
+
+class Workspace(object):
+    """The fixtures, written out to a temp dir for the functions that work on files"""
+    def __init__(self, keys, hosts, rules):
+        self.dir = tempfile.mkdtemp(prefix="crucible-bench-")
+        self.nova_text = fixtures.nova_conf(keys=keys)
+        self.hosts_text = fixtures.etc_hosts(entries=hosts)
+        self.iptables_text = fixtures.iptables_save(fixtures.iptables_rules(rules=rules))
+        self.nova = os.path.join(self.dir, "nova.conf")
+        self.hosts = os.path.join(self.dir, "hosts")
+        self.reset()
+
+    def reset(self):
+        """Puts the pristine fixtures back, and removes the .orig/.bak files the functions leave behind"""
+        for name in os.listdir(self.dir):
+            os.unlink(os.path.join(self.dir, name))
+        with open(self.nova, "w") as nova_f:
+            nova_f.write(self.nova_text)
+        with open(self.hosts, "w") as hosts_f:
+            hosts_f.write(self.hosts_text)
+
+    def cleanup(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def benchmarks(ws):
+    """Returns a list of (name, fn, setup) for every benchmark that can run in this environment"""
+    from crucible.task.config_doc import ConfigDocument, IniDocument, HostsDocument
+    from crucible.task import firewall
+
+    new_hosts = [("10.8.30.141", "controller.{0} controller".format(fixtures.DOMAIN)),
+                 ("10.8.30.200", "compute2.{0} compute2".format(fixtures.DOMAIN))]
+    wanted = [("tcp", str(port)) for port in (111, 662, 875, 892, 2049, 32803, 32769, 16509)]
+
+    def edit_nova():
+        doc = IniDocument(ws.nova_text)
+        doc.update(NOVA_EDITS, delim="=", not_found="append")
+        return doc.render()
+
+    def edit_hosts():
+        doc = HostsDocument(ws.hosts_text)
+        doc.update(new_hosts, not_found="append")
+        return doc.render()
+
+    benches = [
+        ("ConfigDocument parse nova.conf", lambda: ConfigDocument(ws.nova_text), None),
+        ("IniDocument parse nova.conf", lambda: IniDocument(ws.nova_text), None),
+        ("IniDocument update+render nova.conf", edit_nova, None),
+        ("HostsDocument update+render /etc/hosts", edit_hosts, None),
+        ("firewall RuleSet parse iptables-save", lambda: firewall.RuleSet(ws.iptables_text), None),
+        ("firewall plan", lambda: firewall.plan(wanted, firewall.RuleSet(ws.iptables_text)), None),
+    ]
+
+    try:
+        from crucible.task.sys_utils import Utils
+        from crucible.task.live_migrate import Base
+    except ImportError as ie:
+        print "Skipping the Utils and Base benchmarks: {0}".format(ie)
+        return benches
+
+    utils = Utils()
+    base = Base()
+    config = base.make_config_obj("nova_config_obj", ws.nova)
+
+    def backup():
+        with open(ws.nova, "r") as orig_f:
+            with open(ws.nova + ".bak", "w") as backup_f:
+                Utils.make_backup_file(orig_f, backup_f, ws.nova)
+
+    benches.extend([
+        ("Utils.adj_val nova.conf (1 key)",
+         lambda: utils.adj_val(NOVA_EDITS[0][0], NOVA_EDITS[0][1], ws.nova, ws.nova + ".bak"), ws.reset),
+        ("Utils.adj_val nova.conf (5 keys)",
+         lambda: [utils.adj_val(k, v, ws.nova, ws.nova + ".bak", not_found="append") for k, v in NOVA_EDITS],
+         ws.reset),
+        ("Utils.adj_vals nova.conf (5 keys)",
+         lambda: utils.adj_vals(NOVA_EDITS, ws.nova, ws.nova + ".bak", not_found="append", doc_type=IniDocument),
+         ws.reset),
+        ("Utils.make_backup_file nova.conf", backup, ws.reset),
+        ("Base.make_config_obj nova.conf", lambda: base.make_config_obj("nova_config_obj", ws.nova), None),
+        # ConfigParser treats [DEFAULT] as the defaults, not a section, so time a real one
+        ("Base.config_gettr [libvirt]", lambda: base.config_gettr(config, "libvirt"), None),
+    ])
+    return benches
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]", description=__doc__.strip().splitlines()[0])
+    parser.add_option("--keys", type="int", default=5000, help="options in the nova.conf fixture (default 5000)")
+    parser.add_option("--hosts", type="int", default=5000, help="entries in the /etc/hosts fixture (default 5000)")
+    parser.add_option("--rules", type="int", default=2000, help="rules in the iptables fixture (default 2000)")
+    parser.add_option("--min-time", type="float", default=1.0, help="seconds to run each benchmark (default 1)")
+    parser.add_option("--only", default=None, help="only run the benchmarks whose name contains this")
+    opts, _ = parser.parse_args(argv)
+
+    ws = Workspace(opts.keys, opts.hosts, opts.rules)
+    try:
+        row = "{0:<40}{1:>12}{2:>12}{3:>12}  {4}"
+        print row.format("benchmark", "ops/sec", "ms/op", "peak KiB", "")
+        for name, fn, setup in benchmarks(ws):
+            if opts.only and opts.only not in name:
+                continue
+            ops, mean, peak, source = measure(fn, setup=setup, min_time=opts.min_time)
+            peak = "-" if peak is None else "{0:.0f}".format(peak / 1024.0)
+            print row.format(name, "{0:.1f}".format(ops), "{0:.3f}".format(mean * 1000), peak, source)
+            sys.stdout.flush()
+    finally:
+        ws.cleanup()
+
+
+if __name__ == "__main__":
+    main()
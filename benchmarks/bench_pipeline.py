@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+End to end benchmark of the LIVE_Migrate pipeline against local ssh stand-in nodes.
+
+For every host count, starts that many benchmarks.standin nodes on 127.0.0.N:2222, points a Config at
+them and times the whole pipeline twice: a cold run (empty facts and transfer caches, fresh
+connections) and a warm rerun against the now configured nodes.  Nothing leaves the machine, so the
+numbers can be compared between commits to catch regressions in connection handling and fan out.
+
+    python -m benchmarks.bench_pipeline --hosts 2,10,100 --latency 0.02 --bandwidth 10M
+
+The nodes listen on consecutive loopback addresses, which Linux routes without any setup.  On other
+systems the addresses have to be aliased to lo first.
+"""
+
+import sys
+import time
+import shutil
+import logging
+import tempfile
+from optparse import OptionParser
+
+from crucible.utils.logger import glob_logger as LOGGER, get_handlers
+from crucible.utils.ssh_pool import glob_pool as POOL
+from crucible.utils.metrics import glob_metrics as METRICS
+from crucible.task.facts import glob_facts as FACTS
+from crucible.task.journal import glob_journal as JOURNAL
+from crucible.task.transfer_cache import glob_cache as CACHE
+from crucible.task.live_migrate import Config
+from crucible.task.scheduler import Scheduler
+
+from benchmarks.standin import start_nodes, stop_nodes
+from run_me import pipeline
+
+
+def parse_size(text):
+    """10M -> 10485760"""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    if text[-1:].upper() in units:
+        return int(float(text[:-1]) * units[text[-1:].upper()])
+    return int(text)
+
+
+def make_config(addresses, opts):
+    args = ["--controller", addresses[0], "--compute-hosts", ",".join(addresses), "--no-packstack", "--no-save",
+            "--concurrency", str(opts.concurrency), "--canary", str(opts.canary), "--batch-size",
+            str(opts.batch_size), "--password", "standin"]
+    return Config(args=args)
+
+
+def run_once(config, serial):
+    METRICS.reset()
+    start = time.time()
+    Scheduler(pipeline(config)).run(serial=serial)
+    elapsed = time.time() - start
+    samples = list(METRICS.samples)
+    count = lambda op: len([s for s in samples if s.op == op])
+    moved = sum(s.bytes_in + s.bytes_out for s in samples if s.op not in ("step", "host"))
+    return {"elapsed": elapsed, "connects": count("connect"), "execs": count("exec"),
+            "transfers": len([s for s in samples if s.op.startswith(("sftp", "scp"))]), "bytes": moved}
+
+
+def bench(count, opts):
+    workdir = tempfile.mkdtemp(prefix="crucible-bench-")
+    FACTS.path = workdir + "/facts.json"
+    FACTS._facts = None
+    CACHE.cache_dir = workdir + "/cache"
+    CACHE._index = None
+    JOURNAL.path = workdir + "/journal.json"
+    JOURNAL._entries = None
+    POOL.port = opts.port
+    nodes = start_nodes(max(count, 2), base=opts.base, port=opts.port, latency=opts.latency,
+                        bandwidth=opts.bandwidth)
+    try:
+        config = make_config([node.address for node in nodes], opts)
+        cold = run_once(config, opts.serial)
+        warm = run_once(config, opts.serial)
+    finally:
+        POOL.close_all()
+        stop_nodes(nodes)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return cold, warm
+
+
+def main(argv=None):
+    parser = OptionParser(usage="%prog [options]", description=__doc__.strip().splitlines()[0])
+    parser.add_option("--hosts", default="2,10,100", help="comma separated host counts (default 2,10,100)")
+    parser.add_option("--latency", type="float", default=0.0, help="seconds of latency per request (default 0)")
+    parser.add_option("--bandwidth", default=None, help="bytes/s each node sends at, eg 10M (default no limit)")
+    parser.add_option("--concurrency", type="int", default=8, help="hosts configured at once (default 8)")
+    parser.add_option("--canary", type="int", default=0, help="canary hosts of every step (default 0)")
+    parser.add_option("--batch-size", type="int", default=0, help="hosts per rollout batch (default 0, all)")
+    parser.add_option("--serial", action="store_true", default=False, help="run the steps one at a time")
+    parser.add_option("--base", default="127.0.0.10", help="address of the first node (default 127.0.0.10)")
+    parser.add_option("--port", type="int", default=2222, help="port every node listens on (default 2222)")
+    opts, _ = parser.parse_args(argv)
+    opts.bandwidth = parse_size(opts.bandwidth) if opts.bandwidth else None
+
+    for handler in get_handlers(LOGGER):
+        if isinstance(handler, logging.StreamHandler) and not isinstance(handler, logging.FileHandler):
+            handler.setLevel(logging.WARNING)
+
+    row = "{0:>6} {1:>6} {2:>9} {3:>9} {4:>9} {5:>10} {6:>12}"
+    print row.format("hosts", "run", "seconds", "connects", "execs", "transfers", "bytes")
+    for count in [int(c) for c in opts.hosts.split(",")]:
+        cold, warm = bench(count, opts)
+        for name, res in (("cold", cold), ("warm", warm)):
+            print row.format(count, name, "{0:.2f}".format(res["elapsed"]), res["connects"], res["execs"],
+                             res["transfers"], res["bytes"])
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Realistic fixtures for the benchmarks: the files and command output of a RHEL 7 compute node.
+
+Every generator takes a size, so the same shapes can be used small (a fake /etc tree served by the ssh
+stand-in) or large (a multi-thousand line nova.conf for the editing micro-benchmarks).
+"""
+
+import random
+
+DOMAIN = "lab.eng.rdu2.redhat.com"
+
+NOVA_SECTIONS = ["DEFAULT", "api_database", "barbican", "cells", "cinder", "conductor", "database",
+                 "ephemeral_storage_encryption", "glance", "ironic", "keymgr", "keystone_authtoken",
+                 "libvirt", "neutron", "osapi_v3", "rdp", "serial_console", "spice", "ssl", "trusted_computing",
+                 "upgrade_levels", "vmware", "workarounds", "xenserver", "zookeeper"]
+
+
+def nova_conf(keys=2000, seed=0):
+    """A nova.conf in the style packstack leaves behind: mostly commented out defaults with their docs"""
+    rnd = random.Random(seed)
+    per_section = max(1, keys // len(NOVA_SECTIONS))
+    lines = []
+    for section in NOVA_SECTIONS:
+        lines.append("[{0}]\n".format(section))
+        lines.append("\n")
+        for i in range(per_section):
+            key = "{0}_option_{1}".format(section.split("_")[0], i)
+            lines.append("#\n# Help text for {0}, which controls some aspect of nova (string value)\n".format(key))
+            value = rnd.choice(["True", "False", "<None>", str(rnd.randint(0, 65535)), "$state_path/" + key])
+            if rnd.random() < 0.1:
+                lines.append("{0}={1}\n".format(key, value))
+            else:
+                lines.append("#{0}={1}\n".format(key, value))
+            lines.append("\n")
+    lines.insert(2, "state_path=/var/lib/nova\n")
+    lines.insert(3, "#live_migration_flag=VIR_MIGRATE_UNDEFINE_SOURCE, VIR_MIGRATE_PEER2PEER\n")
+    return "".join(lines)
+
+
+def libvirtd_conf():
+    lines = ["# Master libvirt daemon configuration file\n", "#\n"]
+    for key, value in [("listen_tls", "0"), ("listen_tcp", "1"), ("tls_port", '"16514"'), ("tcp_port", '"16509"'),
+                       ("listen_addr", '"192.168.0.1"'), ("unix_sock_group", '"libvirt"'),
+                       ("auth_unix_ro", '"none"'), ("auth_unix_rw", '"none"'), ("auth_tcp", '"sasl"'),
+                       ("auth_tls", '"none"'), ("max_clients", "5000"), ("log_level", "3")]:
+        lines.append("# This is the description of {0}\n#\n#{0} = {1}\n\n".format(key, value))
+    return "".join(lines)
+
+
+def libvirtd_sysconfig():
+    return "# Override the default config file\n#LIBVIRTD_CONFIG=/etc/libvirt/libvirtd.conf\n\n" \
+           "# Listen for TCP/IP connections\n#LIBVIRTD_ARGS=\"--listen\"\n"
+
+
+def nfs_sysconfig():
+    return "".join("#{0}={1}\n".format(key, value) for key, value in [
+        ("RQUOTAD_PORT", "875"), ("LOCKD_TCPPORT", "32803"), ("LOCKD_UDPPORT", "32769"), ("RPCNFSDARGS", '""'),
+        ("RPCNFSDCOUNT", "16"), ("MOUNTD_PORT", "892"), ("STATD_PORT", "662"), ("STATD_OUTGOING_PORT", "2020")])
+
+
+def idmapd_conf():
+    return "[General]\n#Verbosity = 0\n# The following should be set to the local NFSv4 domain name\n" \
+           "#Domain = local.domain.edu\n\n[Mapping]\n\nNobody-User = nobody\nNobody-Group = nobody\n\n" \
+           "[Translation]\nMethod = nsswitch\n"
+
+
+def unit_file(description):
+    return "[Unit]\nDescription={0}\nAfter=syslog.target network.target\n\n[Service]\nType=notify\n" \
+           "NotifyAccess=all\nTimeoutStartSec=0\nRestart=always\nUser=nova\n\n[Install]\n" \
+           "WantedBy=multi-user.target\n".format(description)
+
+
+def etc_hosts(entries=2, seed=0):
+    rnd = random.Random(seed)
+    lines = ["127.0.0.1   localhost localhost.localdomain localhost4 localhost4.localdomain4\n",
+             "::1         localhost localhost.localdomain localhost6 localhost6.localdomain6\n"]
+    for i in range(entries):
+        addr = "10.{0}.{1}.{2}".format(rnd.randint(0, 255), (i // 250) % 256, i % 250 + 1)
+        lines.append("{0}   node{1}.{2} node{1}\n".format(addr, i, DOMAIN))
+    return "".join(lines)
+
+
+def fstab():
+    return "/dev/mapper/rhel-root   /       xfs     defaults        0 0\n" \
+           "UUID=1b9c3a46-5d8f-4b0a-8a2c-0d5e7f6a9b21 /boot xfs defaults 0 0\n" \
+           "/dev/mapper/rhel-swap   swap    swap    defaults        0 0\n"
+
+
+def iptables_rules(rules=10, seed=0):
+    """The -A lines of the INPUT chain of a node, ending with the usual REJECT rule"""
+    rnd = random.Random(seed)
+    lines = ["-A INPUT -m state --state RELATED,ESTABLISHED -j ACCEPT",
+             "-A INPUT -p icmp -j ACCEPT",
+             "-A INPUT -i lo -j ACCEPT",
+             "-A INPUT -p tcp -m state --state NEW -m tcp --dport 22 -j ACCEPT"]
+    for i in range(rules):
+        lines.append("-A INPUT -s 10.{0}.{1}.0/24 -p {2} -m multiport --dports {3} -m comment "
+                     "--comment \"001 rule {4}\" -j ACCEPT".format(rnd.randint(0, 255), rnd.randint(0, 255),
+                                                                  rnd.choice(["tcp", "udp"]),
+                                                                  rnd.randint(1024, 65535), i))
+    lines.append("-A INPUT -j REJECT --reject-with icmp-host-prohibited")
+    return lines
+
+
+def iptables_save(input_rules=None):
+    input_rules = iptables_rules() if input_rules is None else input_rules
+    return "# Generated by iptables-save v1.4.21\n*filter\n:INPUT ACCEPT [0:0]\n:FORWARD ACCEPT [0:0]\n" \
+           ":OUTPUT ACCEPT [0:0]\n" + "".join(rule + "\n" for rule in input_rules) + \
+           "-A FORWARD -j REJECT --reject-with icmp-host-prohibited\nCOMMIT\n# Completed\n"
+
+
+def etc_tree(hostname):
+    """The files of a freshly installed compute node that the LIVE_Migrate steps read and edit"""
+    return {"/etc/hosts": etc_hosts(),
+            "/etc/fstab": fstab(),
+            "/etc/exports": "",
+            "/etc/idmapd.conf": idmapd_conf(),
+            "/etc/hostname": hostname + "\n",
+            "/etc/sysconfig/nfs": nfs_sysconfig(),
+            "/etc/sysconfig/libvirtd": libvirtd_sysconfig(),
+            "/etc/libvirt/libvirtd.conf": libvirtd_conf(),
+            "/etc/nova/nova.conf": nova_conf(keys=400),
+            "/usr/lib/systemd/system/openstack-nova-api.service": unit_file("OpenStack Nova API Server"),
+            "/usr/lib/systemd/system/openstack-nova-cert.service": unit_file("OpenStack Nova Cert Server"),
+            "/usr/lib/systemd/system/openstack-nova-compute.service": unit_file("OpenStack Nova Compute Server")}
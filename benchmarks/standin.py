@@ -0,0 +1,453 @@
+"""
+Local stand-in for the compute nodes crucible configures, built on paramiko's server side.
+
+Every FakeNode listens on its own loopback address (127.0.0.N, all on the same port) and accepts any
+password.  It serves a fake /etc tree over SFTP and scp, answers the commands the LIVE_Migrate steps run
+(the probe script, hostname, iptables-save/-restore, systemctl, setenforce...) with canned output that
+follows the changes made to it, and can inject latency (a delay per command and per SFTP request, like
+a round trip) and a bandwidth limit on what it sends back.
+
+    nodes = start_nodes(10, latency=0.02, bandwidth=10 * 1024 * 1024)
+    ...
+    stop_nodes(nodes)
+"""
+
+import os
+import re
+import stat
+import time
+import socket
+import threading
+
+import paramiko
+from paramiko import SFTP_OK, SFTP_NO_SUCH_FILE, SFTP_FAILURE
+from paramiko.common import cMSG_CHANNEL_SUCCESS
+
+from benchmarks import fixtures
+
+CHUNK = 32768
+
+PROBE_OUTPUT = """@@crucible:os_release
+NAME="Red Hat Enterprise Linux Server"
+VERSION_ID="7.1"
+@@crucible:redhat_release
+Red Hat Enterprise Linux Server release 7.1 (Maipo)
+@@crucible:linux_distribution
+('Red Hat Enterprise Linux Server', '7.1', 'Maipo')
+@@crucible:hostname
+{hostname}
+@@crucible:fqdn
+{hostname}
+@@crucible:selinux
+Enforcing
+@@crucible:binaries
+{binaries}
+@@crucible:services
+rpcbind active
+nfs-server active
+libvirtd active
+iptables active
+openstack-nova-compute active
+@@crucible:iptables
+{iptables}
+@@crucible:exports
+{exports}
+@@crucible:fstab
+{fstab}
+@@crucible:end
+"""
+
+
+class FakeNode(object):
+    """The state of one simulated compute node, and the ssh server in front of it"""
+    def __init__(self, address, port=2222, hostname=None, latency=0.0, bandwidth=None, host_key=None):
+        """
+        :param address: loopback address to listen on
+        :param latency: seconds added to every command and every SFTP request
+        :param bandwidth: bytes/second the node sends at, None for no limit
+        """
+        self.address = address
+        self.port = port
+        self.hostname = hostname or "node-{0}.{1}".format(address.replace(".", "-"), fixtures.DOMAIN)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.host_key = host_key or paramiko.RSAKey.generate(1024)
+        self.lock = threading.RLock()
+        self.files = {}
+        self.mtimes = {}
+        for path, data in fixtures.etc_tree(self.hostname).items():
+            self.put(path, data)
+        self.input_rules = fixtures.iptables_rules()
+        self.commands = []
+        self._sock = None
+        self._accept_thread = None
+        self._transports = []
+        self._running = False
+
+    # -- the fake filesystem
+    def put(self, path, data):
+        with self.lock:
+            self.files[path] = data
+            self.mtimes[path] = int(time.time())
+
+    def get(self, path):
+        return self.files.get(path)
+
+    def delay(self):
+        """Sleeps for the latency, once per command or SFTP request"""
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def throttle(self, nbytes):
+        """Sleeps for the time nbytes take to send at the bandwidth limit"""
+        if self.bandwidth:
+            time.sleep(float(nbytes) / self.bandwidth)
+
+    # -- commands
+    def iptables_save(self):
+        return fixtures.iptables_save(self.input_rules)
+
+    def iptables_restore(self, text):
+        with self.lock:
+            for line in text.splitlines():
+                parts = line.split(None, 3)
+                if len(parts) < 2 or parts[1] != "INPUT":
+                    continue
+                if parts[0] == "-A":
+                    self.input_rules.append("-A INPUT " + " ".join(parts[2:]))
+                elif parts[0] == "-I":
+                    self.input_rules.insert(int(parts[2]) - 1, "-A INPUT " + parts[3])
+                elif parts[0] == "-D":
+                    del self.input_rules[int(parts[2]) - 1]
+
+    def probe(self, script):
+        binaries = re.search(r'BINARIES="([^"]*)"', script)
+        binaries = binaries.group(1).split() if binaries else []
+        return PROBE_OUTPUT.format(hostname=self.hostname, iptables=self.iptables_save(),
+                                   binaries="\n".join("{0} /usr/bin/{0}".format(b) for b in binaries),
+                                   exports=self.get("/etc/exports") or "", fstab=self.get("/etc/fstab") or "")
+
+    def run(self, cmd, stdin=""):
+        """Returns (stdout, stderr, returncode) for cmd"""
+        self.commands.append(cmd)
+        if cmd == "sh -s":
+            if "@@crucible:" in stdin:
+                return self.probe(stdin), "", 0
+            return "", "", 0    # the tool check script, every tool is installed
+        if cmd.startswith("iptables-restore"):
+            self.iptables_restore(stdin)
+            return self.iptables_save(), "", 0
+        if cmd.startswith("iptables-save"):
+            return self.iptables_save(), "", 0
+        if cmd.startswith("hostname"):
+            return self.hostname + "\n", "", 0
+        if cmd.startswith("getenforce"):
+            return "Permissive\n", "", 0
+        m = re.match(r"echo (.*) >> (\S+)$", cmd)
+        if m:
+            with self.lock:
+                self.put(m.group(2), (self.get(m.group(2)) or "") + m.group(1).strip() + "\n")
+            return "", "", 0
+        m = re.match(r"mv -f (\S+) (\S+)$", cmd)
+        if m:
+            with self.lock:
+                self.put(m.group(2), self.files.pop(m.group(1), ""))
+            return "", "", 0
+        m = re.match(r"packstack --gen-answer-file=(\S+)", cmd)
+        if m:
+            self.put(m.group(1), "[general]\nCONFIG_COMPUTE_HOSTS=127.0.0.1\n")
+            return "", "", 0
+        if cmd.startswith("packstack --answer-file"):
+            return "".join("Applying {0}_nova.pp [ DONE ]\n".format(i) for i in range(50)), "", 0
+        return "", "", 0
+
+    # -- the ssh server
+    def start(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.address, self.port))
+        self._sock.listen(64)
+        self._running = True
+        self._accept_thread = threading.Thread(target=self._accept, name="standin-{0}".format(self.address))
+        self._accept_thread.daemon = True
+        self._accept_thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        if self._sock is not None:
+            # close() alone doesn't wake up the accept() of the other thread, and the address stays bound until
+            # it returns
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._sock.close()
+            self._sock = None
+        if self._accept_thread is not None:
+            self._accept_thread.join()
+            self._accept_thread = None
+        for transport in self._transports:
+            transport.close()
+
+    def _accept(self):
+        while self._running:
+            try:
+                conn, _ = self._sock.accept()
+            except socket.error:
+                return
+            transport = StandinTransport(conn)
+            transport.add_server_key(self.host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, FakeSFTPServer)
+            self._transports.append(transport)
+            try:
+                transport.start_server(server=StandinServer(self))
+            except (paramiko.SSHException, EOFError, socket.error):
+                continue
+
+
+class StandinTransport(paramiko.Transport):
+    """
+    A Transport that signals when the reply to a channel request has been sent.  paramiko only sends it once
+    check_channel_exec_request has returned, and a command started from there could otherwise finish and close
+    its channel first, which the client reports as SSHException("Channel closed.")
+    """
+    def __init__(self, sock):
+        paramiko.Transport.__init__(self, sock)
+        self._acks_lock = threading.Lock()
+        self._acks = {}
+
+    def acknowledged(self, channel):
+        """An Event that is set once the client has been told that the last request on channel succeeded"""
+        with self._acks_lock:
+            return self._acks.setdefault(channel.remote_chanid, threading.Event())
+
+    def _send_user_message(self, data):
+        paramiko.Transport._send_user_message(self, data)
+        raw = data.asbytes()
+        if raw[:1] == cMSG_CHANNEL_SUCCESS:
+            chanid = paramiko.Message(raw[1:]).get_int()
+            with self._acks_lock:
+                ack = self._acks.pop(chanid, None)
+            if ack is not None:
+                ack.set()
+
+
+class StandinServer(paramiko.ServerInterface):
+    def __init__(self, node):
+        self.node = node
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_exec_request(self, channel, command):
+        ack = channel.get_transport().acknowledged(channel)
+        thr = threading.Thread(target=self._exec, args=(channel, command, ack))
+        thr.daemon = True
+        thr.start()
+        return True
+
+    def _exec(self, channel, command, ack):
+        node = self.node
+        ack.wait()
+        try:
+            if command.startswith("scp "):
+                returncode = self._scp(channel, command)
+            else:
+                stdin = ""
+                if command == "sh -s" or command.startswith("iptables-restore"):
+                    stdin = _read_all(channel)
+                node.delay()
+                out, err, returncode = node.run(command, stdin)
+                _send(channel, out, node)
+                if err:
+                    channel.sendall_stderr(err)
+            channel.send_exit_status(returncode)
+        finally:
+            channel.close()
+
+    def _scp(self, channel, command):
+        """Just enough of the scp protocol for scpclient's Read (scp -f) and Write (scp -t)"""
+        node = self.node
+        target = command.split()[-1]
+        reader = channel.makefile("rb")
+        if " -t" in command:
+            channel.sendall("\0")
+            while True:
+                line = reader.readline()
+                if not line:
+                    return 0
+                if line[0] == "C":
+                    mode, size, name = line[1:].strip().split(" ", 2)
+                    channel.sendall("\0")
+                    data = reader.read(int(size))
+                    reader.read(1)
+                    path = target if target not in _dirs(node) else target.rstrip("/") + "/" + name
+                    node.put(path, data)
+                    node.delay()
+                channel.sendall("\0")
+        else:
+            reader.read(1)
+            data = node.get(target)
+            if data is None:
+                channel.sendall("\x01scp: {0}: No such file or directory\n".format(target))
+                return 1
+            channel.sendall("C0644 {0} {1}\n".format(len(data), os.path.basename(target)))
+            reader.read(1)
+            _send(channel, data + "\0", node)
+            reader.read(1)
+            return 0
+
+
+def _read_all(channel):
+    chunks = []
+    while True:
+        data = channel.recv(CHUNK)
+        if not data:
+            return "".join(chunks)
+        chunks.append(data)
+
+
+def _send(channel, data, node):
+    for pos in range(0, len(data), CHUNK):
+        chunk = data[pos:pos + CHUNK]
+        node.throttle(len(chunk))
+        channel.sendall(chunk)
+
+
+def _dirs(node):
+    dirs = set(["/tmp"])
+    for path in node.files:
+        parent = os.path.dirname(path)
+        while parent not in dirs and parent != "/":
+            dirs.add(parent)
+            parent = os.path.dirname(parent)
+    return dirs
+
+
+class FakeHandle(paramiko.SFTPHandle):
+    def __init__(self, node, path, flags, data):
+        super(FakeHandle, self).__init__(flags)
+        self.node = node
+        self.path = path
+        self.data = data
+        self.writable = bool(flags & (os.O_WRONLY | os.O_RDWR))
+
+    def read(self, offset, length):
+        chunk = self.data[offset:offset + length]
+        self.node.delay()
+        self.node.throttle(len(chunk))
+        return chunk
+
+    def write(self, offset, data):
+        self.node.delay()
+        self.data = self.data[:offset].ljust(offset, "\0") + data + self.data[offset + len(data):]
+        return SFTP_OK
+
+    def stat(self):
+        return _attributes(self.node, self.path, self.data)
+
+    def close(self):
+        if self.writable:
+            self.node.put(self.path, self.data)
+        super(FakeHandle, self).close()
+
+
+def _attributes(node, path, data=None):
+    attr = paramiko.SFTPAttributes()
+    data = node.get(path) if data is None else data
+    if data is None:
+        attr.st_mode = stat.S_IFDIR | 0o755
+        attr.st_size = 4096
+    else:
+        attr.st_mode = stat.S_IFREG | 0o644
+        attr.st_size = len(data)
+    attr.st_uid = attr.st_gid = 0
+    attr.st_mtime = attr.st_atime = node.mtimes.get(path, int(time.time()))
+    attr.filename = os.path.basename(path)
+    return attr
+
+
+class FakeSFTPServer(paramiko.SFTPServerInterface):
+    def __init__(self, server, *args, **kwargs):
+        super(FakeSFTPServer, self).__init__(server, *args, **kwargs)
+        self.node = server.node
+
+    def stat(self, path):
+        self.node.delay()
+        if self.node.get(path) is None and path not in _dirs(self.node):
+            return SFTP_NO_SUCH_FILE
+        return _attributes(self.node, path)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        self.node.delay()
+        data = self.node.get(path)
+        if flags & os.O_TRUNC or (data is None and flags & os.O_CREAT):
+            data = ""
+        if data is None:
+            return SFTP_NO_SUCH_FILE
+        return FakeHandle(self.node, path, flags, data)
+
+    def list_folder(self, path):
+        self.node.delay()
+        prefix = path.rstrip("/") + "/"
+        return [_attributes(self.node, p) for p in self.node.files if p.startswith(prefix) and
+                "/" not in p[len(prefix):]]
+
+    def remove(self, path):
+        self.node.delay()
+        with self.node.lock:
+            if self.node.files.pop(path, None) is None:
+                return SFTP_NO_SUCH_FILE
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self.node.delay()
+        with self.node.lock:
+            if newpath in self.node.files or oldpath not in self.node.files:
+                return SFTP_FAILURE
+            self.node.put(newpath, self.node.files.pop(oldpath))
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        self.node.delay()
+        with self.node.lock:
+            if oldpath not in self.node.files:
+                return SFTP_NO_SUCH_FILE
+            self.node.put(newpath, self.node.files.pop(oldpath))
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        self.node.delay()
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        self.node.delay()
+        return SFTP_OK
+
+
+def start_nodes(count, base="127.0.0.10", port=2222, latency=0.0, bandwidth=None):
+    """Starts count FakeNodes on consecutive loopback addresses from base"""
+    prefix, last = base.rsplit(".", 1)
+    host_key = paramiko.RSAKey.generate(1024)
+    nodes = []
+    for i in range(count):
+        addr = "{0}.{1}".format(prefix, int(last) + i) if int(last) + i < 255 else \
+            "127.0.{0}.{1}".format((int(last) + i) // 254 + 1, (int(last) + i) % 254 + 1)
+        nodes.append(FakeNode(addr, port=port, latency=latency, bandwidth=bandwidth, host_key=host_key).start())
+    return nodes
+
+
+def stop_nodes(nodes):
+    for node in nodes:
+        node.stop()
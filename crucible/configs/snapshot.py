@@ -0,0 +1,369 @@
+"""
+A validated, read only snapshot of the five config files.
+
+load() parses system_info, share_storage, firewall, libvirtd and nova once each (system_info used to be
+parsed twice, and config_gettr rebuilt a dict of a whole section for every key it was asked for), checks
+them against SCHEMA, and returns a ConfigSnapshot.  Every problem in the files is reported at once, as a
+ConfigError, before crucible talks to any host.
+
+The parsed files are cached in ~/.crucible/config-cache.json, keyed by the path, size and mtime of each
+file, so an unchanged set of files is not parsed again.  system_info holds the ssh password, so the cache
+is only readable by its owner.
+
+    settings = load()
+    settings.system_info.fstab["nfs_server"]    # the text from the file: "10.8.30.141:/"
+    settings.system_info.install.install        # the value as the schema types it: True
+    settings.share_storage.get("nfs_export", "nfs_server")
+
+A Document has the read half of the ConfigParser API (sections, has_section, has_option, options, get,
+items), so it can be passed to code written for a ConfigParser.  Nothing in a snapshot can be changed;
+replace() returns a new snapshot instead.
+"""
+
+import os
+import json
+import errno
+import ConfigParser
+from collections import Mapping
+
+from crucible.configs.configs import get_path
+from crucible.utils.logger import glob_logger as LOGGER
+
+FILES = ["system_info", "share_storage", "firewall", "libvirtd", "nova"]
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".crucible", "config-cache.json")
+
+# bump when the cached form changes
+CACHE_VERSION = 1
+
+
+class ConfigError(Exception):
+    def __init__(self, errors):
+        super(ConfigError, self).__init__("Invalid configuration:\n  " + "\n  ".join(errors))
+        self.errors = errors
+
+
+def text(value):
+    return value
+
+
+def yesno(value):
+    lowered = value.strip().lower()
+    if lowered in ("y", "yes", "true", "on", "1"):
+        return True
+    if lowered in ("n", "no", "false", "off", "0"):
+        return False
+    raise ValueError("expected y or n, not {0!r}".format(value))
+
+
+def integer(value):
+    return int(value.strip())
+
+
+def port(value):
+    number = integer(value)
+    if not 0 < number < 65536:
+        raise ValueError("{0} is not a port number".format(number))
+    return number
+
+
+def csv(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def hosts(value):
+    found = csv(value)
+    if not found:
+        raise ValueError("expected a comma separated list of hosts")
+    return found
+
+
+def ports(value):
+    return [port(v) for v in csv(value)]
+
+
+# file -> section -> key -> type.  A key starting with ? is optional, the key * types any key that isn't
+# listed, and the section * types any section that isn't listed.  Sections named here are required
+FILE_SECTION = {"filename": text, "filepath": text}
+
+SCHEMA = {
+    "system_info": {
+        "packstack": {"filename": text},
+        "install": {"install": yesno},
+        "nova": {"nova_compute_hosts": hosts},
+        "ssh_creds": {"username": text, "password": text},
+        "fstab": {"filename": text, "nfs_server": text, "nfs_client_mount": text, "fstype": text,
+                  "attribute": text, "fsck": text},
+        "services": {"nfs": csv, "rpcbind": csv, "libvirtd": csv, "setenforce": integer},
+        "etc_hosts": FILE_SECTION,
+    },
+    "share_storage": {
+        "nfs_export": dict(FILE_SECTION, nfs_server=text, export=text, attribute=text, network=text),
+        "nfs_idmapd": dict(FILE_SECTION, domain=text),
+        "nfs_ports": dict(FILE_SECTION, **{"*": port}),
+    },
+    "firewall": {
+        "*": {"?tcp_ports": ports, "?udp_ports": ports},
+    },
+    "libvirtd": {
+        "libvirtd_conf": FILE_SECTION,
+        "libvirtd_sysconfig": FILE_SECTION,
+    },
+    "nova": {
+        "nova_conf": dict(FILE_SECTION, state_path=text),
+        "nova_api_service": FILE_SECTION,
+        "nova_cert_service": FILE_SECTION,
+        "nova_compute_service": FILE_SECTION,
+    },
+}
+
+
+def _schema_of(filename, section):
+    sections = SCHEMA.get(filename, {})
+    return sections.get(section, sections.get("*", {}))
+
+
+def _type_of(schema, key):
+    return schema.get(key, schema.get("?" + key, schema.get("*", text)))
+
+
+class Section(Mapping):
+    """
+    The options of one section, in file order.  section[key] is the text from the file, section.key is
+    the value converted to the type the schema gives it
+    """
+    def __init__(self, name, items, schema=None):
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "_items", tuple((str(k), str(v)) for k, v in items))
+        object.__setattr__(self, "_values", dict(self._items))
+        object.__setattr__(self, "_schema", schema or {})
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return (k for k, _ in self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __getattr__(self, key):
+        try:
+            return _type_of(self._schema, key)(self._values[key])
+        except KeyError:
+            raise AttributeError("No option {0} in section {1}".format(key, self.name))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("A config Section can't be changed")
+
+    def items(self, *args, **kwargs):
+        return list(self._items)
+
+    def __repr__(self):
+        return "<Section {0} {1}>".format(self.name, dict(self._items))
+
+
+class Document(object):
+    """One config file, made of Sections.  Read only, with the read half of the ConfigParser API"""
+    def __init__(self, name, sections):
+        """
+        :param sections: list of (section name, list of (key, value)) pairs
+        """
+        self.name = name
+        self._order = tuple(s for s, _ in sections)
+        self._sections = dict((s, Section(s, items, _schema_of(name, s))) for s, items in sections)
+
+    def __getitem__(self, section):
+        return self._sections[section]
+
+    def __getattr__(self, section):
+        if section.startswith("_"):
+            raise AttributeError(section)
+        try:
+            return self._sections[section]
+        except KeyError:
+            raise AttributeError("No section {0} in {1}".format(section, self.name))
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def sections(self):
+        return list(self._order)
+
+    def has_section(self, section):
+        return section in self._sections
+
+    def has_option(self, section, option):
+        return section in self._sections and option in self._sections[section]
+
+    def options(self, section):
+        return list(self._sections[section])
+
+    def get(self, section, option, *args, **kwargs):
+        try:
+            return self._sections[section][option]
+        except KeyError:
+            raise ConfigParser.NoOptionError(option, section)
+
+    def items(self, section, *args, **kwargs):
+        return self._sections[section].items()
+
+    def to_list(self):
+        return [[s, [list(i) for i in self._sections[s].items()]] for s in self._order]
+
+    def to_parser(self):
+        """A new, mutable ConfigParser with the same contents"""
+        parser = ConfigParser.ConfigParser()
+        parser.optionxform = str
+        for section in self._order:
+            parser.add_section(section)
+            for key, value in self._sections[section].items():
+                parser.set(section, key, value)
+        return parser
+
+    def validate(self):
+        """Returns a list of everything wrong with the document according to SCHEMA"""
+        errors = []
+        schema = SCHEMA.get(self.name, {})
+        for section in sorted(s for s in schema if s != "*"):
+            if section not in self._sections:
+                errors.append("{0}: missing section [{1}]".format(self.name, section))
+        for section in self._order:
+            keys = _schema_of(self.name, section)
+            values = self._sections[section]
+            for key in sorted(k for k in keys if k != "*" and not k.startswith("?")):
+                if key not in values:
+                    errors.append("{0}: [{1}] is missing {2}".format(self.name, section, key))
+            for key in values:
+                try:
+                    _type_of(keys, key)(values[key])
+                except ValueError as ve:
+                    errors.append("{0}: [{1}] {2}: {3}".format(self.name, section, key, ve))
+        return errors
+
+
+class ConfigSnapshot(object):
+    def __init__(self, documents):
+        """
+        :param documents: dict of file name -> Document
+        """
+        self._documents = dict(documents)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        try:
+            return self._documents[name]
+        except KeyError:
+            raise AttributeError("No config file {0}".format(name))
+
+    def __getitem__(self, name):
+        return self._documents[name]
+
+    @classmethod
+    def from_parsers(cls, parsers):
+        """
+        :param parsers: dict of file name -> ConfigParser
+        """
+        return cls(dict((name, Document(name, [(s, parser.items(s, raw=True)) for s in parser.sections()]))
+                        for name, parser in parsers.items()))
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(dict((name, Document(name, sections)) for name, sections in data.items()))
+
+    def to_dict(self):
+        return dict((name, doc.to_list()) for name, doc in self._documents.items())
+
+    def replace(self, name, section, **values):
+        """Returns a new snapshot, where the options values of section of file name are changed"""
+        documents = dict(self._documents)
+        doc = documents[name]
+        sections = []
+        for sect in doc.sections():
+            items = doc.items(sect)
+            if sect == section:
+                items = [(k, values.pop(k, v)) for k, v in items] + sorted(values.items())
+            sections.append((sect, items))
+        documents[name] = Document(name, sections)
+        return ConfigSnapshot(documents)
+
+    def validate(self):
+        errors = []
+        for name in sorted(self._documents):
+            errors.extend(self._documents[name].validate())
+        return errors
+
+    def check(self):
+        """:raises ConfigError: listing every problem, if there are any"""
+        errors = self.validate()
+        if errors:
+            raise ConfigError(errors)
+        return self
+
+
+def parse(paths):
+    """Parses every file once.  paths is a dict of file name -> path"""
+    parsers = {}
+    for name, path in paths.items():
+        parser = ConfigParser.ConfigParser()
+        parser.optionxform = str
+        try:
+            if not parser.read(path):
+                raise ConfigError(["{0}: can't read {1}".format(name, path)])
+        except ConfigParser.Error as cpe:
+            raise ConfigError(["{0}: {1}".format(name, cpe)])
+        parsers[name] = parser
+    return ConfigSnapshot.from_parsers(parsers)
+
+
+def _cache_key(paths):
+    key = [CACHE_VERSION]
+    for name in sorted(paths):
+        try:
+            st = os.stat(paths[name])
+        except OSError:
+            return None
+        key.append([name, os.path.abspath(paths[name]), st.st_size, st.st_mtime])
+    return key
+
+
+def load(paths=None, cache_path=DEFAULT_CACHE_FILE, check=True, logger=LOGGER):
+    """
+    Returns the ConfigSnapshot of the config files, from the cache if none of them changed since it
+    was written
+
+    :param paths: dict of file name -> path.  Defaults to the files in crucible/configs
+    :param cache_path: where to cache the parsed files.  None to not cache
+    :param check: validate the files against SCHEMA
+    :raises ConfigError: if a file can't be read or, with check, is not valid
+    """
+    paths = paths or dict((name, get_path(name)) for name in FILES)
+    key = _cache_key(paths)
+    snapshot = None
+    if cache_path is not None and key is not None:
+        try:
+            with open(cache_path, "r") as cache_f:
+                cached = json.load(cache_f)
+            if cached["key"] == json.loads(json.dumps(key)):
+                snapshot = ConfigSnapshot.from_dict(cached["files"])
+        except (IOError, ValueError, KeyError, TypeError):
+            snapshot = None
+
+    if snapshot is None:
+        snapshot = parse(paths)
+        if cache_path is not None and key is not None:
+            try:
+                try:
+                    os.makedirs(os.path.dirname(cache_path), 0o700)
+                except OSError as oe:
+                    if oe.errno != errno.EEXIST:
+                        raise
+                tmp = cache_path + ".tmp"
+                with os.fdopen(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as cache_f:
+                    json.dump({"key": key, "files": snapshot.to_dict()}, cache_f, separators=(",", ":"))
+                os.rename(tmp, cache_path)
+            except (IOError, OSError) as e:
+                logger.warning("Could not save the config cache {0}: {1}".format(cache_path, e))
+
+    return snapshot.check() if check else snapshot
@@ -1,9 +1,9 @@
 __author__ = 'stoner'
 
-from subprocess import Popen, PIPE, STDOUT
-from paramiko import SSHClient, AutoAddPolicy
 from functools import wraps
 
+from crucible.helpers.tools import glob_tools as TOOLS
+
 
 def require_remote(progname, valid=None):
     """
@@ -14,52 +14,57 @@ def require_remote(progname, valid=None):
     username: the user of the remote machine we wish to run command on
     password: the password for that user
 
-    :param progname: program name to check (passed to which)
+    The answer is remembered per (host, program) for the rest of the run (see crucible.helpers.tools),
+    so only the first call for a host costs an exec.  If the program is missing it gets installed.
+
+    :param progname: program name to check
+    :param valid: unused, kept for compatibility
 
     :return:
     """
-    if valid is None:
-        valid = [0]
-
     def outer(fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            cmd = "which {0}".format(progname)
-            client = SSHClient()
-            client.set_missing_host_key_policy(AutoAddPolicy())
-
-            ip = kwargs["host"]
-            user = kwargs["username"]
-            pw = kwargs["password"]
-
-            client.connect(ip, username=user, password=pw, port=22)
-            out, err, inp = client.exec_command(cmd)
-            if out.channel.recv_exit_status() not in valid:
-                # Try to install
-                cmd = "yum install {0}".format(progname)
-                out, err, inp = client.exec_command(cmd)
-                if out.channel.recv_exit_status() not in valid:
-                    raise Exception("{0} is not on the remote machine".format(progname))
+            TOOLS.ensure(kwargs["host"], [progname], username=kwargs["username"], password=kwargs["password"])
             return fn(*args, **kwargs)
+        wrapper.requires_remote = getattr(fn, "requires_remote", ()) + (progname,)
         return wrapper
     return outer
 
 
-def require_local(progname, valid=[0]):
+def require_local(progname, valid=None):
     """
-    Checks that a command exists on the local system
+    Checks that a command exists on the local system.  The answer is remembered for the rest of the run
     :param progname:
-    :param valid:
+    :param valid: unused, kept for compatibility
     :return:
     """
     def outer(fn):
         @wraps(fn)
         def inner(*args, **kwargs):
-            cmd = "which {}".format(progname)
-            proc = Popen(cmd, shell=True, stdout=PIPE, stderr=STDOUT)
-            out, _ = proc.communicate()
-            if proc.returncode not in valid:
-                raise Exception("{0} is not on this machine".format(progname))
+            TOOLS.ensure_local(progname)
             return fn(*args, **kwargs)
         return inner
-    return outer
\ No newline at end of file
+    return outer
+
+
+def step(*requires, **kwargs):
+    """
+    Declares the pipeline steps that the decorated step must run after.  The scheduler in
+    crucible.task.scheduler reads them back from the requires attribute of the function
+
+    :param requires: names of the steps this step depends on
+    :param inputs: keyword only.  Names of the attributes (or "attribute:section" of a ConfigParser
+        attribute) the step reads its settings from.  crucible.task.journal fingerprints them to tell
+        whether a step completed by an earlier run has to be done again
+    :return:
+    """
+    inputs = tuple(kwargs.pop("inputs", ()))
+    if kwargs:
+        raise TypeError("step() got unexpected keyword arguments {0}".format(", ".join(kwargs)))
+
+    def outer(fn):
+        fn.requires = tuple(requires)
+        fn.inputs = inputs
+        return fn
+    return outer
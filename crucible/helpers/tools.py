@@ -0,0 +1,148 @@
+"""
+Run wide memo of which programs are available on which host.
+
+require_remote and require_local used to run "which" on every call of the function they wrap, and to
+install a missing program with a blocking "yum install" right there.  ToolRegistry remembers the answer
+per (host, program) for the rest of the run, and preflight() checks (and installs) every program every
+host needs up front, with one exec per host, all hosts in parallel.  The binaries fact gathered by the
+crucible.task.probe script is used to answer without any exec at all when it is in the facts cache.
+"""
+
+import threading
+from subprocess import Popen, PIPE, STDOUT
+
+from crucible.utils.logger import glob_logger as LOGGER
+from crucible.task.facts import glob_facts as FACTS
+from crucible.task.plan import glob_plan as PLAN
+from crucible.task.fanout import FanOut
+from crucible.task import probe
+
+LOCALHOST = "localhost"
+
+# the package providing a program, when it isn't named after it
+PACKAGES = {"iptables-save": "iptables",
+            "iptables-restore": "iptables",
+            "exportfs": "nfs-utils",
+            "packstack": "openstack-packstack",
+            "getenforce": "libselinux-utils",
+            "setenforce": "libselinux-utils"}
+
+
+class ToolMissing(Exception):
+    pass
+
+
+def check_script(prognames, packages=None):
+    """
+    Returns a shell script printing the programs of prognames that are missing.  If packages is given,
+    they are installed first
+    """
+    lines = []
+    if packages:
+        lines.append("yum install -y {0} >/dev/null 2>&1".format(" ".join(packages)))
+    lines.append("for p in {0}; do command -v $p >/dev/null 2>&1 || echo $p; done".format(" ".join(prognames)))
+    return "\n".join(lines) + "\n"
+
+
+class ToolRegistry(object):
+    def __init__(self, logger=LOGGER):
+        self.logger = logger
+        self._known = {}
+        self._lock = threading.Lock()
+        self._utils = None
+
+    def known(self, host, progname):
+        """Returns True or False if we already know whether host has progname, None if we don't"""
+        with self._lock:
+            found = self._known.get((str(host), progname))
+        if found is None and host != LOCALHOST and progname in probe.BINARIES:
+            binaries = FACTS.get(host, "binaries")
+            if binaries is not None:
+                found = progname in binaries
+                self.remember(host, [progname], found)
+        return found
+
+    def remember(self, host, prognames, found):
+        with self._lock:
+            for progname in prognames:
+                self._known[(str(host), progname)] = found
+
+    def forget(self, host=None):
+        """Forgets what is known about host, or about every host.  Eg after a host was reinstalled"""
+        with self._lock:
+            for key in list(self._known.keys()):
+                if host is None or key[0] == str(host):
+                    del self._known[key]
+
+    def _run(self, host, script, username, password, read_only=True):
+        """Runs script on host with Utils.rmt_run, and returns the programs it printed as missing"""
+        if self._utils is None:
+            # imported here, sys_utils imports this module through crucible.helpers.decorators
+            from crucible.task.sys_utils import Utils
+            self._utils = Utils()
+        res = self._utils.rmt_run(host, "sh -s", username=username, password=password, input=script, check=True,
+                                  read_only=read_only)
+        return res.output.split()
+
+    def ensure(self, host, prognames, username=None, password=None, install=True):
+        """
+        Makes sure host has every program of prognames, installing the missing ones with yum if install
+        is True.  At most two execs are done (check, then install and check again), and none at all for
+        programs whose availability is already known.
+
+        :raises ToolMissing: if a program is still missing
+        """
+        unknown = [p for p in prognames if self.known(host, p) is None]
+        if unknown:
+            missing = self._run(host, check_script(unknown), username, password)
+            self.remember(host, [p for p in unknown if p not in missing], True)
+            self.remember(host, missing, False)
+
+        missing = [p for p in prognames if not self.known(host, p)]
+        if missing and install:
+            packages = sorted(set(PACKAGES.get(p, p) for p in missing))
+            if PLAN.enabled:
+                # the rest of the plan goes on as if they were installed
+                PLAN.command(host, "yum install -y {0}".format(" ".join(packages)))
+                self.remember(host, missing, True)
+                return True
+            self.logger.info("Installing {0} on {1}".format(", ".join(packages), host))
+            still_missing = self._run(host, check_script(missing, packages), username, password, read_only=False)
+            self.remember(host, [p for p in missing if p not in still_missing], True)
+            FACTS.invalidate(host, "binaries")
+            missing = still_missing
+
+        if missing:
+            raise ToolMissing("{0} is not on the remote machine {1}".format(", ".join(missing), host))
+        return True
+
+    def ensure_local(self, progname):
+        """:raises ToolMissing: if progname is not on this machine"""
+        found = self.known(LOCALHOST, progname)
+        if found is None:
+            proc = Popen("which {0}".format(progname), shell=True, stdout=PIPE, stderr=STDOUT)
+            proc.communicate()
+            found = proc.returncode == 0
+            self.remember(LOCALHOST, [progname], found)
+        if not found:
+            raise ToolMissing("{0} is not on this machine".format(progname))
+        return True
+
+    def preflight(self, requirements, username=None, password=None, install=True, fanout=None):
+        """
+        Checks, and installs if needed, the programs every host needs, on all hosts at once.
+
+        :param requirements: dict of host -> list of program names
+        :param fanout: crucible.task.fanout.FanOut to run the hosts on
+        :return: FanOutResult
+        :raises FanOutError: if any host is still missing something
+        """
+        fanout = FanOut() if fanout is None else fanout
+
+        def check(host):
+            return self.ensure(host, requirements[host], username=username, password=password, install=install)
+
+        return fanout.run(check, list(requirements.keys())).raise_for_failures()
+
+
+glob_tools = ToolRegistry()
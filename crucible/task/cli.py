@@ -0,0 +1,65 @@
+"""
+The command line of crucible.
+
+This module only needs the standard library, so run_me.py can parse the command line (and answer --help)
+before it imports the modules that load paramiko or read the config files.
+"""
+
+import platform
+
+
+def get_args(args=None):
+    major, minor, micro = platform.python_version_tuple()
+    if minor == '6':
+        from optparse import OptionParser as Parser
+        parser = Parser(description='Live Migration Setup Util.  All of the command line options are optional, and'
+                                    'if none are used, then the files in the config folder will be used.  If any'
+                                    'options are given on the command line, they will override the config files, and'
+                                    'those settings will be used instead')
+        add_opt = parser.add_option
+        parse_args = lambda x: x.parse_args(args)[0]
+    else:
+        from argparse import ArgumentParser as Parser
+        parser = Parser(description='Live Migration Setup Util.')
+        add_opt = parser.add_argument
+        parse_args = lambda x: x.parse_args(args)
+
+    add_opt("--controller", help="IP address of the controller/compute 1 node")
+    add_opt("--compute2", help="IP address of the 2nd compute node")
+    add_opt("--compute-hosts", help="Comma separated IP addresses of all the compute nodes, the controller included. "
+                                    "Overrides nova_compute_hosts in system_info")
+    add_opt("--gen-sys-info", help="generate a new system_info config")
+    add_opt("--gen-storage", help="Generate a new share_storage config file")
+    add_opt("--gen-only", help="Only generate the new config file(s) the quit", action="store_true", default=False)
+    add_opt("--no-packstack", help="Dont install packstack. (default is false)", action="store_true", default=False)
+    add_opt("--plan", help="Don't change anything, only read the current state of every host and report the diff of "
+                           "every file and the commands a run would make", action="store_true", default=False)
+    add_opt("--resume", help="Pick up where the last run stopped: skip the steps, and the hosts of a step, that it "
+                             "completed with the same settings (see ~/.crucible/journal.json)", action="store_true",
+            default=False)
+    add_opt("--no-save", help="Dont write the overridden settings to config file", action="store_true", default=False)
+    add_opt("--password", help="Password for root on both nodes")
+    add_opt("--serial", help="Run the setup steps one at a time, in order, instead of as their dependencies allow",
+            action="store_true", default=False)
+    add_opt("--concurrency", help="How many hosts to configure at the same time (default 8)", type=int, default=8)
+    add_opt("--canary", help="Run every per host part of a step on this many hosts first, and only go on to the "
+                             "others if they all succeeded (default 0, no canary)", type=int, default=0)
+    add_opt("--batch-size", help="After the canary hosts, roll each step out to this many hosts at a time, stopping "
+                                 "at the first batch with a failure (default 0, all hosts at once)", type=int,
+            default=0)
+    add_opt("--fail-fast", help="Stop starting new hosts as soon as one host fails a step", action="store_true",
+            default=False)
+    add_opt("--refresh-facts", help="Forget the cached facts about the hosts (distro, hostnames, iptables) and "
+                                    "gather them again", action="store_true", default=False)
+    add_opt("--facts-ttl", help="Seconds cached host facts stay valid (default 86400)", type=int, default=24 * 3600)
+    add_opt("--no-cache", help="Always transfer files, even if the transfer cache says they did not change",
+            action="store_true", default=False)
+    add_opt("--metrics", help="File to write the timings and byte counts of every remote operation to, as JSON "
+                              "or, if it ends with .prom, in the Prometheus text format (default "
+                              "/tmp/crucible-metrics-<timestamp>.json)")
+    add_opt("--profile", help="Profile the run, writing a cProfile .pstats file and a Chrome/Perfetto trace of "
+                              "the steps, hosts and remote operations to /tmp", action="store_true", default=False)
+    add_opt("--log-json", help="Also log every record as a line of JSON, with the host, step and command it belongs "
+                               "to, to this file.  Rotated like the text log")
+    args = parse_args(parser)
+    return args
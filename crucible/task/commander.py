@@ -1,39 +1,86 @@
 __author__ = "Sean Toner"
 
 from subprocess import Popen, PIPE, STDOUT
+from collections import deque, namedtuple
 import threading
-import os
+import tempfile
+import atexit
+import select
 import shlex
+import mmap
+import re
+import errno
+import time
+import os
+
+try:
+    import selectors
+except ImportError:
+    selectors = None
 
 from crucible.utils.logger import glob_logger as LOGGER
 
 
-LOG_DIR = "logs"
-if not os.path.exists("logs"):
-    os.mkdir("logs")
+LOG_DIR = os.path.join(os.path.expanduser("~"), ".crucible", "logs")
 os.environ["PYTHONUNBUFFERED"] = "1"
 
+BUFSIZE = 32768
+
+# how many of the last lines of stdout and stderr are kept in memory for each process
+TAIL_LINES = 200
+
+# a line longer than this is split, so a process that never prints a newline can't make us buffer its whole output
+MAX_LINE = 65536
+
+ProcessLine = namedtuple("ProcessLine", ["name", "stream", "text"])
+
+
+def get_log_dir():
+    """Returns LOG_DIR, creating it the first time it is needed rather than when this module is imported"""
+    try:
+        os.makedirs(LOG_DIR)
+    except OSError as oe:
+        if oe.errno != errno.EEXIST:
+            raise
+    return LOG_DIR
+
+
+# the spill files of the Captures still around, which are removed at exit unless they were asked to be kept
+_SPILLED = set()
+_SPILLED_LOCK = threading.Lock()
 
-def freader(fobj, save=None):
+
+@atexit.register
+def remove_spill_files():
+    with _SPILLED_LOCK:
+        paths = list(_SPILLED)
+        _SPILLED.clear()
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
+def freader(fobj, save=None, command=None):
     """
     Small function which can be thrown into a thread to read a long running
     subprocess
 
+    Returns once fobj reaches EOF (the subprocess closed its end), or is closed
+
     Args:
       - fobj: a file like object that will be read from
-      - interval: polling interval between reads
       - save(list): by default dont save, otherwise append output to this
+      - command(str): the command the output is from, for the command field of the log records
     """
-    do_print = True
-    if save is not None:
-        buff = []
-
-    while not fobj.closed:
-        line = fobj.readline()  # blocks when nothing in fobj buffer
-        if line and do_print:
-            LOGGER.info(line)
-        if save is not None:
-            buff.append(line)
+    try:
+        for line in iter(fobj.readline, ""):  # blocks when nothing in fobj buffer
+            LOGGER.info(line, extra={"command": command})
+            if save is not None:
+                save.append(line)
+    except ValueError:
+        pass  # fobj was closed under us
 
 
 def creader(cobj, interval=0.2, save=None):
@@ -78,13 +125,15 @@ class ProcessResult:
     None, and int types must have an int value ('inf' and 'nan' are for
     float types)
     """
-    def __init__(self, command=None, outp="", error="", meta=None, logger=LOGGER):
+    def __init__(self, command=None, outp="", error="", meta=None, logger=LOGGER, capture=None):
         """
         Args:
           - cmdobj(Command): the Command object
           - outp(str): a str used to hold output
           - error(str): a str used to hold error
           - logger(logging): logging object
+          - capture(dict): stream name -> Capture, when the output was spilled to disk.  outp and
+                           error are then just the tails
         """
         if command is None or not isinstance(command, Command):
             raise ResultException("Must pass in a command object")
@@ -95,6 +144,8 @@ class ProcessResult:
         self._output = outp
         self._error = error
         self._rdr_thr = None
+        self._lines = []
+        self._capture = capture or {}
         self.returncode = self.proc.poll()
 
     def __nonzero__(self):
@@ -139,24 +190,58 @@ class ProcessResult:
 
     @property
     def output(self):
-        outp = self._check_filehandle()
+        """
+        The stdout of the process.  While it is still running, this is what has been read so far: the
+        first access starts a single reader thread, and later ones return what it has collected.
+
+        When the output was captured to disk, it is read back from the spill file on every access
+        instead of being kept around
+        """
+        if "stdout" in self._capture:
+            return self._capture["stdout"].read()
         if self.proc.poll() is None:
             self.logger.warning("Process is not yet finished")
-            lines = []
-            rdr_thread = threading.Thread(target=freader, args=(outp,),
-                                          kwargs={"save": lines})
-            rdr_thread.start() 
-            self._rdr_thr = rdr_thread
+            if self._rdr_thr is None:
+                outp = self._check_filehandle()
+                if outp is not None:
+                    self._rdr_thr = threading.Thread(target=freader, args=(outp,),
+                                                     kwargs={"save": self._lines, "command": self.cmd.cmd})
+                    self._rdr_thr.daemon = True
+                    self._rdr_thr.start()
+            return "".join(self._lines)
+
+        if self._rdr_thr is not None:
+            self._rdr_thr.join()
+            self._rdr_thr = None
+            self._output = "".join(self._lines)
         elif not self._output:
-            
-            self._output = outp.read() # this will block
-
+            outp = self._check_filehandle()
+            if outp is not None:
+                self._output = outp.read()  # this will block
         return self._output
 
     @output.setter
     def output(self, val):
         self.logger.error("output is read-only. Not setting to {}".format(val))
 
+    @property
+    def error(self):
+        if "stderr" in self._capture:
+            return self._capture["stderr"].read()
+        return self._error
+
+    @property
+    def tail(self):
+        """The last lines of stdout, without reading the whole of a captured output back"""
+        if "stdout" in self._capture:
+            return self._capture["stdout"].text()
+        return "".join(self.output.splitlines(True)[-TAIL_LINES:])
+
+    @property
+    def spill_files(self):
+        """stream name -> the file the whole stream was captured to"""
+        return dict((name, cap.path) for name, cap in self._capture.items() if cap.path)
+
 
 class CommandException(Exception):
     def __init__(self, msg=""):
@@ -173,7 +258,7 @@ class Command(object):
     subprocess to return) or not.
     """
     def __init__(self, cmd=None, sudo=False, pw="", logr=None, stdin=PIPE,
-                 stdout=PIPE, stderr=STDOUT, saveout=True):
+                 stdout=PIPE, stderr=STDOUT, saveout=True, capture=False, keep_spill=False):
         """
         *Args:*
             - cmd(str|list): The command to be executed, either in string or list format
@@ -181,6 +266,11 @@ class Command(object):
             - stdout(file-like): by default uses PIPE, but can be any file-like object
             - stderr(file-like): same as stdout
             - comb_err(bool): combine stderr to stdout
+            - capture(bool): write the whole output to a file in LOG_DIR as it arrives, and only keep
+                             the last TAIL_LINES lines in memory.  ProcessResult.output reads the file
+                             back when asked.  Only for blocking calls
+            - keep_spill(bool): keep the files capture writes.  By default they are removed once the
+                                ProcessResult is gone, or at exit
         """
         self.cmd = cmd
         self.out = stdout
@@ -190,6 +280,8 @@ class Command(object):
         self.sudo = sudo
         self.pw = pw
         self.saveout = saveout
+        self.capture = capture
+        self.keep_spill = keep_spill
         if logr:
             self.logger = logr
         else:
@@ -229,14 +321,13 @@ class Command(object):
         if cmd:
             self.cmd = cmd
 
-        if isinstance(self.cmd, str):
-            cmd_toks = shlex.split(self.cmd)
-        else:
-            cmd_toks = self.cmd
-
-        if self.sudo:
-            cmd_toks = ["sudo"] + cmd_toks
+        if self.capture:
+            if not block:
+                raise CommandException("capture only works for a blocking call, submit the command to a "
+                                       "ProcessGroup(spill=True) instead")
+            return self._call_captured(showout, showerr, checkresult, meta, kwds)
 
+        cmd_toks = self.tokens()
         kwds['stdout'] = self.out
         kwds['stderr'] = self.err
         kwds['stdin'] = self.inp
@@ -267,6 +358,32 @@ class Command(object):
             self.check_result(result, checkresult[1])
         return ProcessResult(**proc_res)
 
+    def _call_captured(self, showout, showerr, checkresult, meta, kwds):
+        """__call__ with capture: the output goes through a Capture instead of communicate()"""
+        group = ProcessGroup(max_procs=1, spill=True, keep_spill=self.keep_spill, logger=self.logger)
+        future = group.submit(self, **kwds)
+        proc_res = future.result()
+        output, err = proc_res.tail, proc_res._error
+        if showout and output:
+            self.logger.info(output)
+        if showerr and err:
+            self.logger.error(err)
+        if checkresult[0]:
+            self.check_result((self.proc, output, err, meta), checkresult[1])
+        return proc_res
+
+    def tokens(self, cmd=None):
+        """The argument list Popen is given for cmd (by default self.cmd), with sudo in front if needed"""
+        cmd = cmd or self.cmd
+        if isinstance(cmd, basestring):
+            cmd_toks = shlex.split(cmd)
+        else:
+            cmd_toks = list(cmd)
+
+        if self.sudo:
+            cmd_toks = ["sudo"] + cmd_toks
+        return cmd_toks
+
     def check_result(self, result, success=0, throws=False):
         """
         Simple checker for the return of a subprocess.
@@ -291,7 +408,7 @@ class Command(object):
         return returnval
 
     def _add_fail(self, result):
-        proc, out, err = result
+        proc, out, err = result[:3]
         self.fails[proc.pid] = {"returncode": proc.returncode,
                                 "errmsg": err,
                                 "command": self.cmd }
@@ -335,6 +452,373 @@ class Command(object):
         return CommandProxy(handler, *args, **kwds)
 
 
+class _Streams(object):
+    """
+    Waits for any of a set of pipes to become readable.  Uses the selectors module (epoll, kqueue...)
+    when the interpreter has it, and select.select otherwise
+    """
+    def __init__(self):
+        self._selector = selectors.DefaultSelector() if selectors is not None else None
+        self._fds = {}
+
+    def __len__(self):
+        return len(self._fds)
+
+    def register(self, fobj, data):
+        self._fds[fobj.fileno()] = data
+        if self._selector is not None:
+            self._selector.register(fobj.fileno(), selectors.EVENT_READ, data)
+
+    def unregister(self, fd):
+        del self._fds[fd]
+        if self._selector is not None:
+            self._selector.unregister(fd)
+
+    def ready(self, timeout=None):
+        """Returns a list of (fd, data) for the pipes that can be read without blocking"""
+        if self._selector is not None:
+            return [(key.fd, key.data) for key, _ in self._selector.select(timeout)]
+        try:
+            readable, _, _ = select.select(list(self._fds), [], [], timeout)
+        except select.error as se:
+            if se.args[0] != errno.EINTR:
+                raise
+            return []
+        return [(fd, self._fds[fd]) for fd in readable]
+
+    def close(self):
+        if self._selector is not None:
+            self._selector.close()
+
+
+class Capture(object):
+    """
+    One output stream of one process: the last lines in a fixed size ring buffer, and, with a path,
+    everything in a spill file on disk that read() maps back in when the whole output is wanted.
+
+    Unless keep is set, the spill file is removed when the Capture is garbage collected (with the
+    ProcessResult that holds it), or at exit
+    """
+    def __init__(self, tail=TAIL_LINES, path=None, keep=False):
+        """
+        :param tail: how many of the last lines to keep in memory
+        :param path: the file to spill the whole stream to.  None keeps only the tail
+        :param keep: leave the spill file behind
+        """
+        self.partial = ""
+        self.tail = deque(maxlen=tail)
+        self.path = path
+        self.keep = keep
+        self.size = 0
+        self._spill = open(path, "wb") if path else None
+        if path and not keep:
+            with _SPILLED_LOCK:
+                _SPILLED.add(path)
+
+    @classmethod
+    def spill(cls, name, stream, tail=TAIL_LINES, keep=False):
+        """A Capture spilling to a new file in LOG_DIR, named after the process and the stream"""
+        prefix = re.sub(r"[^\w.-]+", "_", name)[:40] + "-"
+        fd, path = tempfile.mkstemp(prefix=prefix, suffix=".{0}.log".format(stream), dir=get_log_dir())
+        os.close(fd)
+        return cls(tail=tail, path=path, keep=keep)
+
+    def discard(self):
+        """Closes the spill file and, unless it is to be kept, removes it.  read() only has the tail after this"""
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        if self.path is None or self.keep:
+            return
+        with _SPILLED_LOCK:
+            _SPILLED.discard(self.path)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self.path = None
+
+    def __del__(self):
+        try:
+            self.discard()
+        except Exception:
+            pass  # at interpreter shutdown the modules may be gone, remove_spill_files has run by then
+
+    def feed(self, data):
+        """Takes in the next chunk of the stream, and returns the lines it completed"""
+        if self._spill is not None:
+            self._spill.write(data)
+        self.size += len(data)
+        pieces = (self.partial + data).split("\n")
+        self.partial = pieces.pop()
+        if len(self.partial) >= MAX_LINE:
+            pieces.append(self.partial)
+            self.partial = ""
+        self.tail.extend(pieces)
+        return pieces
+
+    def close(self):
+        """The stream is at EOF.  Returns the last, unterminated, line if there is one"""
+        pieces = [self.partial] if self.partial else []
+        self.partial = ""
+        self.tail.extend(pieces)
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+        return pieces
+
+    def text(self):
+        """The last lines of the stream"""
+        return "".join(line + "\n" for line in self.tail)
+
+    def read(self):
+        """The whole stream, memory mapped from the spill file, or just the tail without one"""
+        if self.path is None:
+            return self.text()
+        if self._spill is not None:
+            self._spill.flush()
+        with open(self.path, "rb") as spill_f:
+            if not os.fstat(spill_f.fileno()).st_size:
+                return ""
+            mapped = mmap.mmap(spill_f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                return mapped[:]
+            finally:
+                mapped.close()
+
+
+class ProcessFuture(object):
+    """
+    The eventual ProcessResult of a command submitted to a ProcessGroup.
+
+    result() blocks until the process has exited.  If nothing is driving the group at the time, it runs
+    the group itself, so a single threaded caller can just submit everything and then ask for results
+    """
+    def __init__(self, group, command, name, callback=None, kwds=None):
+        self.group = group
+        self.command = command
+        self.name = name
+        self.callback = callback
+        self.kwds = kwds or {}
+        self.proc = None
+        self.streams = {}
+        self._result = None
+        self._exception = None
+        self._done = threading.Event()
+        self._done_callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def running(self):
+        return self.proc is not None and not self.done()
+
+    def result(self, timeout=None):
+        """
+        :return: the ProcessResult of the command
+        :raises: whatever starting the command raised (eg OSError for a missing executable)
+        """
+        if not self.done() and not self.group.running:
+            self.group.run(timeout=timeout)
+        if not self._done.wait(timeout) and not self.done():
+            raise CommandException("{0} did not finish within {1}s".format(self.name, timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """What starting or running the command raised, or None once it has completed normally"""
+        try:
+            self.result(timeout=timeout)
+        except Exception:
+            pass
+        if not self.done():
+            raise CommandException("{0} did not finish within {1}s".format(self.name, timeout))
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """fn(future) is called once the process has exited, or right away if it already has"""
+        if self.done():
+            fn(self)
+        else:
+            self._done_callbacks.append(fn)
+
+    def _finish(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+        self._done.set()
+        for fn in self._done_callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                self.group.logger.error("Done callback of {0} failed: {1!r}".format(self.name, e))
+
+
+class ProcessGroup(object):
+    """
+    Runs many local subprocesses from a single thread, at most max_procs of them at a time.
+
+    Instead of a reader thread per process (freader) or blocking in communicate() one process at a time,
+    run() waits on the stdout and stderr pipes of all the running processes at once and reads whichever
+    has data.  Every line is handed to the callback of its process as a ProcessLine as soon as it is
+    read, and only the last TAIL_LINES lines of each stream are kept for the ProcessResult.
+
+    Usage::
+
+        group = ProcessGroup(max_procs=4)
+        futures = [group.submit("scp answers.txt root@{0}:/root".format(host), name=host,
+                                callback=lambda line: LOGGER.info("{0}: {1}".format(line.name, line.text)))
+                   for host in hosts]
+        group.run()
+        failed = [f.name for f in futures if f.result() != 0]
+    """
+    def __init__(self, max_procs=8, tail=TAIL_LINES, spill=False, keep_spill=False, logger=LOGGER):
+        """
+        :param max_procs: upper bound on the number of processes running at the same time
+        :param tail: how many of the last lines of each stream to keep for the ProcessResult
+        :param spill: also write every stream to its own file in LOG_DIR, so ProcessResult.output has the
+            whole of it (see Capture)
+        :param keep_spill: keep the spill files.  By default each is removed once its ProcessResult is gone,
+            or at exit
+        """
+        self.max_procs = max(1, int(max_procs))
+        self.tail = tail
+        self.spill = spill
+        self.keep_spill = keep_spill
+        self.logger = logger
+        self.running = False
+        self._queued = deque()
+        self._active = []
+        self._submitted = 0
+        self._lock = threading.Lock()
+
+    def submit(self, cmd, name=None, callback=None, **kwds):
+        """
+        Queues a command.  Nothing is started until run() (or the result() of a future) drives the group
+
+        :param cmd: a Command, or the command line (str or list) to build one from
+        :param name: how the process is known in its ProcessLines.  Defaults to the command line
+        :param callback: called with a ProcessLine for every line the process prints
+        :param kwds: passed to the Popen() constructor
+        :return: ProcessFuture
+        """
+        command = cmd if isinstance(cmd, Command) else Command(cmd)
+        if name is None:
+            name = command.cmd if isinstance(command.cmd, basestring) else " ".join(command.cmd)
+        future = ProcessFuture(self, command, name, callback=callback, kwds=kwds)
+        with self._lock:
+            future.order = self._submitted
+            self._submitted += 1
+            self._queued.append(future)
+        return future
+
+    def _start(self, future, streams):
+        command = future.command
+        kwds = dict(future.kwds, stdout=PIPE, stderr=PIPE if command.err == PIPE else STDOUT, stdin=command.inp)
+        try:
+            proc = Popen(command.tokens(), **kwds)
+        except (OSError, ValueError) as e:
+            self.logger.error("Could not start {0}: {1}".format(future.name, e))
+            future._finish(exception=e)
+            return
+        if proc.stdin is not None:
+            proc.stdin.close()  # nothing is fed to the processes of a group, let them see EOF
+        future.proc = proc
+        for stream in ("stdout", "stderr"):
+            pipe = getattr(proc, stream)
+            if pipe is None:
+                continue
+            if self.spill:
+                future.streams[stream] = Capture.spill(future.name, stream, tail=self.tail, keep=self.keep_spill)
+            else:
+                future.streams[stream] = Capture(tail=self.tail)
+            streams.register(pipe, (future, stream))
+        self._active.append(future)
+
+    def _deliver(self, future, stream, lines):
+        if future.callback is None:
+            return
+        for text in lines:
+            try:
+                future.callback(ProcessLine(future.name, stream, text))
+            except Exception as e:
+                self.logger.error("Line callback of {0} failed: {1!r}".format(future.name, e))
+
+    def _reap(self, future):
+        """Completes future if its process has closed its pipes and exited.  Returns True if it did"""
+        proc = future.proc
+        if any(getattr(proc, s) is not None and not getattr(proc, s).closed for s in ("stdout", "stderr")):
+            return False
+        if proc.poll() is None:
+            return False
+        self._active.remove(future)
+        future.command.proc = proc
+        result = ProcessResult(command=future.command, outp=future.streams["stdout"].text(),
+                               error=future.streams["stderr"].text() if "stderr" in future.streams else "",
+                               logger=self.logger, capture=future.streams if self.spill else None)
+        future._finish(result=result)
+        return True
+
+    def run(self, timeout=None):
+        """
+        Starts the queued commands, max_procs at a time, and reads their output until all have exited.
+
+        :param timeout: seconds to wait for all of them.  Once it is up, the processes still running are
+            killed and a CommandException is raised
+        :return: list of the ProcessFutures that completed, in the order they were submitted
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        streams = _Streams()
+        finished = []
+        self.running = True
+        try:
+            while True:
+                with self._lock:
+                    while self._queued and len(self._active) < self.max_procs:
+                        future = self._queued.popleft()
+                        self._start(future, streams)
+                        if future.done():
+                            finished.append(future)
+                if not self._active:
+                    break
+
+                wait = None if deadline is None else max(0.0, deadline - time.time())
+                if not len(streams):
+                    # every pipe is at EOF, but a process has not exited yet
+                    wait = 0.05 if wait is None else min(wait, 0.05)
+                for fd, (future, stream) in streams.ready(wait):
+                    data = os.read(fd, BUFSIZE)
+                    lines = future.streams[stream]
+                    if data:
+                        self._deliver(future, stream, lines.feed(data))
+                        continue
+                    streams.unregister(fd)
+                    getattr(future.proc, stream).close()
+                    self._deliver(future, stream, lines.close())
+                for future in list(self._active):
+                    if self._reap(future):
+                        finished.append(future)
+
+                if deadline is not None and time.time() >= deadline and self._active:
+                    names = [f.name for f in self._active]
+                    for future in list(self._active):
+                        future.proc.kill()
+                        future.proc.wait()
+                        for stream in ("stdout", "stderr"):
+                            pipe = getattr(future.proc, stream)
+                            if pipe is not None and not pipe.closed:
+                                streams.unregister(pipe.fileno())
+                                pipe.close()
+                                future.streams[stream].close()
+                        self._active.remove(future)
+                        future._finish(exception=CommandException("{0} was killed after {1}s".format(
+                            future.name, timeout)))
+                    raise CommandException("{0} did not finish within {1}s".format(", ".join(names), timeout))
+        finally:
+            self.running = False
+            streams.close()
+        return sorted(finished, key=lambda f: f.order)
+
 
 if __name__ == "__main__":
     cmd = Command("iostat -d 2 10 ")
@@ -342,7 +826,6 @@ if __name__ == "__main__":
     rdr_t = cmd.make_proxy(freader, res.proc.stdout)
     rdr_t.daemon = True
     rdr_t.start()
-    import time
 
     while res.proc.poll() is None:
         time.sleep(1)
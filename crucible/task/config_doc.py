@@ -0,0 +1,230 @@
+"""
+In memory models of the config files crucible edits on the remote systems.
+
+A document is parsed once and every key is indexed to the line numbers it appears on, so a whole dict
+of edits can be applied without re-reading or re-writing the file for each key.  Comments, blank lines
+and the ordering of the file are preserved.  The edit rules are the same as Utils.adj_val:
+
+- the first line matching a key (commented out or not) is replaced with "key<delim>value"
+- later uncommented lines for the same key are dropped, commented ones are left alone
+- if the key is not found, not_found decides whether to ignore it, append it, or raise
+"""
+
+import os
+import re
+import logging
+
+from crucible.utils.logger import glob_logger as LOGGER
+
+TRACE = logging.DEBUG
+
+
+class DocumentException(Exception):
+    pass
+
+
+class ConfigDocument(object):
+    """
+    Document for simple key/value files such as libvirtd.conf, /etc/sysconfig/* or idmapd.conf, where
+    each setting is a "key = value" or "key: value" line.
+    """
+    patt = re.compile(r"^(#\s*)?\s*([\w.\-]+)(\s*[=:]\s*)(.*?)\s*$")
+    default_delim = "="
+
+    def __init__(self, text="", name=None):
+        """
+        :param text: contents of the config file
+        :param name: name used in log and error messages, normally the path of the file
+        """
+        self.name = name
+        self.original = text
+        self.lines = text.splitlines(True)
+        if self.lines and not self.lines[-1].endswith("\n"):
+            self.lines[-1] += "\n"
+        self._reindex()
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as fobj:
+            return cls(fobj.read(), name=path)
+
+    def parse_line(self, line):
+        """
+        :return: a (comment, key, delimiter, value) tuple, or None if the line is not a setting
+        """
+        m = self.patt.match(line)
+        if m is None:
+            return None
+        return m.groups()
+
+    def _reindex(self):
+        self.parsed = []
+        self.index = {}
+        for num, line in enumerate(self.lines):
+            parsed = self.parse_line(line)
+            self.parsed.append(parsed)
+            if parsed is not None:
+                self.index.setdefault(parsed[1], []).append(num)
+
+    def _positions(self, key, section=None):
+        return self.index.get(key, [])
+
+    def _append_pos(self, key, section=None):
+        return len(self.lines)
+
+    def get(self, key, default=None, section=None):
+        """Returns the value of the first uncommented line for key"""
+        for pos in self._positions(key, section):
+            comment, _, _, value = self.parsed[pos]
+            if comment is None:
+                return value
+        return default
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def make_line(self, key, delimiter, value):
+        return "{0}{1}{2}\n".format(key, delimiter, value)
+
+    def update(self, edits, not_found="ignore", delim=None, section=None):
+        """
+        Applies a batch of edits in memory.
+
+        :param edits: dict (or sequence of (key, value) pairs) of settings to change
+        :param not_found: can be one of 'ignore', 'append', or 'fail'.
+        :param delim: If specified, use delim as the delimiter instead of the one found in the file.  If
+            "strip", the found delimiter is used with the surrounding whitespace removed
+        :param section: only used by section aware documents
+        :return: list of the keys that were changed
+        """
+        items = edits.items() if hasattr(edits, "items") else edits
+        dropped = set()
+        appended = []
+        changed = []
+        for key, value in items:
+            positions = [p for p in self._positions(key, section) if p not in dropped]
+            if not positions:
+                if not_found == "fail":
+                    raise DocumentException("Could not find {0} in file {1}".format(key, self.name))
+                elif not_found == "append":
+                    delimiter = self.default_delim if delim in (None, "strip") else delim
+                    line = self.make_line(key, delimiter, value)
+                    LOGGER.log(TRACE, "{0} was not found in {1}. Appending {2}".format(key, self.name, line))
+                    appended.append((self._append_pos(key, section), line))
+                    changed.append(key)
+                continue
+
+            first = positions[0]
+            comment, _, delimiter, _ = self.parsed[first]
+            if delim == "strip":
+                delimiter = delimiter.strip()
+            elif delim is not None:
+                delimiter = delim
+            line = self.make_line(key, delimiter, value)
+            if self.lines[first] != line:
+                LOGGER.log(TRACE, "Matched {0} in {1}, writing out {2}".format(key, self.name, line))
+                self.lines[first] = line
+                changed.append(key)
+            for pos in positions[1:]:
+                if self.parsed[pos][0] is None:
+                    LOGGER.log(TRACE, "Already found {0}, dropping {1}".format(key, self.lines[pos]))
+                    dropped.add(pos)
+                    if key not in changed:
+                        changed.append(key)
+
+        if dropped or appended:
+            # Insert from the back so earlier insertion points stay valid
+            for pos, line in reversed(sorted(appended, key=lambda x: x[0])):
+                self.lines.insert(pos, line)
+                dropped = set(p + 1 if p >= pos else p for p in dropped)
+            self.lines = [l for num, l in enumerate(self.lines) if num not in dropped]
+        self._reindex()
+        return changed
+
+    def render(self):
+        return "".join(self.lines)
+
+    __str__ = render
+
+    @property
+    def modified(self):
+        return self.render() != self.original
+
+    def save(self, path=None, backup=None):
+        """
+        Writes the document out once.  The original contents are written to backup (if given), and the
+        very first original is kept in path + '.orig' like Utils.make_backup_file does.
+
+        :param path: where to write the file, defaults to the name the document was loaded from
+        :param backup: path of the backup file
+        """
+        path = path or self.name
+        if path is None:
+            raise DocumentException("No path given to save the document to")
+        try:
+            pristine = path + ".orig"
+            if not os.path.exists(pristine):
+                with open(pristine, "w") as pristine_f:
+                    pristine_f.write(self.original)
+            if backup is not None:
+                with open(backup, "w") as backup_f:
+                    backup_f.write(self.original)
+            with open(path, "w") as new_f:
+                new_f.write(self.render())
+        except IOError as ie:
+            raise DocumentException("Could not write {0}: {1}".format(path, ie.strerror))
+        return path
+
+
+class IniDocument(ConfigDocument):
+    """
+    Document for INI style files such as nova.conf or systemd unit files.  Keys are indexed with the
+    section they belong to, so edits can be limited to one section.  When section is None, a key is
+    matched in whichever section it appears first (the behavior of Utils.adj_val).
+    """
+    section_patt = re.compile(r"^\s*\[([^\]]+)\]")
+
+    def _reindex(self):
+        super(IniDocument, self)._reindex()
+        self.sections = []
+        self.section_ends = {}
+        current = None
+        for num, line in enumerate(self.lines):
+            m = self.section_patt.match(line)
+            if m:
+                current = m.group(1).strip()
+            self.sections.append(current)
+            self.section_ends[current] = num + 1
+
+    def _positions(self, key, section=None):
+        positions = self.index.get(key, [])
+        if section is None:
+            return positions
+        return [p for p in positions if self.sections[p] == section]
+
+    def _append_pos(self, key, section=None):
+        if section is None or section not in self.section_ends:
+            if section is not None:
+                self.lines.extend(["\n", "[{0}]\n".format(section)])
+                self._reindex()
+            return len(self.lines)
+        # put the new key after the last setting of the section, not after its trailing blank lines
+        pos = self.section_ends[section]
+        while pos > 0 and self.sections[pos - 1] == section and not self.lines[pos - 1].strip():
+            pos -= 1
+        return pos
+
+
+class HostsDocument(ConfigDocument):
+    """
+    Document for /etc/hosts.  The key of a line is its address and the value is the list of names, so
+    update({"10.0.0.1": "compute1 compute1.example.com"}) replaces the entry for that address.
+    """
+    patt = re.compile(r"^(#\s*)?\s*([0-9A-Fa-f.:]+)(\s+)(.*?)\s*$")
+    default_delim = " "
+
+    def parse_line(self, line):
+        m = self.patt.match(line)
+        if m is None or not any(c.isdigit() for c in m.group(2)):
+            return None
+        return m.groups()
@@ -0,0 +1,117 @@
+"""
+On disk cache of the facts crucible gathers from the remote hosts.
+
+Facts such as the distro of the controller (the OSInfo fields), the hostname of every node or the
+iptables INPUT chain rarely change between runs, but used to be fetched over ssh every time, even for
+--gen-only.  They are now kept in ~/.crucible/facts.json, keyed by host, and are reused until they are
+older than the ttl or get invalidated (--refresh-facts, or a step that changes the fact on the host).
+"""
+
+import os
+import json
+import time
+import errno
+import threading
+
+from crucible.utils.logger import glob_logger as LOGGER
+
+
+DEFAULT_FACTS_FILE = os.path.join(os.path.expanduser("~"), ".crucible", "facts.json")
+
+
+class FactsCache(object):
+    def __init__(self, path=DEFAULT_FACTS_FILE, ttl=24 * 3600, enabled=True, logger=LOGGER):
+        """
+        :param path: json file the facts are kept in
+        :param ttl: seconds a fact stays valid
+        :param enabled: if False, every lookup misses and nothing is stored
+        """
+        self.path = path
+        self.ttl = ttl
+        self.enabled = enabled
+        self.logger = logger
+        self._facts = None
+        self._lock = threading.RLock()
+        self.started = time.time()
+
+    def _load(self):
+        """Must be called with self._lock held"""
+        if self._facts is None:
+            try:
+                with open(self.path, "r") as facts_f:
+                    self._facts = json.load(facts_f)
+            except (IOError, ValueError):
+                self._facts = {}
+        return self._facts
+
+    def _save(self):
+        """Must be called with self._lock held"""
+        try:
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError as oe:
+                if oe.errno != errno.EEXIST:
+                    raise
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as facts_f:
+                json.dump(self._facts, facts_f, indent=1, sort_keys=True)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            self.logger.warning("Could not save the facts cache {0}: {1}".format(self.path, e))
+
+    def get(self, host, name, default=None, since=None):
+        """
+        Returns the fact name of host, or default if it is unknown or older than the ttl
+
+        :param since: also return default if the fact was gathered before this time
+        """
+        if not self.enabled:
+            return default
+        with self._lock:
+            fact = self._load().get(str(host), {}).get(name)
+        if fact is None or time.time() - fact["time"] > self.ttl:
+            return default
+        if since is not None and fact["time"] < since:
+            return default
+        return fact["value"]
+
+    def fresh(self, host, name, default=None):
+        """Returns the fact name of host only if it was gathered (or set) during this run"""
+        return self.get(host, name, default=default, since=self.started)
+
+    def set(self, host, name, value):
+        """Stores a fact.  value must be serializable to json"""
+        if not self.enabled:
+            return value
+        with self._lock:
+            self._load().setdefault(str(host), {})[name] = {"value": value, "time": time.time()}
+            self._save()
+        return value
+
+    def get_or_fetch(self, host, name, fetch):
+        """
+        Returns the fact name of host, calling fetch() to gather (and store) it if it is not cached.
+        fetch runs without holding the lock so hosts can be probed in parallel
+        """
+        value = self.get(host, name)
+        if value is None:
+            self.logger.debug("Gathering {0} from {1}".format(name, host))
+            value = self.set(host, name, fetch())
+        return value
+
+    def invalidate(self, host=None, name=None):
+        """Forgets the fact name of host, every fact of host, or everything"""
+        with self._lock:
+            facts = self._load()
+            for fact_host in list(facts.keys()):
+                if host is not None and fact_host != str(host):
+                    continue
+                if name is None:
+                    del facts[fact_host]
+                else:
+                    facts[fact_host].pop(name, None)
+            if os.path.exists(self.path):
+                self._save()
+
+
+glob_facts = FactsCache()
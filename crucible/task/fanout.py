@@ -0,0 +1,194 @@
+"""
+Runs the per-host body of a Config step on many hosts at once.
+
+FanOut.run() hands every host to a bounded pool of worker threads and gathers whatever each call
+returned or raised into a FanOutResult, the result matrix of the step.  With fail_fast, the first
+failure stops hosts that have not started yet from being started; otherwise every host is attempted
+and the failures are reported together.
+
+FanOut.rollout() does the same over a list of batches (see crucible.task.inventory.batches), one batch
+after the other, and does not start the next batch once a batch has a failure.  With a canary batch
+first, a step that breaks a host breaks just the canary.
+"""
+
+import time
+import threading
+import traceback
+from Queue import Queue, Empty
+
+from crucible.utils.logger import glob_logger as LOGGER
+from crucible.utils.metrics import glob_metrics as METRICS
+from crucible.utils.trace import glob_profiler as PROFILER
+
+
+class HostResult(object):
+    """Outcome of running a function against one host"""
+    def __init__(self, host, value=None, exception=None, trace=None, elapsed=0.0, skipped=False):
+        self.host = host
+        self.value = value
+        self.exception = exception
+        self.trace = trace
+        self.elapsed = elapsed
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        return self.exception is None and not self.skipped
+
+    def __repr__(self):
+        if self.skipped:
+            state = "skipped"
+        elif self.exception is not None:
+            state = "failed: {0!r}".format(self.exception)
+        else:
+            state = "ok: {0!r}".format(self.value)
+        return "<HostResult {0} {1} ({2:.2f}s)>".format(self.host, state, self.elapsed)
+
+
+class FanOutError(Exception):
+    def __init__(self, msg="", result=None):
+        super(FanOutError, self).__init__(msg)
+        self.msg = msg
+        self.result = result
+
+
+class FanOutResult(object):
+    """The per-host results of a fan out, in the order the hosts were given"""
+    def __init__(self, hosts, name=""):
+        self.hosts = list(hosts)
+        self.name = name
+        self.results = {}
+
+    def __getitem__(self, host):
+        return self.results[host]
+
+    def __iter__(self):
+        return (self.results[h] for h in self.hosts if h in self.results)
+
+    def __nonzero__(self):
+        return all(r.ok for r in self)
+
+    @property
+    def values(self):
+        return dict((r.host, r.value) for r in self if r.ok)
+
+    @property
+    def failures(self):
+        return [r for r in self if r.exception is not None]
+
+    @property
+    def skipped(self):
+        return [r for r in self if r.skipped]
+
+    def raise_for_failures(self):
+        """Raises a FanOutError describing every failed host, if any host failed"""
+        failures = self.failures
+        if not failures:
+            return self
+        lines = ["{0} failed on {1} of {2} host(s)".format(self.name or "fan out", len(failures), len(self.hosts))]
+        for res in failures:
+            lines.append("  {0}: {1!r}".format(res.host, res.exception))
+        if self.skipped:
+            lines.append("  not attempted: {0}".format(", ".join(str(r.host) for r in self.skipped)))
+        raise FanOutError("\n".join(lines), result=self)
+
+
+class FanOut(object):
+    def __init__(self, max_workers=8, fail_fast=False, logger=LOGGER):
+        """
+        :param max_workers: upper bound on the number of hosts worked on at the same time.  With 1 (or
+            a single host) everything runs in the calling thread
+        :param fail_fast: if True, a failure on one host stops the hosts that have not started yet
+        """
+        self.max_workers = max(1, int(max_workers))
+        self.fail_fast = fail_fast
+        self.logger = logger
+
+    def _call(self, fn, host, args, kwargs, tags):
+        start = time.time()
+        try:
+            with METRICS.context(**dict(tags, host=str(host))):
+                with METRICS.timer("host", host, fn=getattr(fn, "__name__", "")):
+                    value = fn(host, *args, **kwargs)
+        except Exception as e:
+            self.logger.error("{0} failed on host {1}: {2!r}".format(getattr(fn, "__name__", fn), host, e))
+            return HostResult(host, exception=e, trace=traceback.format_exc(), elapsed=time.time() - start)
+        return HostResult(host, value=value, elapsed=time.time() - start)
+
+    def run(self, fn, hosts, *args, **kwargs):
+        """
+        Calls fn(host, *args, **kwargs) for every host.
+
+        :param fn: the per-host body.  It takes the host as the first argument
+        :param hosts: iterable of hosts
+        :return: FanOutResult
+        """
+        hosts = list(hosts)
+        result = FanOutResult(hosts, name=getattr(fn, "__name__", ""))
+        workers = min(self.max_workers, len(hosts))
+        stop = threading.Event()
+        tags = METRICS.tags()  # the worker threads record their samples for the step of the caller
+
+        if workers <= 1:
+            for host in hosts:
+                if stop.is_set():
+                    result.results[host] = HostResult(host, skipped=True)
+                    continue
+                res = result.results[host] = self._call(fn, host, args, kwargs, tags)
+                if self.fail_fast and not res.ok:
+                    stop.set()
+            return result
+
+        todo = Queue()
+        for host in hosts:
+            todo.put(host)
+        lock = threading.Lock()
+
+        def worker():
+            while True:
+                try:
+                    host = todo.get_nowait()
+                except Empty:
+                    return
+                if stop.is_set():
+                    res = HostResult(host, skipped=True)
+                else:
+                    res = self._call(fn, host, args, kwargs, tags)
+                    if self.fail_fast and not res.ok:
+                        stop.set()
+                with lock:
+                    result.results[host] = res
+
+        threads = [threading.Thread(target=PROFILER.wrap(worker), name="fanout-{0}".format(i))
+                   for i in range(workers)]
+        for thr in threads:
+            thr.daemon = True
+            thr.start()
+        for thr in threads:
+            # join with a timeout so a KeyboardInterrupt still reaches the main thread
+            while thr.is_alive():
+                thr.join(0.5)
+        return result
+
+    def rollout(self, fn, batches, *args, **kwargs):
+        """
+        Calls fn(host, *args, **kwargs) for every host of every batch, a batch at a time.  The hosts of a batch
+        run at the same time, up to max_workers.  Once a batch has a failure, the hosts of the later batches
+        are not attempted, and show up as skipped in the result.
+
+        :param fn: the per-host body.  It takes the host as the first argument
+        :param batches: list of lists of hosts
+        :return: FanOutResult for all the hosts
+        """
+        batches = [list(b) for b in batches]
+        result = FanOutResult([h for b in batches for h in b], name=getattr(fn, "__name__", ""))
+        for i, batch in enumerate(batches):
+            if result.failures:
+                for host in batch:
+                    result.results[host] = HostResult(host, skipped=True)
+                continue
+            if len(batches) > 1:
+                self.logger.info("{0}: batch {1} of {2} ({3} host(s))".format(result.name, i + 1, len(batches),
+                                                                             len(batch)))
+            result.results.update(self.run(fn, batch, *args, **kwargs).results)
+        return result
@@ -0,0 +1,212 @@
+"""
+Idempotent firewall backend built on iptables-save / iptables-restore.
+
+The filter table of a host is parsed from iptables-save output into a RuleSet, an indexed model of the
+chains.  plan() diffs it against the (proto, port) pairs wanted by configs/firewall: ports that already
+have an ACCEPT rule in front of the first REJECT rule are left alone, missing ones are added, and
+duplicate rules crucible created on earlier runs are removed.  The diff is rendered into an
+iptables-restore document and applied with "iptables-restore --noflush" in a single transaction, either
+all the changes get in or none do.  The same exec then persists the chain and prints the new state.
+
+Rules crucible adds are tagged with "-m comment --comment crucible".  Untagged rules of exactly the form
+older crucible versions inserted are also treated as crucible's, so the duplicates they left behind get
+cleaned up.  Other rules are never removed.
+"""
+
+import re
+import shlex
+
+# iptables-restore reads the changes from stdin, then the running rules get saved so they survive a reboot.
+# RHEL 7 without iptables-services has no "service iptables save", so fall back to writing the file.  The
+# new state is printed at the end so the iptables fact can be refreshed without another exec
+APPLY_CMD = "iptables-restore --noflush && " \
+            "(service iptables save >/dev/null || iptables-save > /etc/sysconfig/iptables) && " \
+            "iptables-save"
+
+SAVE_CMD = "iptables-save"
+
+COMMENT = "crucible"
+
+RULE_SPEC = "-m state --state NEW -m {proto} -p {proto} --dport {port} -m comment --comment " + COMMENT + \
+            " -j ACCEPT"
+
+# the options of a plain "accept new connections to this port" rule, anything else (a source address,
+# an interface...) makes the rule narrower than what we want
+PLAIN_OPTIONS = set(["-p", "-m", "--state", "--ctstate", "--dport", "--comment", "-j"])
+
+
+class Rule(object):
+    """One "-A <chain> ..." line of iptables-save output"""
+    def __init__(self, chain, args, num):
+        """
+        :param chain: the chain the rule is in
+        :param args: the rest of the line, after the chain name
+        :param num: 1-based position of the rule in its chain
+        """
+        self.chain = chain
+        self.args = args
+        self.num = num
+        self.options = {}
+        opt = None
+        for token in shlex.split(args):
+            if token.startswith("-") and not token.lstrip("-").isdigit():
+                opt = token
+                self.options.setdefault(opt, [])
+            elif opt is not None:
+                self.options[opt].append(token)
+
+    def option(self, name):
+        values = self.options.get(name)
+        return " ".join(values) if values else None
+
+    @property
+    def target(self):
+        return self.option("-j")
+
+    @property
+    def comment(self):
+        return self.option("--comment")
+
+    @property
+    def key(self):
+        """(proto, port) if this is a plain rule accepting new connections to a port, else None"""
+        if self.target != "ACCEPT" or not set(self.options) <= PLAIN_OPTIONS:
+            return None
+        state = self.option("--state") or self.option("--ctstate")
+        if state not in (None, "NEW"):
+            return None
+        proto, port = self.option("-p"), self.option("--dport")
+        if proto is None or port is None:
+            return None
+        return proto, port
+
+    @property
+    def owned(self):
+        """True if crucible created this rule"""
+        return self.comment == COMMENT or (self.key is not None and self.comment is None and
+                                           self.option("--state") == "NEW")
+
+    def __repr__(self):
+        return "<Rule {0} {1}: {2}>".format(self.chain, self.num, self.args)
+
+
+class RuleSet(object):
+    """The chains of the filter table, with the plain ACCEPT rules indexed by (proto, port)"""
+    def __init__(self, iptables_save):
+        self.chains = {}
+        self.index = {}
+        table = None
+        for line in iptables_save.splitlines():
+            line = line.strip()
+            if line.startswith("*"):
+                table = line[1:]
+            elif table == "filter" and line.startswith("-A "):
+                _, chain, args = (line.split(None, 2) + [""])[:3]
+                rules = self.chains.setdefault(chain, [])
+                rule = Rule(chain, args, len(rules) + 1)
+                rules.append(rule)
+                if rule.key is not None:
+                    self.index.setdefault((chain, rule.key), []).append(rule)
+
+    def rules(self, chain="INPUT"):
+        return self.chains.get(chain, [])
+
+    def find(self, proto, port, chain="INPUT"):
+        """Returns the rules accepting new connections to port, in chain order"""
+        return self.index.get((chain, (proto, str(port))), [])
+
+    def reject_position(self, chain="INPUT"):
+        """
+        Returns the 1-based position of the first REJECT rule of the chain, which is where new ACCEPT
+        rules have to go so they are seen before it, or None if the chain has no REJECT rule
+        """
+        for rule in self.rules(chain):
+            if re.match(r"REJECT\b", rule.target or ""):
+                return rule.num
+        return None
+
+
+class FirewallDiff(object):
+    def __init__(self, chain, add, delete, position):
+        """
+        :param add: (proto, port) pairs that need a rule
+        :param delete: redundant Rules to remove
+        :param position: where the first added rule goes once the deletes are done, None to append
+        """
+        self.chain = chain
+        self.add = add
+        self.delete = delete
+        self.position = position
+
+    def __nonzero__(self):
+        return bool(self.add or self.delete)
+
+    def __str__(self):
+        lines = ["+ {0}/{1}".format(proto, port) for proto, port in self.add]
+        lines.extend("- {0} {1}".format(rule.num, rule.args) for rule in self.delete)
+        return "\n".join(lines)
+
+
+def wanted_rules(firewall_config):
+    """
+    Returns the (proto, port) pairs to open, in the order of the firewall config file
+
+    :param firewall_config: ConfigParser object of configs/firewall
+    """
+    rules = []
+    for section in firewall_config.sections():
+        for proto in ("tcp", "udp"):
+            option = "{0}_ports".format(proto)
+            if not firewall_config.has_option(section, option):
+                continue
+            for port in firewall_config.get(section, option).split(","):
+                port = port.strip()
+                if port and (proto, port) not in rules:
+                    rules.append((proto, port))
+    return rules
+
+
+def plan(wanted, ruleset, chain="INPUT"):
+    """
+    Diffs the wanted (proto, port) pairs against the chain.  A pair is satisfied by the first rule
+    accepting it in front of the REJECT rule; any other crucible owned rule for the same pair is a
+    duplicate (or dead, behind the REJECT) and gets deleted.
+
+    :return: FirewallDiff
+    """
+    reject = ruleset.reject_position(chain)
+    add = []
+    delete = []
+    for proto, port in wanted:
+        kept = None
+        for rule in ruleset.find(proto, port, chain):
+            if kept is None and (reject is None or rule.num < reject):
+                kept = rule
+            elif rule.owned:
+                delete.append(rule)
+        if kept is None:
+            add.append((proto, port))
+
+    delete.sort(key=lambda r: r.num)
+    position = None
+    if reject is not None:
+        position = reject - len([rule for rule in delete if rule.num < reject])
+    return FirewallDiff(chain, add, delete, position)
+
+
+def render_restore(diff):
+    """
+    Renders the iptables-restore --noflush document applying diff.  Rules are deleted by position from
+    the bottom up so the positions of the ones still to delete don't move.
+    """
+    lines = ["*filter"]
+    for rule in reversed(diff.delete):
+        lines.append("-D {0} {1}".format(diff.chain, rule.num))
+    for num, (proto, port) in enumerate(diff.add):
+        spec = RULE_SPEC.format(proto=proto, port=port)
+        if diff.position is None:
+            lines.append("-A {0} {1}".format(diff.chain, spec))
+        else:
+            lines.append("-I {0} {1} {2}".format(diff.chain, diff.position + num, spec))
+    lines.append("COMMIT")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,164 @@
+"""
+The hosts crucible configures, in named groups.
+
+The groups every run has are built from system_info and share_storage:
+
+    compute     every nova compute host, from [nova] nova_compute_hosts
+    controller  the node packstack runs on, which is also the nfs server
+    nfs_server  the node that exports the shared instance storage
+
+Any other group can be added in an [inventory] section of system_info, one group per key with a comma
+separated list of hosts, and a group may also name other groups with an @ prefix:
+
+    [inventory]
+    rack1: 10.8.30.200,10.8.30.201,10.8.30.202
+    rack2: 10.8.31.200,10.8.31.201
+    compute: 10.8.30.141,@rack1,@rack2
+
+batches() splits a list of hosts for a rolling rollout: a canary batch first, then fixed size batches.
+"""
+
+STANDARD_GROUPS = ["compute", "controller", "nfs_server"]
+
+
+class InventoryError(Exception):
+    pass
+
+
+def split_hosts(value):
+    """"10.0.0.1, 10.0.0.2,," -> ["10.0.0.1", "10.0.0.2"]"""
+    return [h.strip() for h in str(value or "").split(",") if h.strip()]
+
+
+def unique(hosts):
+    """hosts without the repeats, in the order they were first seen"""
+    seen = set()
+    result = []
+    for host in hosts:
+        if host not in seen:
+            seen.add(host)
+            result.append(host)
+    return result
+
+
+class Inventory(object):
+    def __init__(self, groups=None):
+        """
+        :param groups: list of (group name, list of hosts) pairs
+        """
+        self._order = []
+        self._groups = {}
+        for name, hosts in groups or []:
+            self.set(name, hosts)
+
+    @classmethod
+    def from_config(cls, system_info, share_storage):
+        """
+        Builds the inventory from the system_info and share_storage ConfigParser objects
+
+        :param system_info: ConfigParser of system_info
+        :param share_storage: ConfigParser of share_storage
+        """
+        nfs_server = share_storage.get("nfs_export", "nfs_server").strip()
+        raw = [("compute", system_info.get("nova", "nova_compute_hosts"))]
+        if system_info.has_section("inventory"):
+            raw.extend(system_info.items("inventory"))
+        defined = dict(raw)
+
+        def expand(value, seen):
+            hosts = []
+            for item in split_hosts(value):
+                if not item.startswith("@"):
+                    hosts.append(item)
+                    continue
+                group = item[1:]
+                if group in seen:
+                    raise InventoryError("Group {0} includes itself".format(group))
+                if group not in defined:
+                    raise InventoryError("Unknown group {0} in the [inventory] section".format(item))
+                hosts.extend(expand(defined[group], seen | set([group])))
+            return hosts
+
+        inventory = cls()
+        for name, value in raw:
+            inventory.set(name, expand(value, set([name])))
+        inventory.set("controller", [nfs_server])
+        inventory.set("nfs_server", [nfs_server])
+        return inventory
+
+    @property
+    def groups(self):
+        return list(self._order)
+
+    def set(self, group, hosts):
+        """Replaces the hosts of group, creating the group if needed"""
+        if group not in self._groups:
+            self._order.append(group)
+        self._groups[group] = unique(hosts)
+
+    def replace(self, old, new):
+        """Replaces the host old with new in every group it is in"""
+        for group in self._order:
+            self._groups[group] = unique(new if h == old else h for h in self._groups[group])
+
+    def hosts(self, *groups):
+        """
+        Returns the hosts in any of groups, in the order the groups and their hosts were given
+
+        :param groups: group names.  With none, every host in the inventory
+        :raises InventoryError: for an unknown group
+        """
+        groups = groups or self._order
+        hosts = []
+        for group in groups:
+            if group not in self._groups:
+                raise InventoryError("Unknown host group {0}, known groups are {1}".format(group,
+                                                                                         ", ".join(self._order)))
+            hosts.extend(self._groups[group])
+        return unique(hosts)
+
+    def groups_of(self, host):
+        return [g for g in self._order if host in self._groups[g]]
+
+    def __contains__(self, host):
+        return any(host in hosts for hosts in self._groups.values())
+
+    def __len__(self):
+        return len(self.hosts())
+
+    def __repr__(self):
+        return "<Inventory {0}>".format(", ".join("{0}={1}".format(g, len(self._groups[g])) for g in self._order))
+
+    def write(self, config_obj):
+        """Saves the compute group back to [nova] nova_compute_hosts of a system_info ConfigParser"""
+        config_obj.set("nova", "nova_compute_hosts", ",".join(self._groups["compute"]))
+        if not config_obj.has_section("inventory"):
+            return
+        for group in self._order:
+            if group not in STANDARD_GROUPS:
+                config_obj.set("inventory", group, ",".join(self._groups[group]))
+
+
+def batches(hosts, canary=0, batch_size=0):
+    """
+    Splits hosts into the batches of a rolling rollout: the first canary hosts on their own, then the
+    rest batch_size at a time.
+
+        batches(range(10), canary=1, batch_size=4) -> [[0], [1, 2, 3, 4], [5, 6, 7, 8], [9]]
+
+    :param hosts: the hosts, in rollout order
+    :param canary: how many hosts go first, on their own.  0 for no canary batch
+    :param batch_size: how many hosts per batch after the canary.  0 for all of them in one batch
+    :return: list of lists of hosts.  Empty batches are left out
+    """
+    hosts = list(hosts)
+    canary = max(0, int(canary or 0))
+    batch_size = max(0, int(batch_size or 0))
+    result = []
+    if canary:
+        result.append(hosts[:canary])
+        hosts = hosts[canary:]
+    size = batch_size or len(hosts)
+    for i in range(0, len(hosts), size or 1):
+        result.append(hosts[i:i + size])
+    return [b for b in result if b]
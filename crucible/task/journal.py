@@ -0,0 +1,156 @@
+"""
+On disk journal of the steps, and the hosts of each step, a run has completed.
+
+Every step declares the config it reads with @step(..., inputs=(...)), as the names of Config attributes
+(eg "inventory", or "settings.nova" for one file of the config snapshot), or as "attribute:section" for a
+single section of a config file.
+The journal keeps, per step, a fingerprint of those inputs, whether the step as a whole finished, and
+which hosts its per-host part (Config.for_each_host) finished on.  A run with --resume then skips a step
+that finished with the same fingerprint on every host of this run, and within the steps it does run, skips
+the hosts that already finished with the same fingerprint.  After a failure, only the failed hosts and
+whatever changed are done again.
+
+The journal lives in ~/.crucible/journal.json.  A run without --resume starts a fresh one.
+"""
+
+import os
+import json
+import time
+import errno
+import hashlib
+import threading
+
+from crucible.utils.logger import glob_logger as LOGGER
+
+
+DEFAULT_JOURNAL_FILE = os.path.join(os.path.expanduser("~"), ".crucible", "journal.json")
+
+
+def describe(value):
+    """Turns a step input into something json can serialize the same way every time"""
+    if hasattr(value, "sections") and hasattr(value, "items"):  # a ConfigParser
+        return [[section, sorted(value.items(section, raw=True))] for section in sorted(value.sections())]
+    if hasattr(value, "groups") and hasattr(value, "hosts"):  # a crucible.task.inventory.Inventory
+        return [[group, value.hosts(group)] for group in value.groups]
+    return value
+
+
+def fingerprint(inputs):
+    """sha1 of a list of (name, value) pairs"""
+    text = json.dumps([[name, describe(value)] for name, value in inputs], sort_keys=True, default=repr)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class Journal(object):
+    def __init__(self, path=DEFAULT_JOURNAL_FILE, enabled=True, logger=LOGGER):
+        """
+        :param path: json file the journal is kept in
+        :param enabled: if False, nothing is recorded and nothing is ever skipped
+        """
+        self.path = path
+        self.enabled = enabled
+        self.resume = False
+        self.hosts = []
+        self.logger = logger
+        self._entries = None
+        self._lock = threading.RLock()
+
+    def _load(self):
+        """Must be called with self._lock held"""
+        if self._entries is None:
+            try:
+                with open(self.path, "r") as journal_f:
+                    self._entries = json.load(journal_f)
+            except (IOError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        """Must be called with self._lock held"""
+        try:
+            try:
+                os.makedirs(os.path.dirname(self.path))
+            except OSError as oe:
+                if oe.errno != errno.EEXIST:
+                    raise
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as journal_f:
+                json.dump(self._entries, journal_f, indent=1, sort_keys=True)
+            os.rename(tmp, self.path)
+        except (IOError, OSError) as e:
+            self.logger.warning("Could not save the journal {0}: {1}".format(self.path, e))
+
+    def start(self, resume=False, hosts=None):
+        """
+        Begins a run.  Without resume, whatever an earlier run recorded is forgotten
+
+        :param hosts: the hosts of this run.  A step is only complete once it was completed on all of them
+        """
+        self.resume = resume
+        self.hosts = [str(h) for h in hosts or []]
+        if not self.enabled:
+            return
+        with self._lock:
+            if not resume:
+                self._entries = {}
+                self._save()
+            elif self._load():
+                self.logger.info("Resuming from the journal in {0}".format(self.path))
+
+    def fingerprint(self, fn):
+        """The fingerprint of the inputs a step (a bound method decorated with @step) declared"""
+        owner = getattr(fn, "__self__", None)
+        inputs = []
+        for name in getattr(fn, "inputs", ()):
+            attr, _, section = name.partition(":")
+            value = owner
+            for part in attr.split("."):
+                value = getattr(value, part, None)
+            if section and value is not None:
+                value = sorted(value.items(section, raw=True)) if value.has_section(section) else None
+            inputs.append((name, value))
+        return fingerprint(inputs)
+
+    def _entry(self, name, fprint):
+        """Must be called with self._lock held.  The entry of step name, emptied if its inputs changed"""
+        entry = self._load().get(name)
+        if entry is None or entry["fingerprint"] != fprint:
+            entry = self._load()[name] = {"fingerprint": fprint, "done": False, "hosts": {}}
+        return entry
+
+    def step_done(self, name, fprint):
+        """True if --resume can skip step name: it finished with these inputs, on every host of this run"""
+        if not (self.enabled and self.resume):
+            return False
+        with self._lock:
+            entry = self._load().get(name)
+        if entry is None or entry["fingerprint"] != fprint or not entry["done"]:
+            return False
+        return not entry["hosts"] or all(h in entry["hosts"] for h in self.hosts)
+
+    def host_done(self, name, fprint, host):
+        """True if --resume can skip the per-host part of step name on host"""
+        if not (self.enabled and self.resume):
+            return False
+        with self._lock:
+            entry = self._load().get(name)
+        return entry is not None and entry["fingerprint"] == fprint and str(host) in entry["hosts"]
+
+    def record_host(self, name, fprint, host):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._entry(name, fprint)["hosts"][str(host)] = time.time()
+            self._save()
+
+    def record_step(self, name, fprint, done=True):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._entry(name, fprint)
+            entry["done"] = done
+            entry["time"] = time.time()
+            self._save()
+
+
+glob_journal = Journal()
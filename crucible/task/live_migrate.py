@@ -7,45 +7,42 @@ __version__ = '2.1.0'
 
 import os
 import ConfigParser
-from crucible.configs.configs import get_path
+from crucible.configs.snapshot import ConfigSnapshot, load as load_settings
+from crucible.task.cli import get_args
 from subprocess import call
 from threading import RLock
 import sys
-import re
-import shutil
-import platform
+import posixpath
+from functools import wraps
 
 
 from crucible.utils.logger import glob_logger as LOGGER
 from crucible.utils.logger import banner
-
-
-def get_args(args=None):
-    major, minor, micro = platform.python_version_tuple()
-    if minor == '6':
-        from optparse import OptionParser as Parser
-        parser = Parser(description='Live Migration Setup Util.  All of the command line options are optional, and'
-                                    'if none are used, then the files in the config folder will be used.  If any'
-                                    'options are given on the command line, they will override the config files, and'
-                                    'those settings will be used instead')
-        add_opt = parser.add_option
-        parse_args = lambda x: x.parse_args(args)[0]
-    else:
-        from argparse import ArgumentParser as Parser
-        parser = Parser(description='Live Migration Setup Util.')
-        add_opt = parser.add_argument
-        parse_args = lambda x: x.parse_args(args)
-
-    add_opt("--controller", help="IP address of the controller/compute 1 node")
-    add_opt("--compute2", help="IP address of the 2nd compute node")
-    add_opt("--gen-sys-info", help="generate a new system_info config")
-    add_opt("--gen-storage", help="Generate a new share_storage config file")
-    add_opt("--gen-only", help="Only generate the new config file(s) the quit", action="store_true", default=False)
-    add_opt("--no-packstack", help="Dont install packstack. (default is false)", action="store_true", default=False)
-    add_opt("--no-save", help="Dont write the overridden settings to config file", action="store_true", default=False)
-    add_opt("--password", help="Password for root on both nodes")
-    args = parse_args(parser)
-    return args
+from crucible.task.config_doc import IniDocument
+from crucible.task.config_doc import HostsDocument
+from crucible.task.transfer_cache import glob_cache as CACHE
+from crucible.task.fanout import FanOut
+from crucible.task.inventory import Inventory, split_hosts, batches
+from crucible.task import firewall
+from crucible.task.facts import glob_facts as FACTS
+from crucible.task.journal import glob_journal as JOURNAL
+from crucible.task.plan import glob_plan as PLAN, LOCALHOST
+from crucible.helpers.decorators import step
+from crucible.helpers.tools import glob_tools as TOOLS
+from crucible.utils.metrics import glob_metrics as METRICS
+
+
+def file_path(section):
+    """Returns the full remote path of the file described by the filename and filepath keys of a config section"""
+    return posixpath.join(section['filepath'], section['filename'])
+
+
+def file_edits(section):
+    """
+    Returns the key/value pairs of a config section that describes a file, without the filename and
+    filepath keys that say where the file lives
+    """
+    return dict((k, v) for k, v in section.items() if k not in ("filename", "filepath"))
 
 
 class Base(object):
@@ -97,40 +94,167 @@ class Base(object):
 
 
 class Config(Base, Utils):
-    def __init__(self, args=None, logger=LOGGER):
+    def __init__(self, args=None, logger=LOGGER, parsed=None):
         """
         FIXME: There's a lot of ugly version checking for RHEL 6 vs RHEL 7.  This should be an abstract base class
         and depending on the version override the implementation
 
-        :param args: Result from argument parser
+        Nothing here talks to the hosts.  The distro of the controller is detected the first time a step needs
+        it (see prepare)
+
+        :param args: list of command line arguments to parse, sys.argv[1:] by default
         :param logger:
+        :param parsed: the already parsed command line (from crucible.task.cli.get_args), instead of args
         """
         super(Config, self).__init__(logger=logger)
-        self.args = get_args(args=args)
-        self.ssh_creds_obj = self.make_config_obj('ssh_creds', get_path('system_info'))
-        self.system_info_obj = self.make_config_obj('sys_info', get_path('system_info'))
-        self.firewall_config_obj = self.make_config_obj('firewall', get_path('firewall'))
-        self.libvirtd_config_obj = self.make_config_obj('libvirtd', get_path('libvirtd'))
-        self.nova_config_obj = self.make_config_obj('nova', get_path('nova'))
-        self.nova_hosts_value = self.config_gettr(self.system_info_obj, 'nova')['nova_compute_hosts']
-        self.nova_hosts_list = str(self.nova_hosts_value).split(',')
-        self.share_storage_config_obj = self.make_config_obj('nfs_server', get_path('share_storage'))
-        self.ssh_uid = self.config_gettr(self.ssh_creds_obj, 'ssh_creds')['username']
-        self.ssh_pass = self.config_gettr(self.ssh_creds_obj, 'ssh_creds')['password']
-        self.nfs_server = self.config_gettr(self.share_storage_config_obj, 'nfs_export')['nfs_server']
-        self.fstab_section = self.config_gettr(self.system_info_obj, "fstab")
+        self.args = parsed if parsed is not None else get_args(args=args)
+        self.fanout = FanOut(max_workers=getattr(self.args, "concurrency", 8),
+                             fail_fast=getattr(self.args, "fail_fast", False), logger=logger)
+        # every config file is parsed (or loaded from the config cache) and validated once, up front.  The
+        # ConfigParser objects are the drafts the command line overrides are applied to, and the steps read
+        # from the read only snapshot of them that freeze_settings() takes
+        loaded = self._settings = load_settings()
+        self.system_info_obj = loaded.system_info.to_parser()
+        self.ssh_creds_obj = self.system_info_obj
+        self.firewall_config_obj = loaded.firewall.to_parser()
+        self.libvirtd_config_obj = loaded.libvirtd.to_parser()
+        self.nova_config_obj = loaded.nova.to_parser()
+        self.share_storage_config_obj = loaded.share_storage.to_parser()
+        self.inventory = Inventory.from_config(loaded.system_info, loaded.share_storage)
+        self.ssh_uid = loaded.system_info.ssh_creds["username"]
+        self.ssh_pass = loaded.system_info.ssh_creds["password"]
+        self.nfs_server = loaded.share_storage.nfs_export["nfs_server"]
+        self.fstab_section = loaded.system_info.fstab
         self.nfs_ver = self.fstab_section["fstype"]
         self.controller = self.nfs_server
-        temp = set(self.nova_hosts_list)
-        temp.remove(self.controller)
-        self.compute2 = temp.pop()
-        self.distro_type = None  # will get filled in by args_override()
+        self._distro_type = None  # detected by detect_distro(), when first needed
+        self._prepared = False
         self.args_override()
 
 
     def get_ip(self):
         pass
 
+    @property
+    def distro_type(self):
+        """The OSInfo of the controller.  Detected on first use"""
+        if self._distro_type is None:
+            self.detect_distro()
+        return self._distro_type
+
+    def detect_distro(self, offline=False):
+        """
+        Returns the OSInfo of the controller, from the facts cache or by probing it
+
+        :param offline: never connect to the controller.  Returns None if the distro isn't cached
+        """
+        with self.rlock:
+            if self._distro_type is None:
+                if offline and FACTS.get(self.controller, "os_info") is None:
+                    return None
+                self._distro_type = self.os_info(self.controller, self.ssh_uid, self.ssh_pass)
+            return self._distro_type
+
+    @property
+    def settings(self):
+        """
+        The read only snapshot of the config the steps read.  The first access detects the distro of the
+        controller, as the nfs settings depend on it
+        """
+        if not self._prepared:
+            self.prepare()
+        return self._settings
+
+    def prepare(self, offline=False):
+        """
+        Fills in the settings that depend on the distro of the controller (the nfs version) and freezes the
+        config.  Called the first time the settings are used
+
+        :param offline: use the distro from the facts cache if it is there, otherwise keep the nfs version
+            in system_info.  No host is contacted
+        """
+        with self.rlock:
+            if self._prepared:
+                return self._settings
+            distro = self.detect_distro(offline=offline)
+            if distro is not None:
+                self.nfs_ver = distro.nfs_ver
+            else:
+                self.logger.info("The distro of {0} is not known yet, using fstype {1} from system_info".format(
+                    self.controller, self.nfs_ver))
+            self.configure_nfs()
+            self._prepared = distro is not None
+            return self.freeze_settings()
+
+    def freeze_settings(self):
+        """
+        Takes the snapshot of the config the steps read from, once the command line overrides are applied
+
+        :raises ConfigError: if the overrides made the config invalid
+        """
+        self._settings = ConfigSnapshot.from_parsers({"system_info": self.system_info_obj,
+                                                     "share_storage": self.share_storage_config_obj,
+                                                     "firewall": self.firewall_config_obj,
+                                                     "libvirtd": self.libvirtd_config_obj,
+                                                     "nova": self.nova_config_obj}).check()
+        return self._settings
+
+    @property
+    def nova_hosts_list(self):
+        """The nova compute hosts, ie the compute group of the inventory"""
+        return self.inventory.hosts("compute")
+
+    @nova_hosts_list.setter
+    def nova_hosts_list(self, hosts):
+        self.inventory.set("compute", hosts)
+
+    @property
+    def nova_hosts_value(self):
+        """The nova compute hosts as the comma separated string packstack and system_info use"""
+        return ",".join(self.nova_hosts_list)
+
+    @nova_hosts_value.setter
+    def nova_hosts_value(self, value):
+        if value is not None:  # Base.__init__ sets it to None before there is an inventory
+            self.nova_hosts_list = split_hosts(value)
+
+    def for_each_host(self, fn, hosts=None):
+        """
+        Runs fn(host) for every host (the nova hosts by default) on the fan out thread pool, rolled out in
+        the batches --canary and --batch-size ask for.  With --plan nothing is changed, so all the hosts
+        go at once.
+
+        :return: FanOutResult with what fn returned for every host
+        :raises FanOutError: if fn raised on any host.  The hosts of the batches after it are not attempted
+        """
+        hosts = self.nova_hosts_list if hosts is None else hosts
+        name = METRICS.tags().get("step")
+        if JOURNAL.enabled and getattr(getattr(self, str(name), None), "requires", None) is not None:
+            hosts, fn = self._journaled(name, fn, hosts)
+        if PLAN.enabled:
+            plan = [hosts]
+        else:
+            plan = batches(hosts, canary=getattr(self.args, "canary", 0),
+                           batch_size=getattr(self.args, "batch_size", 0))
+        return self.fanout.rollout(fn, plan).raise_for_failures()
+
+    def _journaled(self, name, fn, hosts):
+        """
+        Returns the hosts of hosts that step name still has to do fn on, and fn wrapped to record every
+        host it completes on in the journal
+        """
+        fprint = JOURNAL.fingerprint(getattr(self, name))
+        done = [h for h in hosts if JOURNAL.host_done(name, fprint, h)]
+        if done:
+            self.logger.info("{0}: skipping {1}, done by an earlier run".format(name, ", ".join(map(str, done))))
+
+        @wraps(fn)
+        def journaled(host, *args, **kwargs):
+            value = fn(host, *args, **kwargs)
+            JOURNAL.record_host(name, fprint, host)
+            return value
+
+        return [h for h in hosts if h not in done], journaled
 
     def configure_nfs(self):
         """
@@ -162,29 +286,51 @@ class Config(Base, Utils):
         if self.args.password is not None:
             self.ssh_pass = self.args.password
 
+        if self.args.no_cache:
+            CACHE.enabled = False
+
+        PLAN.enabled = self.args.plan
+        JOURNAL.enabled = not self.args.plan
+
+        compute_hosts = self.args.compute_hosts
+        if compute_hosts is not None:
+            self.nova_hosts_list = split_hosts(compute_hosts)
+
         # Edit any place in the config files where we need the value of the controller
         if self.args.controller is not None:
+            self.inventory.replace(self.controller, self.args.controller)
+            if self.args.controller not in self.nova_hosts_list:
+                self.nova_hosts_list = [self.args.controller] + self.nova_hosts_list
             self.controller = self.args.controller
-            self.nova_hosts_list[0] = self.args.controller
             self.nfs_server = self.args.controller
-            self.nova_hosts_value = ",".join(self.nova_hosts_list)
+            self.inventory.set("controller", [self.controller])
+            self.inventory.set("nfs_server", [self.nfs_server])
             self.system_info_obj.set("fstab", "nfs_server", self.nfs_server + ":/")
             self.share_storage_config_obj.set("nfs_export", "nfs_server", self.nfs_server)
 
         # Edit any place in the config files where we need the value of the 2nd compute node
         if self.args.compute2 is not None:
-            self.compute2 = self.args.compute2
-            self.nova_hosts_list[1] = self.args.compute2
-            self.nova_hosts_value = ",".join(self.nova_hosts_list)
+            hosts = self.nova_hosts_list
+            self.nova_hosts_list = hosts[:1] + [self.args.compute2] + hosts[2:]
 
         # Set the values in the config object
-        if self.args.compute2 is not None or self.args.controller is not None:
-            self.system_info_obj.set("nova", "nova_compute_hosts", self.nova_hosts_value)
+        if any(x is not None for x in [self.args.compute2, self.args.controller, compute_hosts]):
+            self.inventory.write(self.system_info_obj)
 
-        # Set the nfs type appropriately for the distro
-        self.distro_type = self.system_version(self.controller, self.ssh_uid, self.ssh_pass)
-        self.nfs_ver = self.distro_type.nfs_ver
-        self.configure_nfs()
+        FACTS.ttl = self.args.facts_ttl
+        if self.args.refresh_facts:
+            for host in self.inventory.hosts():
+                FACTS.invalidate(host)
+
+        # Check the overrides right away.  The nfs settings for the distro of the controller are filled in
+        # later, when a step first needs them, except when writing the config files: they need them now.  For
+        # --gen-only that is done without contacting the controller
+        if self.args.gen_only:
+            self.prepare(offline=True)
+        elif not self.args.no_save and (self.args.gen_sys_info or self.args.gen_storage):
+            self.prepare()
+        else:
+            self.freeze_settings()
 
         def gen_file(arg_file, config_obj):
             if arg_file is not None:
@@ -205,15 +351,19 @@ class Config(Base, Utils):
             self.logger.info("Done generating config files....quitting")
             sys.exit(0)
 
+    @step(inputs=("settings.system_info", "inventory"))
     def system_setup(self):
         """System setup will determine RHEL version and configure the correct services per release info.
         """
         banner(self.logger, ["Checking to see if Packstack will be run..."])
-        to_install = self.config_gettr(self.system_info_obj, 'install')['install']
-        if 'n' in to_install:
+        if not self.settings.system_info.install.install:
             return True
 
-        answerfile = self.config_gettr(self.system_info_obj, 'packstack')['filename']
+        answerfile = self.settings.system_info.packstack["filename"]
+        if PLAN.enabled:
+            PLAN.command(LOCALHOST, "packstack --gen-answer-file {0}".format(answerfile))
+            PLAN.command(LOCALHOST, "packstack --answer-file {0}".format(answerfile))
+            return True
         call(['packstack', '--gen-answer-file', answerfile])
 
         if os.path.exists(answerfile) and os.stat(answerfile)[6] != 0:
@@ -232,262 +382,225 @@ class Config(Base, Utils):
 
         return True
 
+    def tool_requirements(self):
+        """Returns a dict of host -> programs the steps run on that host"""
+        reqs = dict((host, ["iptables-save", "iptables-restore", "getenforce", "setenforce"])
+                    for host in self.nova_hosts_list)
+        reqs.setdefault(self.controller, []).extend(self.copy_public_keys.requires_remote)
+        return reqs
+
+    @step(inputs=("inventory",))
+    def preflight(self):
+        """Checks for (and installs) everything the steps need on every host in one go, instead of one host
+        and one program at a time as the steps get to them.
+        """
+        TOOLS.preflight(self.tool_requirements(), username=self.ssh_uid, password=self.ssh_pass,
+                        fanout=self.fanout)
+        return True
+
+    @step("preflight", inputs=("settings.system_info", "inventory"))
     def remote_setup(self, install=True):
         banner(self.logger, ["Checking to see if Packstack will be run remotely..."])
-        to_install = self.config_gettr(self.system_info_obj, 'install')['install']
-        if 'n' in to_install:
+        if not self.settings.system_info.install.install:
             return True
 
-        answer = self.config_gettr(self.system_info_obj, 'packstack')['filename']
-        answerfile = os.path.basename(answer)
-        answerpath = os.path.dirname(answer)
+        answer = self.settings.system_info.packstack["filename"]
 
         for target in self.nova_hosts_list:
             res = self.copy_public_keys(host=self.controller, target=target, username=self.ssh_uid,
                                         password=self.ssh_pass)
 
-        owd = os.getcwd()
-        os.chdir("/tmp")  # When we copy, put it in /tmp
-
-        # FIXME: Figure out a way to tell if this command was successful
-        self.rmt_exec(self.controller, "packstack --gen-answer-file={0}".format(answer), username=self.ssh_uid,
-                      password=self.ssh_pass)
-        self.rmt_copy(self.controller, username=self.ssh_uid, password=self.ssh_pass, fname=answerfile,
-                      remote_path=answerpath)
+        self.rmt_run(self.controller, "packstack --gen-answer-file={0}".format(answer), username=self.ssh_uid,
+                     password=self.ssh_pass, check=True)
+        try:
+            # the answer file is full of passwords, so it is kept out of the transfer cache
+            doc = self.rmt_load(self.controller, answer, username=self.ssh_uid, password=self.ssh_pass,
+                                cached=False)
+        except IOError:
+            doc = None
 
-        if os.path.exists(answerfile) and os.stat(answerfile)[6] != 0:
+        if doc is not None and doc.original:
             #check to see if the file exist and its not empty.
-            self.logger.debug("Creating backup file for answerfile")
-            try:
-                self.adj_val('CONFIG_COMPUTE_HOSTS', self.nova_hosts_value, answerfile, answerfile + '.bak')
-            except IOError:
-                raise IOError("Couldn't rename {0}".format(answerfile))
+            doc.update({'CONFIG_COMPUTE_HOSTS': self.nova_hosts_value})
+            self.rmt_write(self.controller, answer, doc.render(), username=self.ssh_uid, password=self.ssh_pass,
+                           cached=False)
 
-            banner(self.logger, ["Running packstack installer, using {0} file".format(answerfile)])
-            self.rmt_copy(self.controller, username=self.ssh_uid, password=self.ssh_pass, fname=answerfile,
-                          remote_path=answerpath, send=True)
+            banner(self.logger, ["Running packstack installer, using {0} file".format(answer)])
             if install:
-                out, err = self.rmt_exec(self.controller, 'packstack --answer-file={0}'.format(answer),
-                                         username=self.ssh_uid, password=self.ssh_pass)
-                for line in out.readlines():
-                    self.logger.info(line)
-
-            os.chdir(owd)
+                for line in self.rmt_stream(self.controller, 'packstack --answer-file={0}'.format(answer),
+                                            username=self.ssh_uid, password=self.ssh_pass):
+                    self.logger.info("{0}: {1}".format(line.host, line.text))
 
             return True
+        elif PLAN.enabled:
+            # the answer file is only generated by a real run
+            if install:
+                self.rmt_run(self.controller, 'packstack --answer-file={0}'.format(answer), username=self.ssh_uid,
+                             password=self.ssh_pass)
+            return True
         else:
             self.logger.error("Couldn't find packstack answer file: {0}".format(answer))
             exit()
 
+    @step("system_setup", "remote_setup", "preflight", inputs=("settings.firewall",))
     def firewall_setup(self):
         """Firewall setup will open necessary ports on all compute nodes to allow libvirtd, nfs_server to
         communicate with their clients.
 
-        FIXME: this function should be idempotent
+        The INPUT chain of every host is diffed against the ports in configs/firewall (see
+        crucible.task.firewall): only the missing ACCEPT rules are inserted, in front of the first REJECT
+        rule, and duplicates left by earlier runs are removed.  The changes are applied and persisted by a
+        single iptables-restore exec, and a host that is already converged isn't touched at all.  Only a
+        chain read during this run is trusted to say a host is converged, an older cached one could miss
+        rules that were flushed since.
 
         :return: upon success zero is returned if not an exception is raised.
         """
-        nfs_tcp = self.config_gettr(self.firewall_config_obj, 'nfs rules')['tcp_ports']
-        nfs_udp = self.config_gettr(self.firewall_config_obj, 'nfs rules')['udp_ports']
-        libvirtd_tcp = self.config_gettr(self.firewall_config_obj, 'libvirtd rules')['tcp_ports']
-
-        # In iptables, find where the first REJECT rule is.  We need to insert at this line number. If the
-        # REJECT rule doesn't exist, just start at the last line in the INPUT chain
-        def get_line(host):
-            out, err = self.rmt_exec(str(host), "iptables -L INPUT --line-numbers",
-                                     username=self.ssh_uid, password=self.ssh_pass)
-            out = out.readlines()
-
-            patt = re.compile(r"(\d+)\s+(\w+)")
-            for i, lineout in enumerate(out, -1):
-                m = patt.search(lineout)
-                if not m:
-                    continue
-                line, chain = m.groups()
-                self.logger.info("line = {0}, chain = {1}, i={2}".format(line, chain, i))
-                if chain == "REJECT":
-                    # this line needs to be deleted.
-                    out, err = self.rmt_exec(str(host), "iptables -D INPUT {0}".format(i), username=self.ssh_uid,
-                                             password=self.ssh_pass)
-                    line = i - 1
-                    break
-            else:
-                line = i
-
-            self.logger.info("Final line = {0}".format(line))
-            return line
+        rules = firewall.wanted_rules(self.settings.firewall)
+
+        def apply_rules(host):
+            current = FACTS.fresh(host, "iptables")
+            if current is not None and not firewall.plan(rules, firewall.RuleSet(current)):
+                self.logger.info("Firewall rules on {0} are already in place".format(host))
+                return False
+
+            # positions are about to be used to delete rules, so never trust the cached chain for that
+            current = self.rmt_run(str(host), firewall.SAVE_CMD, username=self.ssh_uid, password=self.ssh_pass,
+                                   check=True, read_only=True).output
+            diff = firewall.plan(rules, firewall.RuleSet(current))
+            if not diff:
+                FACTS.set(host, "iptables", current)
+                self.logger.info("Firewall rules on {0} are already in place".format(host))
+                return False
+
+            self.logger.info("Setting up firewall rules on {0}:\n{1}".format(host, diff))
+            if not PLAN.enabled:
+                FACTS.invalidate(host, "iptables")  # we are about to change the chain
+            ret = self.rmt_run(str(host), firewall.APPLY_CMD, username=self.ssh_uid, password=self.ssh_pass,
+                               input=firewall.render_restore(diff))
+            if ret.planned:
+                return True
+            if ret != 0:
+                raise EnvironmentError('The remote command failed {0}'.format(ret.error.splitlines()))
+            FACTS.set(host, "iptables", ret.output)
+            return True
 
-        host = self.nfs_server
         self.logger.info("=" * 20)
-        self.logger.info("Setting up firewall rules on {0}".format(host))
-
-        line = int(get_line(host))
-        for proto, ports in [("tcp", nfs_tcp), ("udp", nfs_udp), ("tcp", libvirtd_tcp)]:
-            for port in ports.split(','):
-                cmd = "iptables -I INPUT {0} -m state --state NEW -m {1} -p {1}" \
-                      " --dport {2:s} -j ACCEPT".format(line, proto, port)
-                line += 1
-                ret = self.rmt_exec(str(host), cmd, username=self.ssh_uid, password=self.ssh_pass)
-                errlines = ret[1].readlines()
-                self.logger.info("Issued: {0}".format(cmd))
-                if len(errlines) == 0:
-                    continue
-                else:
-                    raise EnvironmentError('The remote command failed {0}'.format(errlines))
-
-            ipsave_cmd = "service iptables save"
-            self.rmt_exec(str(host), ipsave_cmd, username=self.ssh_uid, password=self.ssh_pass)
+        self.for_each_host(apply_rules)
         self.logger.info("+" * 20)
         return True
 
+    @step("system_setup", "remote_setup", inputs=("settings.libvirtd",))
     def libvirtd_setup(self):
         """ libvirtd setup will configure libvirtd to listen on the external network interface.
 
         :return: upon success zero is returned if not an exception is raised.
         """
-        if os.path.isdir('/tmp/libvirtd_conf'):
-            os.chdir('/tmp/libvirtd_conf')
-        else:
-            os.mkdir('/tmp/libvirtd_conf')
-            os.chdir('/tmp/libvirtd_conf')
-
-        _libvirtd_conf = dict(self.libvirtd_config_obj.items('libvirtd_conf'))
-        _libvirtd_sysconf = dict(self.libvirtd_config_obj.items('libvirtd_sysconfig'))
+        _libvirtd_conf = dict(self.settings.libvirtd.libvirtd_conf)
+        _libvirtd_sysconf = dict(self.settings.libvirtd.libvirtd_sysconfig)
         banner(self.logger, ["_libvirtd_conf: {0}".format(_libvirtd_conf),
                              "_libvirtd_sysconf: {0}".format(_libvirtd_sysconf)])
 
+        # Edit the libvirtd files from the first node in memory, then push them to every node
+        docs = []
         for _dict_obj in [_libvirtd_conf, _libvirtd_sysconf]:
-            self.rmt_copy(self.nova_hosts_list[0], username=self.ssh_uid, password=self.ssh_pass,
-                          fname=_dict_obj['filename'], remote_path=_dict_obj['filepath'])
-
-        # Edit the libvirtd
-        for name, value in _libvirtd_conf.items():
-            self.adj_val(name, value, 'libvirtd.conf', 'libvirtd.conf.bak')
+            doc = self.rmt_load(self.nova_hosts_list[0], file_path(_dict_obj), username=self.ssh_uid,
+                                password=self.ssh_pass)
+            doc.update(file_edits(_dict_obj))
+            docs.append(doc)
 
-        for name, value in _libvirtd_sysconf.items():
-            self.adj_val(name, value, 'libvirtd', 'libvirtd.bak')
+        def push(host):
+            for doc in docs:
+                self.rmt_write(host, doc.name, doc.render(), username=self.ssh_uid, password=self.ssh_pass)
 
-        for host in self.nova_hosts_list:
-            for _obj in [_libvirtd_conf, _libvirtd_sysconf]:
-                self.rmt_copy(host, username=self.ssh_uid, password=self.ssh_pass,
-                              send=True, fname=_obj['filename'], remote_path=_obj['filepath'])
+        self.for_each_host(push)
 
         return True
 
+    @step("system_setup", "remote_setup", inputs=("settings.nova",))
     def nova_setup(self):
         """Nova setup will configure all necessary files for nova to enable live migration."""
 
-        if os.path.isdir('/tmp/nova_conf'):
-            os.chdir('/tmp/nova_conf')
-        else:
-            os.mkdir('/tmp/nova_conf')
-            os.chdir('/tmp/nova_conf')
-
         banner(self.logger, ["Doing nova.conf configuration"])
 
         def nova_adjust(nova_config_list):
+            docs = []
             for _conf in nova_config_list:
-                self.logger.info("Copying {0} to {1}".format(_conf['filename'], _conf['filepath']))
-                self.rmt_copy(self.nova_hosts_list[0], username=self.ssh_uid, password=self.ssh_pass,
-                              fname=_conf['filename'], remote_path=_conf['filepath'])
-                for name, value in _conf.items():
-                    self.adj_val(name, value, _conf['filename'], _conf['filename'] + '.bak', delim="=")
+                path = file_path(_conf)
+                self.logger.info("Editing {0}".format(path))
+                doc = self.rmt_load(self.nova_hosts_list[0], path, username=self.ssh_uid, password=self.ssh_pass,
+                                    doc_type=IniDocument)
+                doc.update(file_edits(_conf), delim="=")
+                docs.append(doc)
 
-            return True
+            return docs
 
-        _nova_conf = dict(self.nova_config_obj.items('nova_conf'))
+        _nova_conf = dict(self.settings.nova.nova_conf)
         cmd = "mkdir -p {0}".format(_nova_conf['state_path'])
 
         if self.distro_type.family in ["RHEL", "Centos"] and self.distro_type.version >= 7:
             self.logger.info("Doing nova setup for {0} {1}".format(self.distro_type.family, self.distro_type.version))
-            _nova_api_service = dict(self.nova_config_obj.items('nova_api_service'))
-            _nova_cert_service = dict(self.nova_config_obj.items('nova_cert_service'))
-            _nova_compute_service = dict(self.nova_config_obj.items('nova_compute_service'))
+            _nova_api_service = dict(self.settings.nova.nova_api_service)
+            _nova_cert_service = dict(self.settings.nova.nova_cert_service)
+            _nova_compute_service = dict(self.settings.nova.nova_compute_service)
             _nova_config_list = [_nova_conf, _nova_api_service, _nova_cert_service, _nova_compute_service]
 
-            nova_adjust(_nova_config_list)
+            docs = nova_adjust(_nova_config_list)
         else:
             self.logger.info("Doing nova setup for RHEL 6")
             _nova_config_list = [_nova_conf]
-            nova_adjust(_nova_config_list)
+            docs = nova_adjust(_nova_config_list)
 
-        for host in self.nova_hosts_list:
-            for conf in _nova_config_list:
-                self.rmt_copy(host, username=self.ssh_uid, password=self.ssh_pass,
-                              send=True, fname=conf['filename'], remote_path=conf['filepath'])
-            self.rmt_exec(host, cmd, username=self.ssh_uid, password=self.ssh_pass)
+        def push(host):
+            for doc in docs:
+                self.rmt_write(host, doc.name, doc.render(), username=self.ssh_uid, password=self.ssh_pass)
+            self.rmt_run(host, cmd, username=self.ssh_uid, password=self.ssh_pass)
+
+        self.for_each_host(push)
 
         return True
 
+    @step("system_setup", "remote_setup", inputs=("settings.share_storage",))
     def nfs_server_setup(self):
         """ NFS_Server setup will create an export file and copy this file to the nfs server, it will also
         determine the release of RHEL and configure version 3 or 4 nfs service.
 
         """
-        if os.path.isdir('/tmp/nfs_conf'):
-            os.chdir('/tmp/nfs_conf')
-        else:
-            os.mkdir('/tmp/nfs_conf')
-            os.chdir('/tmp/nfs_conf')
-
-        _nfs_export = self.config_gettr(self.share_storage_config_obj, 'nfs_export')['export']
-        _nfs_export_attribute = self.config_gettr(self.share_storage_config_obj, 'nfs_export')['attribute']
-        _nfs_export_net = self.config_gettr(self.share_storage_config_obj, 'nfs_export')['network']
-        _nfs_export_obj = dict(self.share_storage_config_obj.items('nfs_export'))
-
-        vals = dict(self.config_gettr(self.share_storage_config_obj, 'nfs_ports'))
-        fname, fpath = map(vals.pop, ("filename", "filepath"))  # pop them so we dont iterate on them later
+        _nfs_export_obj = self.settings.share_storage.nfs_export
+        _nfs_export = _nfs_export_obj['export']
+        _nfs_export_attribute = _nfs_export_obj['attribute']
+        _nfs_export_net = _nfs_export_obj['network']
+        _nfs_ports = self.settings.share_storage.nfs_ports
 
         banner(self.logger, ["Doing NFS server setup"])
 
-        # Copy the originals to our local machine.  we will use this for editing
-        self.rmt_copy(self.nfs_server, fname=fname, remote_path=fpath, username=self.ssh_uid, password=self.ssh_pass)
-        shutil.copyfile(fname, fname + ".bak")
-
         # Edit the files based on the values from share_storage config file
-        for k, v in vals.items():
-            self.adj_val(k, v, fname, fname + ".bak", not_found="append", delim="=")
-
-        # Send the modified files back to the original host
-        self.rmt_copy(self.nfs_server, username=self.ssh_uid, password=self.ssh_pass, send=True, fname=fname,
-                      remote_path=fpath)
+        self.rmt_edit(self.nfs_server, file_path(_nfs_ports), file_edits(_nfs_ports), username=self.ssh_uid,
+                      password=self.ssh_pass, not_found="append", delim="=")
 
         if self.distro_type.family in ["RHEL", "Centos"] and self.distro_type.version >= 7:
-            _nfs_idmapd_obj = dict(self.share_storage_config_obj.items('nfs_idmapd'))
-            _nfs_idmapd_domain = self.config_gettr(self.share_storage_config_obj, 'nfs_idmapd')['domain']
-            self.rmt_copy(self.nfs_server, fname=_nfs_idmapd_obj['filename'], username=self.ssh_uid,
-                          password=self.ssh_pass, remote_path=_nfs_idmapd_obj['filepath'])
-            self.adj_val('Domain', _nfs_idmapd_domain, _nfs_idmapd_obj['filename'],
-                         _nfs_idmapd_obj['filename'] + '.bak')
-            self.rmt_copy(self.nfs_server, username=self.ssh_uid, password=self.ssh_pass,
-                          send=True, fname=_nfs_idmapd_obj['filename'], remote_path=_nfs_idmapd_obj['filepath'])
+            _nfs_idmapd_obj = self.settings.share_storage.nfs_idmapd
+            _nfs_idmapd_domain = _nfs_idmapd_obj['domain']
+            self.rmt_edit(self.nfs_server, file_path(_nfs_idmapd_obj), {'Domain': _nfs_idmapd_domain},
+                          username=self.ssh_uid, password=self.ssh_pass, doc_type=IniDocument)
 
         nfs_exports_info = [_nfs_export, _nfs_export_net + _nfs_export_attribute]
-        export_fn = self.gen_file(_nfs_export_obj['filename'], nfs_exports_info)
-        self.rmt_copy(self.nfs_server, username=self.ssh_uid, password=self.ssh_pass,
-                      send=True, fname=export_fn, remote_path=_nfs_export_obj['filepath'])
+        self.rmt_write(self.nfs_server, file_path(_nfs_export_obj), "".join('%s   ' % i for i in nfs_exports_info),
+                       username=self.ssh_uid, password=self.ssh_pass)
 
         return True
 
+    @step("nfs_server_setup", inputs=("settings.system_info:fstab",))
     def nfs_client_setup(self):
         """NFS client function will append mount option for live migration to the compute nodes fstab file.
 
         """
-        if os.path.isdir('/tmp/nfs_conf'):
-            os.chdir('/tmp/nfs_conf')
-        else:
-            os.mkdir('/tmp/nfs_conf')
-            os.chdir('/tmp/nfs_conf')
-
         banner(self.logger, ["Doing NFS client setup"])
-        _fstab_filename = self.config_gettr(self.system_info_obj, 'fstab')['filename']
-        _nfs_server = self.config_gettr(self.system_info_obj, 'fstab')['nfs_server']
-        _nfs_mount_pt = self.config_gettr(self.system_info_obj, 'fstab')['nfs_client_mount']
-        _nfs_fstype = self.config_gettr(self.system_info_obj, 'fstab')['fstype']
-        _mnt_opts = self.config_gettr(self.system_info_obj, 'fstab')['attribute']
-        _fsck_opt = self.config_gettr(self.system_info_obj, 'fstab')['fsck']
-
-        fstab_entry = [_nfs_server, _nfs_mount_pt, _nfs_fstype, _mnt_opts, _fsck_opt]
+        fstab = self.settings.system_info.fstab
+        _fstab_filename = fstab['filename']
+
+        fstab_entry = [fstab['nfs_server'], fstab['nfs_client_mount'], fstab['fstype'], fstab['attribute'],
+                       fstab['fsck']]
         fstab_entry = "    ".join(fstab_entry)
 
         system_util = 'echo '
@@ -497,59 +610,64 @@ class Config(Base, Utils):
         cmd = [system_util, fstab_entry, system_util_operator, _fstab_filename]
         rmt_cmd = " ".join(cmd)
 
-        for host in self.nova_hosts_list:
-            ret = self.rmt_exec(str(host), rmt_cmd, username=self.ssh_uid, password=self.ssh_pass)
-            if ret[0].channel.recv_exit_status() == 0:
-                continue
-            else:
-                raise EnvironmentError('The remote command failed {0}'.format(ret[1].readlines()))
+        def add_entry(host):
+            ret = self.rmt_run(str(host), rmt_cmd, username=self.ssh_uid, password=self.ssh_pass)
+            if ret != 0:
+                raise EnvironmentError('The remote command failed {0}'.format(ret.error.splitlines()))
+
+        self.for_each_host(add_entry)
 
         return True
 
+    @step("preflight", "firewall_setup", "libvirtd_setup", "nova_setup", "nfs_server_setup",
+          "nfs_client_setup", "configure_etc_hosts", inputs=("settings.system_info:services", "nfs_server"))
     def finalize_services(self):
         """Looks at the [services] section of system_info, and performs any necessary operations"""
         banner(self.logger, ["Finalizing services"])
 
-        keys = ["nfs", "rpcbind", "libvirtd", "setenforce"]
-        vals = dict(self.system_info_obj.items('services'))
-        _nfs, _rpcbind, _libvirt, _setenforce = map(lambda x: vals[x], keys)
+        services = self.settings.system_info.services
+        _nfs, _rpcbind, _libvirt, _setenforce = services.nfs, services.rpcbind, services.libvirtd, services.setenforce
 
         # do the command for nfs
         def set_service(host, cmd, service_name, val):
             srv_cmd = {"command": val, "name": service_name}
             cmd = cmd.format(**srv_cmd)
             self.logger.info("Issuing {0} on host {1}".format(cmd, host))
-            return self.rmt_exec(str(host), cmd, username=self.ssh_uid, password=self.ssh_pass)
+            return self.rmt_run(str(host), cmd, username=self.ssh_uid, password=self.ssh_pass)
 
         # Ughh, this is ugly.  This should be made polymorphic
-        for host in self.nova_hosts_list:
+        def finalize(host):
             # NFS server
             srv_name = "nfs-server" if self.distro_type.nfs_ver == "nfs4" else "nfs"
             if host == self.nfs_server:
-                for i in _rpcbind.split(","):
+                for i in _rpcbind:
                     cmd = self.distro_type.service_enable if i in ["on", "enable"] else self.distro_type.service_cmd
                     set_service(host, cmd, "rpcbind", i)
-                for i in _nfs.split(","):
+                for i in _nfs:
                     cmd = self.distro_type.service_enable if i in ["on", "enable"] else self.distro_type.service_cmd
                     set_service(host, cmd, srv_name, i)
 
-            for i in _libvirt.split(","):
+            for i in _libvirt:
                 cmd = self.distro_type.service_enable if i in ["on", "enable"] else self.distro_type.service_cmd
                 set_service(host, cmd, "libvirtd", i)
 
             # FIXME: this is a temporary workaround
-            self.rmt_exec(str(host), "setenforce {0}".format(_setenforce), username=self.ssh_uid,
-                          password=self.ssh_pass)
+            self.rmt_run(str(host), "setenforce {0}".format(_setenforce), username=self.ssh_uid,
+                         password=self.ssh_pass)
             self.logger.info("Calling setenforce {0}".format(_setenforce))
-            out, _ = self.rmt_exec(str(host), "getenforce", username=self.ssh_uid, password=self.ssh_pass)
-            self.logger.info("getenforce: {0}".format("".join(out)))
+            res = self.rmt_run(str(host), "getenforce", username=self.ssh_uid, password=self.ssh_pass,
+                               read_only=True)
+            self.logger.info("getenforce: {0}".format(res.output))
 
+        self.for_each_host(finalize)
         return True
 
+    @step("system_setup", "remote_setup",
+          inputs=("settings.system_info:etc_hosts", "settings.share_storage:nfs_idmapd", "inventory"))
     def configure_etc_hosts(self):
-        """Sets the /etc/hosts file on both the controller and compute2 nodes
+        """Sets the /etc/hosts file on every nova host, with an entry for every host in the inventory
 
-        It copies the /etc/hosts file locally, edits it, then copies the edited file back.  The function
+        It reads the /etc/hosts file into memory, edits it, then writes the edited file back.  The function
         will also run the hostname command remotely in order to get the hostname from the nodes.  It
         compares this with the cdomain name from the nfs_idmapd section.  If there is a discrepancy or
         it can't retrieve the hostname, it will raise an error
@@ -557,18 +675,17 @@ class Config(Base, Utils):
         Returns a tuple of the short hostname and the full hostname
         """
         # Get the /etc/hosts file from the remote machine
-        getattr = lambda x: self.system_info_obj.get("etc_hosts", x)
-        fname, fpath = map(getattr, ["filename", "filepath"])
+        hosts_file = file_path(self.settings.system_info.etc_hosts)
 
         # Get the domain from the share_storage config file
-        domain = dict(self.config_gettr(self.share_storage_config_obj, "nfs_idmapd"))
-        domain_name = domain["domain"]
+        domain_name = self.settings.share_storage.nfs_idmapd["domain"]
 
         # Helper to retrieve the short and long names.
-        def get_host_names(host, domain):
-            out, _ = self.rmt_exec(host, "hostname", username=self.ssh_uid, password=self.ssh_pass)
+        def get_host_names(host, domain=domain_name):
             try:
-                hostname = out.readlines()[0].strip()
+                hostname = self.host_fact(host, "hostname", self.ssh_uid, self.ssh_pass)
+                if not hostname:
+                    raise ValueError("empty hostname")
             except Exception as e:
                 self.logger.error("Unable to get the hostname from {0}".format(host))
                 raise e
@@ -586,14 +703,14 @@ class Config(Base, Utils):
 
             return short, hostname
 
-        # Copy the originals to our local machine.  we will use this for editing
-        compute1_entry = "{0} {1}".format(*get_host_names(self.controller, domain_name))
-        compute2_entry = "{0} {1}".format(*get_host_names(self.compute2, domain_name))
-        entries = [(self.controller, compute1_entry), (self.compute2, compute2_entry)]
-        for host in self.nova_hosts_list:
-            self.rmt_copy(host, fname=fname, remote_path=fpath, username=self.ssh_uid, password=self.ssh_pass)
-            for h, v in entries:
-                self.adj_val(h, v, fname, fname + ".bak", not_found="append", delim=" ")
-            self.rmt_copy(host, username=self.ssh_uid, password=self.ssh_pass, send=True, fname=fname,
-                          remote_path=fpath)
+        # Only reads, so there is no need to roll it out
+        hosts = self.inventory.hosts()
+        names = self.fanout.run(get_host_names, hosts).raise_for_failures().values
+        entries = [(host, "{0} {1}".format(*names[host])) for host in hosts]
+
+        def edit_hosts(host):
+            self.rmt_edit(host, hosts_file, entries, username=self.ssh_uid, password=self.ssh_pass,
+                          not_found="append", delim=" ", doc_type=HostsDocument)
+
+        self.for_each_host(edit_hosts)
         return True
@@ -0,0 +1,123 @@
+"""
+Records what a run would change, for --plan.
+
+With the plan enabled, Utils.rmt_write, rmt_copy and rmt_run (for anything but the read only commands)
+don't touch the hosts.  They hand the change to glob_plan instead, as a unified diff between the current
+remote file and what would be written, or as the command line that would be run.  Everything that only
+reads (the probe, iptables-save, the remote files themselves) still runs, in parallel on all hosts, so
+the diffs are against the real state of the cluster.
+
+    python run_me.py --plan
+"""
+
+import difflib
+import threading
+
+from crucible.utils.logger import glob_logger as LOGGER
+
+LOCALHOST = "localhost"
+
+
+class Change(object):
+    """One file a run would write, or one command it would run, on one host"""
+    def __init__(self, host, kind, target, diff=None, input=None):
+        """
+        :param kind: "write" or "command"
+        :param target: the path written to, or the command line
+        :param diff: for a write, the lines of the unified diff
+        :param input: for a command, what it would be given on stdin
+        """
+        self.host = str(host)
+        self.kind = kind
+        self.target = target
+        self.diff = diff or []
+        self.input = input
+
+    def lines(self):
+        if self.kind == "write":
+            return ["# {0}:{1}".format(self.host, self.target)] + [l.rstrip("\n") for l in self.diff]
+        lines = ["$ {0}".format(self.target)]
+        if self.input:
+            lines.extend("  < {0}".format(l) for l in self.input.splitlines())
+        return lines
+
+
+def unified_diff(path, old, new):
+    """The unified diff of a file going from old to new contents.  old is None for a new file"""
+    return list(difflib.unified_diff((old or "").splitlines(True), new.splitlines(True),
+                                     fromfile="a" + path if old is not None else "/dev/null",
+                                     tofile="b" + path))
+
+
+class Plan(object):
+    def __init__(self, logger=LOGGER):
+        self.enabled = False
+        self.logger = logger
+        self.changes = []
+        self._lock = threading.Lock()
+
+    def _add(self, change):
+        with self._lock:
+            if any(c.host == change.host and c.kind == change.kind and c.target == change.target and
+                   c.input == change.input for c in self.changes):
+                return change
+            self.changes.append(change)
+        self.logger.debug("Planned on {0}: {1} {2}".format(change.host, change.kind, change.target))
+        return change
+
+    def write(self, host, path, old, new):
+        """
+        Records that path on host would get new as its contents
+
+        :param old: the current contents, or None if the file does not exist
+        :return: False if the file already has new as its contents, True otherwise
+        """
+        if old == new:
+            return False
+        self._add(Change(host, "write", path, diff=unified_diff(path, old, new)))
+        return True
+
+    def command(self, host, cmd, input=None):
+        """Records that cmd would be run on host (LOCALHOST for this machine)"""
+        return self._add(Change(host, "command", cmd, input=input))
+
+    def hosts(self):
+        """The hosts with changes, in the order they were first planned on"""
+        seen = []
+        for change in self.changes:
+            if change.host not in seen:
+                seen.append(change.host)
+        return seen
+
+    def for_host(self, host):
+        return [c for c in self.changes if c.host == str(host)]
+
+    def summary(self):
+        """One line per host, with the number of files and commands a run would change and run there"""
+        lines = []
+        for host in self.hosts():
+            changes = self.for_host(host)
+            writes = len([c for c in changes if c.kind == "write"])
+            lines.append("{0}: {1} file(s) to change, {2} command(s) to run".format(host, writes,
+                                                                                   len(changes) - writes))
+        return lines or ["Nothing to change"]
+
+    def report(self):
+        """The full plan: per host, the diff of every file and then every command, as lines"""
+        lines = []
+        for host in self.hosts():
+            changes = self.for_host(host)
+            lines.append("=" * 20 + " " + host + " " + "=" * 20)
+            for change in [c for c in changes if c.kind == "write"] + [c for c in changes if c.kind == "command"]:
+                lines.extend(change.lines())
+            lines.append("")
+        return lines
+
+    def save(self, path):
+        with open(path, "w") as plan_f:
+            for line in self.report():
+                plan_f.write(line + "\n")
+        self.logger.info("Wrote the plan of this run to {0}".format(path))
+
+
+glob_plan = Plan()
@@ -0,0 +1,145 @@
+"""
+Gathers all the facts crucible needs about a host with a single remote exec.
+
+PROBE_SCRIPT is fed to "sh -s" on the host's stdin, and prints one section per fact, each starting with
+a "@@crucible:<name>" marker line.  parse_probe() turns that output into a structured document:
+
+    {"os_info": {"flavor": ..., "version": ..., "name": ...},   # the fields OSInfo is built from
+     "os_release": {"NAME": ..., "VERSION_ID": ...},
+     "hostname": "compute1.example.com",
+     "fqdn": "compute1.example.com",
+     "selinux": "Enforcing",
+     "binaries": {"iptables": "/usr/sbin/iptables", ...},       # only the ones that are installed
+     "services": {"libvirtd": "active", ...},
+     "iptables": "<iptables-save output>",
+     "exports": "<contents of /etc/exports>",
+     "fstab": "<contents of /etc/fstab>"}
+"""
+
+import re
+import ast
+
+
+MARKER = "@@crucible:"
+
+BINARIES = ["sshpass", "packstack", "iptables", "iptables-save", "iptables-restore", "exportfs", "setenforce",
+            "getenforce", "systemctl", "yum"]
+
+SERVICES = ["rpcbind", "nfs", "nfs-server", "libvirtd", "iptables", "openstack-nova-compute"]
+
+PROBE_SCRIPT = """
+section() { echo "@@crucible:$1"; }
+section os_release; cat /etc/os-release 2>/dev/null
+section redhat_release; cat /etc/redhat-release 2>/dev/null
+section linux_distribution
+python -c "from platform import linux_distribution; print(repr(linux_distribution()))" 2>/dev/null
+section hostname; hostname
+section fqdn; hostname -f 2>/dev/null
+section selinux; getenforce 2>/dev/null
+section binaries
+for b in $BINARIES; do p=$(command -v $b 2>/dev/null) && echo "$b $p"; done
+section services
+for s in $SERVICES; do
+    if command -v systemctl >/dev/null 2>&1; then
+        st=$(systemctl is-active $s 2>/dev/null)
+    elif service $s status >/dev/null 2>&1; then
+        st=active
+    else
+        st=inactive
+    fi
+    echo "$s ${st:-unknown}"
+done
+section iptables; iptables-save 2>/dev/null
+section exports; cat /etc/exports 2>/dev/null
+section fstab; cat /etc/fstab 2>/dev/null
+section end
+"""
+
+
+class ProbeException(Exception):
+    pass
+
+
+def make_script(binaries=None, services=None):
+    """Returns the probe script, checking for the given binaries and services"""
+    binaries = BINARIES if binaries is None else binaries
+    services = SERVICES if services is None else services
+    header = 'BINARIES="{0}"\nSERVICES="{1}"\n'.format(" ".join(binaries), " ".join(services))
+    return header + PROBE_SCRIPT
+
+
+def split_sections(output):
+    """Splits the raw probe output into a dict of section name -> text"""
+    sections = {}
+    name = None
+    for line in output.splitlines():
+        if line.startswith(MARKER):
+            name = line[len(MARKER):].strip()
+            sections[name] = []
+        elif name is not None:
+            sections[name].append(line)
+    if "end" not in sections:
+        raise ProbeException("The probe output is truncated")
+    return dict((k, "\n".join(v)) for k, v in sections.items())
+
+
+def parse_os_release(text):
+    release = {}
+    for line in text.splitlines():
+        key, sep, value = line.partition("=")
+        if sep:
+            release[key.strip()] = value.strip().strip('"\'')
+    return release
+
+
+def os_info(sections, os_release):
+    """
+    Returns the (flavor, version, codename) fields for OSInfo.  platform.linux_distribution() is what
+    Utils.system_version always used, so it is preferred.  Hosts without a python that has it fall back
+    to /etc/redhat-release and then /etc/os-release
+    """
+    dist = sections.get("linux_distribution", "").strip()
+    if dist:
+        try:
+            flavor, version, name = ast.literal_eval(dist)
+            if flavor:
+                return {"flavor": flavor, "version": float(version), "name": name}
+        except (ValueError, SyntaxError):
+            pass
+
+    # eg Red Hat Enterprise Linux Server release 7.1 (Maipo)
+    m = re.match(r"(.*?) release ([\d.]+)[^(]*(?:\((.*)\))?", sections.get("redhat_release", "").strip())
+    if m:
+        flavor, version, name = m.groups()
+        version = ".".join(version.split(".")[:2])
+        return {"flavor": flavor, "version": float(version), "name": name or ""}
+
+    if os_release.get("NAME") and os_release.get("VERSION_ID"):
+        version = ".".join(os_release["VERSION_ID"].split(".")[:2])
+        return {"flavor": os_release["NAME"], "version": float(version), "name": ""}
+    raise ProbeException("Could not determine the linux distribution")
+
+
+def parse_probe(output):
+    """Turns the output of the probe script into the facts document described in the module docstring"""
+    sections = split_sections(output)
+    os_release = parse_os_release(sections.get("os_release", ""))
+
+    def pairs(name):
+        result = {}
+        for line in sections.get(name, "").splitlines():
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                result[parts[0]] = parts[1].strip()
+        return result
+
+    return {"os_info": os_info(sections, os_release),
+            "os_release": os_release,
+            "hostname": sections.get("hostname", "").strip(),
+            "fqdn": sections.get("fqdn", "").strip(),
+            "selinux": sections.get("selinux", "").strip(),
+            "binaries": pairs("binaries"),
+            "services": pairs("services"),
+            "iptables": sections.get("iptables", ""),
+            "exports": sections.get("exports", ""),
+            "fstab": sections.get("fstab", "")}
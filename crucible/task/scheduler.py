@@ -0,0 +1,213 @@
+"""
+Dependency graph scheduler for the steps of the LIVE_Migrate pipeline.
+
+Each step declares the steps it must run after with the crucible.helpers.decorators.step decorator.
+Scheduler.run() starts every step as soon as all of its requirements have finished, so steps that
+touch different files (eg firewall_setup, libvirtd_setup and nova_setup) overlap.  With serial=True
+the steps run one at a time in the order they were given, which is how run_me.py always used to work.
+
+Given a crucible.task.journal.Journal, every step that completes is recorded in it, and a step the
+journal says is already done (for --resume) is skipped.
+"""
+
+import time
+import threading
+from Queue import Queue, Empty
+
+from crucible.utils.logger import glob_logger as LOGGER
+from crucible.utils.metrics import glob_metrics as METRICS
+from crucible.utils.trace import glob_profiler as PROFILER
+
+
+class SchedulerException(Exception):
+    pass
+
+
+class StepResult(object):
+    def __init__(self, name, value=None, exception=None, start=0.0, end=0.0, skipped=False):
+        self.name = name
+        self.value = value
+        self.exception = exception
+        self.start = start
+        self.end = end
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        return self.exception is None and bool(self.value)
+
+    @property
+    def elapsed(self):
+        return self.end - self.start
+
+
+class ScheduleResult(object):
+    """What happened to every step of a schedule, in the order the steps were given"""
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.steps = {}
+        self.start = time.time()
+        self.end = None
+
+    @property
+    def successes(self):
+        return [name for name in self.scheduler.order if name in self.steps and self.steps[name].ok]
+
+    @property
+    def failures(self):
+        return [self.steps[name] for name in self.scheduler.order if name in self.steps and not self.steps[name].ok]
+
+    def critical_path(self):
+        """
+        Returns (total, [names]) for the chain of dependent steps that took the longest.  This is the
+        lower bound on the wall clock time of the pipeline no matter how much runs concurrently.
+        """
+        best = {}
+        for name in self.scheduler.order:
+            if name not in self.steps:
+                continue
+            before = [best[req] for req in self.scheduler.requires[name] if req in best]
+            total, path = max(before) if before else (0.0, [])
+            best[name] = (total + self.steps[name].elapsed, path + [name])
+        if not best:
+            return 0.0, []
+        return max(best.values())
+
+    def report(self):
+        lines = ["{0:<24}{1:>10}{2:>10}".format("step", "start", "elapsed")]
+        for name in self.scheduler.order:
+            if name in self.steps:
+                res = self.steps[name]
+                if res.skipped:
+                    lines.append("{0:<24}{1:>20}".format(name, "done before"))
+                    continue
+                lines.append("{0:<24}{1:>9.2f}s{2:>9.2f}s".format(name, res.start - self.start, res.elapsed))
+        total, path = self.critical_path()
+        lines.append("critical path ({0:.2f}s): {1}".format(total, " -> ".join(path)))
+        if self.end is not None:
+            lines.append("wall clock: {0:.2f}s".format(self.end - self.start))
+        return lines
+
+
+class Scheduler(object):
+    def __init__(self, steps, journal=None, logger=LOGGER):
+        """
+        :param steps: list of callables, in the order they would run serially.  A callable's requires
+            attribute (set by the step decorator) names the steps it depends on.  Requirements that are
+            not part of this pipeline are ignored
+        :param journal: crucible.task.journal.Journal to record completed steps in, and skip them from
+        """
+        self.logger = logger
+        self.journal = journal
+        self.fns = {}
+        self.order = []
+        for fn in steps:
+            name = fn.__name__
+            if name in self.fns:
+                raise SchedulerException("{0} is in the pipeline twice".format(name))
+            self.fns[name] = fn
+            self.order.append(name)
+
+        self.requires = {}
+        for name in self.order:
+            reqs = getattr(self.fns[name], "requires", ())
+            self.requires[name] = [req for req in reqs if req in self.fns]
+        self._check_cycles()
+
+    def _check_cycles(self):
+        state = {}
+
+        def visit(name, chain):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise SchedulerException("Circular step dependency: {0}".format(" -> ".join(chain + [name])))
+            state[name] = "visiting"
+            for req in self.requires[name]:
+                visit(req, chain + [name])
+            state[name] = "done"
+
+        for name in self.order:
+            visit(name, [])
+
+    def _run_step(self, name):
+        fprint = None
+        if self.journal is not None:
+            fprint = self.journal.fingerprint(self.fns[name])
+            if self.journal.step_done(name, fprint):
+                self.logger.info("Skipping {0}, an earlier run already did it".format(name))
+                now = time.time()
+                return StepResult(name, value=True, start=now, end=now, skipped=True)
+
+        self.logger.info("Running {0}".format(name))
+        res = StepResult(name, start=time.time())
+        with METRICS.context(step=name):
+            sample = METRICS.start("step")
+            try:
+                res.value = self.fns[name]()
+            except Exception as e:
+                res.exception = e
+                sample.error = repr(e)
+            res.end = time.time()
+            sample.elapsed = res.elapsed
+            METRICS.finish(sample)
+        if self.journal is not None:
+            self.journal.record_step(name, fprint, done=res.ok)
+        return res
+
+    def run(self, serial=False):
+        """
+        Runs the pipeline.  When a step raises or returns a false value, no new steps are started, the
+        steps already running are allowed to finish, and a SchedulerException is raised.
+
+        :param serial: run the steps one at a time in the order they were given
+        :return: ScheduleResult
+        """
+        result = ScheduleResult(self)
+        if serial:
+            for name in self.order:
+                res = result.steps[name] = self._run_step(name)
+                if not res.ok:
+                    break
+        else:
+            self._run_concurrent(result)
+        result.end = time.time()
+
+        for res in result.failures:
+            if res.exception is not None:
+                raise SchedulerException("Time to call it quits as {0} didn't complete its task: {1}".format(
+                    res.name, res.exception))
+            raise SchedulerException("Time to call it quits as {0} didn't complete its task.".format(res.name))
+        return result
+
+    def _run_concurrent(self, result):
+        finished = Queue()
+        pending = list(self.order)
+        running = set()
+        failed = False
+
+        def worker(name):
+            finished.put(self._run_step(name))
+
+        while pending or running:
+            if not failed:
+                ready = [name for name in pending if all(req in result.steps for req in self.requires[name])]
+                for name in ready:
+                    pending.remove(name)
+                    running.add(name)
+                    thr = threading.Thread(target=PROFILER.wrap(worker), args=(name,),
+                                           name="step-{0}".format(name))
+                    thr.daemon = True
+                    thr.start()
+            if not running:
+                break
+            try:
+                # get with a timeout so a KeyboardInterrupt still reaches the main thread
+                res = finished.get(timeout=0.5)
+            except Empty:
+                continue
+            running.discard(res.name)
+            result.steps[res.name] = res
+            if not res.ok:
+                self.logger.error("{0} failed, not starting any more steps".format(res.name))
+                failed = True
@@ -3,20 +3,30 @@ __credits__ = ['Toure Dunnon', 'Sean Toner']
 __license__ = 'GPL'
 __version__ = '2.1.0'
 
+import ast
 import time
 import os
 import re
+import select
 import logging
-
-from paramiko import SSHClient
-from paramiko import AutoAddPolicy
+import posixpath
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from StringIO import StringIO
 
 from scpclient import closing
 from scpclient import Read
 from scpclient import Write
 
 from crucible.utils.logger import glob_logger as LOGGER
+from crucible.utils.ssh_pool import glob_pool as POOL
+from crucible.utils.metrics import glob_metrics as METRICS
 from crucible.helpers.decorators import require_remote
+from crucible.task.config_doc import ConfigDocument
+from crucible.task.transfer_cache import glob_cache as CACHE
+from crucible.task.facts import glob_facts as FACTS
+from crucible.task.plan import glob_plan as PLAN, LOCALHOST
+from crucible.task import probe
 
 
 TRACE = logging.DEBUG
@@ -24,6 +34,206 @@ TRACE = logging.DEBUG
 version = 'python -c "from platform import linux_distribution\n\
 print linux_distribution()"'
 
+BUFSIZE = 32768
+
+# a streamed line longer than this is handed out in pieces, so a command that never prints a newline can't
+# make us buffer its whole output
+MAX_LINE = 65536
+
+# how many of the last lines of stdout and stderr a streamed RemoteResult keeps in output and error
+TAIL_LINES = 200
+
+RemoteLine = namedtuple("RemoteLine", ["host", "stream", "text"])
+
+
+class RemoteTimeout(Exception):
+    pass
+
+
+class _LineBuffer(object):
+    """Splits the data of one stream of one command into lines, remembering the last ones"""
+    def __init__(self, tail):
+        self.partial = ""
+        self.tail = deque(maxlen=tail)
+
+    def feed(self, data):
+        pieces = (self.partial + data).split("\n")
+        self.partial = pieces.pop()
+        if len(self.partial) >= MAX_LINE:
+            pieces.append(self.partial)
+            self.partial = ""
+        return self._keep(pieces)
+
+    def close(self):
+        pieces = [self.partial] if self.partial else []
+        self.partial = ""
+        return self._keep(pieces)
+
+    def _keep(self, pieces):
+        pieces = [p.rstrip("\r") for p in pieces]
+        self.tail.extend(pieces)
+        return pieces
+
+    def text(self):
+        return "".join(line + "\n" for line in self.tail)
+
+
+class RemoteResult(object):
+    """
+    Represents a command started on a remote host by Utils.rmt_run.
+
+    Like commander.ProcessResult, the object can be used for truth value testing (it is true once the
+    remote command has finished) and compared against an int to check the return code.  Until wait()
+    has been called, output, error and returncode are None.
+    """
+    def __init__(self, hostname, cmd, channel, sample=None):
+        self.hostname = hostname
+        self.cmd = cmd
+        self.channel = channel
+        self.output = None
+        self.error = None
+        self.returncode = None
+        self.sample = sample
+        self.received = 0
+        self.started = time.time()
+        self.planned = False
+
+    @classmethod
+    def from_plan(cls, hostname, cmd):
+        """The result of a command that --plan recorded instead of running: it "succeeded" with no output"""
+        result = cls(hostname, cmd, None)
+        result.output = result.error = ""
+        result.returncode = 0
+        result.planned = True
+        return result
+
+    def _finished(self):
+        """Completes the metrics sample of the command once it has exited"""
+        if self.sample is not None:
+            self.sample.phases["wait"] = time.time() - self.started
+            self.sample.bytes_in = self.received
+            self.sample.returncode = self.returncode
+            METRICS.finish(self.sample)
+
+    def __nonzero__(self):
+        return self.returncode is not None
+
+    def __eq__(self, other):
+        return self.returncode == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def wait(self, timeout=None, callback=None):
+        """
+        Blocks until the remote command has exited, collecting stdout and stderr as the data arrives.
+
+        There is no polling involved, we select() on the channel which wakes up whenever data, EOF or
+        the exit status comes in.
+
+        :param timeout: seconds to wait before raising RemoteTimeout.  None waits forever
+        :param callback: if given, called with a RemoteLine for every line as it arrives.  Only the
+            last TAIL_LINES lines are then kept in output and error
+        :return: self
+        """
+        if self.returncode is not None:
+            return self
+        if callback is not None:
+            for line in stream_lines([self], timeout=timeout):
+                callback(line)
+            return self
+
+        chan = self.channel
+        deadline = None if timeout is None else time.time() + timeout
+        out, err = [], []
+
+        def remaining():
+            if deadline is None:
+                return None
+            left = deadline - time.time()
+            if left <= 0:
+                raise RemoteTimeout("{0} on host {1} did not finish within {2}s".format(self.cmd, self.hostname,
+                                                                                       timeout))
+            return left
+
+        while True:
+            done = chan.eof_received or chan.closed
+            while chan.recv_ready():
+                out.append(chan.recv(BUFSIZE))
+            while chan.recv_stderr_ready():
+                err.append(chan.recv_stderr(BUFSIZE))
+            if done:
+                break
+            select.select([chan], [], [], remaining())
+
+        chan.status_event.wait(remaining())
+        if not chan.exit_status_ready():
+            remaining()
+        self.output = "".join(out)
+        self.error = "".join(err)
+        self.returncode = chan.recv_exit_status()
+        self.received = len(self.output) + len(self.error)
+        self._finished()
+        return self
+
+
+def stream_lines(results, timeout=None, tail=TAIL_LINES):
+    """
+    Yields a RemoteLine for every line the running commands of results print, interleaved in the order
+    the data arrives and tagged with the host and the stream ("stdout" or "stderr") it came from.  Only
+    a partial line and the last tail lines of each stream are buffered, so memory stays flat no matter
+    how long the commands run.  Once a command has exited, its RemoteResult gets the returncode and the
+    tail of its stdout and stderr as output and error.
+
+    :param results: RemoteResults started with rmt_run(..., wait=False)
+    :param timeout: seconds to wait for all the commands before raising RemoteTimeout
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    pending = [res for res in results if res.returncode is None]
+    buffers = dict((id(res), (_LineBuffer(tail), _LineBuffer(tail))) for res in pending)
+
+    def remaining():
+        if deadline is None:
+            return None
+        left = deadline - time.time()
+        if left <= 0:
+            raise RemoteTimeout("{0} on host(s) {1} did not finish within {2}s".format(
+                pending[0].cmd, ", ".join(str(res.hostname) for res in pending), timeout))
+        return left
+
+    while pending:
+        for res in list(pending):
+            chan = res.channel
+            out, err = buffers[id(res)]
+            done = chan.eof_received or chan.closed
+            while chan.recv_ready():
+                data = chan.recv(BUFSIZE)
+                res.received += len(data)
+                for text in out.feed(data):
+                    yield RemoteLine(res.hostname, "stdout", text)
+            while chan.recv_stderr_ready():
+                data = chan.recv_stderr(BUFSIZE)
+                res.received += len(data)
+                for text in err.feed(data):
+                    yield RemoteLine(res.hostname, "stderr", text)
+            if not done:
+                continue
+
+            for stream, buf in (("stdout", out), ("stderr", err)):
+                for text in buf.close():
+                    yield RemoteLine(res.hostname, stream, text)
+            chan.status_event.wait(remaining())
+            if not chan.exit_status_ready():
+                remaining()
+            res.output = out.text()
+            res.error = err.text()
+            res.returncode = chan.recv_exit_status()
+            res._finished()
+            pending.remove(res)
+
+        if pending:
+            select.select([res.channel for res in pending], [], [], remaining())
+
 
 class OSInfo:
     def __init__(self, flavor, version, name):
@@ -58,6 +268,10 @@ class OSInfo:
         else:
             raise Exception("{0} is not a supported linux distro".format(self.flavor))
 
+    def to_dict(self):
+        """The fields OSInfo is built from, so it can be kept in the facts cache"""
+        return {"flavor": self.flavor, "version": self.version, "name": self.name}
+
     def enable_service(self, srv_name):
         cmd = "on" if self.nfs_ver == "nfs" else "enable"
         return self.service_enable.format(name=srv_name, command=cmd)
@@ -72,16 +286,44 @@ class Utils(object):
         """
         :return: RHEL release version number.
         """
-        ssh_out, ssh_err = self.rmt_exec(host, cmd, username=user, password=pw)
-        lines = ssh_out.readlines()
+        res = self.rmt_run(host, cmd, username=user, password=pw, read_only=True)
+        lines = res.output.splitlines()
         out = lines[0].strip()
-        res = eval(out)
+        res = ast.literal_eval(out)
         flavor, version, codename = res
         version = float(version)
         return OSInfo(flavor, version, codename)
 
+    def os_info(self, host, user, pw):
+        """
+        Same as system_version, but answered from the facts cache when the distro of host is already known,
+        and otherwise gathered by the probe along with the other facts of the host
+        """
+        return OSInfo(**self.host_fact(host, "os_info", user, pw))
+
+    def host_facts(self, host, user, pw):
+        """
+        Runs the crucible.task.probe script on host, which gathers every fact we need (os release, hostname,
+        selinux mode, installed binaries, service states, iptables rules, nfs exports and fstab) in a single
+        exec.  Each fact is stored in the facts cache.
+
+        :return: the facts document (see crucible.task.probe)
+        """
+        res = self.rmt_run(host, "sh -s", username=user, password=pw, input=probe.make_script(), read_only=True)
+        facts = probe.parse_probe(res.output)
+        for name, value in facts.items():
+            FACTS.set(host, name, value)
+        return facts
+
+    def host_fact(self, host, name, user, pw):
+        """Returns one fact about host from the facts cache, running the probe if it is not known"""
+        value = FACTS.get(host, name)
+        if value is None:
+            value = self.host_facts(host, user, pw)[name]
+        return value
+
     def rmt_copy(self, hostname, username=None, password=None, send=False,
-                 fname=None, remote_path=None):
+                 fname=None, remote_path=None, cached=True):
         """Remote copy function retrieves files from specified host.
 
         :param hostname: host name or ip address
@@ -91,17 +333,171 @@ class Utils(object):
         :type  send: bool
         :param fname: file name which to transport
         :param remote_path: where to place the file on the other end.
+        :param cached: if True, skip the transfer when the transfer cache knows the remote file is
+            already identical to what we would fetch or send.  Must be False for a file holding a secret,
+            the cache keeps a copy of every file it sees
         """
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-        ssh.connect(hostname, username=username, password=password)
+        target = posixpath.join(remote_path, os.path.basename(fname))
+        host = str(hostname)
+        if send and PLAN.enabled:
+            PLAN.command(LOCALHOST, "scp {0} {1}:{2}".format(fname, host, target))
+            return
+        ssh = POOL.get(hostname, username=username, password=password)
+
+        with METRICS.timer("scp_send" if send else "scp_receive", hostname, path=target) as sample:
+            st = None
+            if cached and CACHE.enabled:
+                with self.rmt_sftp(hostname, username=username, password=password) as sftp:
+                    try:
+                        st = sftp.stat(target)
+                    except IOError:
+                        st = None
+
+            if not send:
+                data = CACHE.fetch(host, target, st)
+                sample.fields["cached"] = data is not None
+                if data is not None:
+                    with open(fname, "wb") as local_f:
+                        local_f.write(data)
+                    return
+                with closing(Read(ssh.get_transport(), remote_path)) as scp:
+                    scp.receive_file(fname)
+                sample.bytes_in = os.path.getsize(fname)
+                if st is not None:
+                    with open(fname, "rb") as local_f:
+                        CACHE.record(host, target, st, local_f.read())
+            else:
+                with open(fname, "rb") as local_f:
+                    data = local_f.read()
+                sample.fields["cached"] = CACHE.matches(host, target, st, data)
+                if sample.fields["cached"]:
+                    LOGGER.debug("{0}:{1} is already up to date, not sending {2}".format(host, target, fname))
+                    return
+                with closing(Write(ssh.get_transport(), remote_path)) as scp:
+                    scp.send_file(fname, send)
+                sample.bytes_out = len(data)
+                if cached and CACHE.enabled:
+                    with self.rmt_sftp(hostname, username=username, password=password) as sftp:
+                        CACHE.record(host, target, sftp.stat(target), data)
+
+    @contextmanager
+    def rmt_sftp(self, hostname, username=None, password=None):
+        """Opens an SFTP session over the pooled connection to hostname, and closes it when done"""
+        sftp = POOL.get(hostname, username=username, password=password).open_sftp()
+        try:
+            yield sftp
+        finally:
+            sftp.close()
 
-        if not send:
-            with closing(Read(ssh.get_transport(), remote_path)) as scp:
-                scp.receive_file(fname)
-        else:
-            with closing(Write(ssh.get_transport(), remote_path)) as scp:
-                scp.send_file(fname, send)
+    def rmt_read(self, hostname, path, username=None, password=None, cached=True):
+        """Reads a remote file into memory over SFTP.
+
+        :param hostname: host name or ip address
+        :param path: full path of the file on the remote host
+        :param cached: if False, neither use nor update the transfer cache (for files holding secrets)
+        :return: the contents of the file as a str
+        """
+        with METRICS.timer("sftp_read", hostname, path=path) as sample:
+            with self.rmt_sftp(hostname, username=username, password=password) as sftp:
+                st = sftp.stat(path) if cached else None
+                data = CACHE.fetch(str(hostname), path, st)
+                sample.fields["cached"] = data is not None
+                if data is None:
+                    with sftp.open(path, "r") as rfile:
+                        data = rfile.read()
+                    sample.bytes_in = len(data)
+                    CACHE.record(str(hostname), path, st, data)
+                return data
+
+    def rmt_write(self, hostname, path, data, username=None, password=None, backup=True, cached=True):
+        """Atomically replaces a remote file with data.
+
+        The data is written to a temporary file next to path, which gets the mode and ownership of the
+        file it replaces, and is then renamed over path.  Readers on the remote host will either see the
+        old or the new file, never a partially written one.
+
+        :param hostname: host name or ip address
+        :param path: full path of the file on the remote host
+        :param data: the new contents of the file
+        :param backup: if True, and path + '.orig' does not exist yet, keep the current file there (like
+            make_backup_file does for local files)
+        :param cached: if False, neither use nor update the transfer cache (for files holding secrets)
+        :return: False if the remote file already contained data and nothing was written, True otherwise
+        """
+        if PLAN.enabled:
+            try:
+                current = self.rmt_read(hostname, path, username=username, password=password, cached=cached)
+            except IOError:
+                current = None
+            return PLAN.write(hostname, path, current, data)
+
+        tmp_path = posixpath.join(posixpath.dirname(path), ".{0}.crucible-tmp".format(posixpath.basename(path)))
+        with METRICS.timer("sftp_write", hostname, path=path) as sample:
+            with self.rmt_sftp(hostname, username=username, password=password) as sftp:
+                try:
+                    st = sftp.stat(path)
+                except IOError:
+                    st = None
+
+                sample.fields["cached"] = cached and CACHE.matches(str(hostname), path, st, data)
+                if sample.fields["cached"]:
+                    LOGGER.log(TRACE, "{0}:{1} is already up to date".format(hostname, path))
+                    return False
+
+                if backup and st is not None:
+                    pristine = path + ".orig"
+                    try:
+                        sftp.stat(pristine)
+                    except IOError:
+                        original = CACHE.fetch(str(hostname), path, st) if cached else None
+                        if original is None:
+                            with sftp.open(path, "r") as orig_f:
+                                original = orig_f.read()
+                        with sftp.open(pristine, "w") as pristine_f:
+                            pristine_f.write(original)
+
+                with sftp.open(tmp_path, "w") as tmp_f:
+                    tmp_f.write(data)
+                sample.bytes_out = len(data)
+                if st is not None:
+                    sftp.chmod(tmp_path, st.st_mode & 0o7777)
+                    sftp.chown(tmp_path, st.st_uid, st.st_gid)
+
+                if hasattr(sftp, "posix_rename"):
+                    sftp.posix_rename(tmp_path, path)
+                else:
+                    # older paramiko has no posix-rename@openssh.com support and plain rename won't overwrite
+                    self.rmt_run(hostname, "mv -f {0} {1}".format(tmp_path, path), username=username,
+                                 password=password, check=True)
+                if cached:
+                    CACHE.record(str(hostname), path, sftp.stat(path), data)
+            LOGGER.log(TRACE, "Wrote {0} bytes to {1}:{2}".format(len(data), hostname, path))
+            return True
+
+    def rmt_load(self, hostname, path, username=None, password=None, doc_type=ConfigDocument, cached=True):
+        """Reads a remote config file into a config_doc document"""
+        return doc_type(self.rmt_read(hostname, path, username=username, password=password, cached=cached),
+                        name=path)
+
+    def rmt_edit(self, hostname, path, edits, username=None, password=None, not_found="ignore", delim=None,
+                 doc_type=ConfigDocument, section=None):
+        """Remote version of adj_vals.  The file is fetched into memory, edited, and written back atomically
+        with rmt_write.  If none of the edits change anything, nothing is written.
+
+        :param hostname: host name or ip address
+        :param path: full path of the config file on the remote host
+        :param edits: dict (or sequence of (key, value) pairs) of tokens and their new values
+        :param not_found: can be one of 'ignore', 'append', or 'fail' (see adj_val)
+        :param delim: If specified, use delim as the delimiter instead of what is found in the file.
+        :param doc_type: the config_doc class that knows the format of the file
+        :param section: for IniDocument, only edit keys in this section
+        :return: the edited document
+        """
+        doc = self.rmt_load(hostname, path, username=username, password=password, doc_type=doc_type)
+        doc.update(edits, not_found=not_found, delim=delim, section=section)
+        if doc.modified:
+            self.rmt_write(hostname, path, doc.render(), username=username, password=password)
+        return doc
 
     def rmt_exec(self, hostname, cmd, username=None, password=None, check=False, valid=None, throws=True):
         """Remote execution function to run defined commands.
@@ -113,22 +509,104 @@ class Utils(object):
         :return: list that contains standard shell information.
          ei. rmt_exec('localhost', 'date') ==> ['Fri Sep  5 12:16:58 EDT 2014\n']
         """
-        ssh = SSHClient()
-        ssh.set_missing_host_key_policy(AutoAddPolicy())
-        ssh.connect(hostname, port=22, username=username, password=password)
-        ssh_stdin, ssh_stdout, ssh_stderr = ssh.exec_command(cmd)
-        time.sleep(.25)
+        if PLAN.enabled:
+            PLAN.command(hostname, cmd)
+            return StringIO(""), StringIO("")
+        with METRICS.timer("exec", hostname, cmd=cmd) as sample:
+            with sample.phase("exec"):
+                ssh_stdin, ssh_stdout, ssh_stderr = POOL.exec_command(hostname, cmd, username=username,
+                                                                      password=password)
+
+            if check:
+                with sample.phase("wait"):
+                    ret = sample.returncode = ssh_stdout.channel.recv_exit_status()
+                self._check_returncode(hostname, cmd, ret, valid, throws)
+        return ssh_stdout, ssh_stderr
+
+    def rmt_run(self, hostname, cmd, username=None, password=None, wait=True, timeout=None, check=False,
+                valid=None, throws=True, input=None, callback=None, read_only=False):
+        """Runs a command on a remote host and returns stdout, stderr and the exit code together.
 
+        :param hostname: server hostname in which to run command.
+        :param cmd: system command which will be ran from a remote shell.
+        :param username: user with sufficient privilege to execute defined command.
+        :param password: password for user.
+        :param wait: if False, return as soon as the command is started.  Call wait() on the result
+            when (and if) the output is needed
+        :param timeout: seconds to wait for the command before raising RemoteTimeout
+        :param check: if True, validate the returncode against valid (only when wait is True)
+        :param valid: list of acceptable return codes, defaults to [0]
+        :param throws: if True raise an exception on an invalid returncode, otherwise just log it
+        :param input: data to send to the stdin of the command
+        :param callback: called with a RemoteLine for every line as it arrives (see RemoteResult.wait)
+        :param read_only: the command doesn't change anything on the host, so it is run even with --plan.
+            Any other command is only recorded in the plan, and "succeeds" with no output
+        :return: RemoteResult
+         ei. rmt_run('localhost', 'date').output ==> 'Fri Sep  5 12:16:58 EDT 2014\n'
+        """
+        if PLAN.enabled and not read_only:
+            PLAN.command(hostname, cmd, input=input)
+            return RemoteResult.from_plan(hostname, cmd)
+        sample = METRICS.start("exec", hostname, cmd=cmd)
+        try:
+            with sample.phase("exec"):
+                ssh_stdin, ssh_stdout, ssh_stderr = POOL.exec_command(hostname, cmd, username=username,
+                                                                      password=password)
+                if input is not None:
+                    ssh_stdin.write(input)
+                    ssh_stdin.flush()
+                    sample.bytes_out = len(input)
+                ssh_stdin.channel.shutdown_write()
+                ssh_stdin.close()
+        except Exception as e:
+            sample.error = repr(e)
+            METRICS.finish(sample)
+            raise
+        result = RemoteResult(hostname, cmd, ssh_stdout.channel, sample=sample)
+        if not wait:
+            return result
+
+        result.wait(timeout=timeout, callback=callback)
         if check:
-            ret = ssh_stdout.channel.recv_exit_status()
-            valid = [0] if valid is None else valid
-            if ret not in valid:
-                msg = "{0} failed on host {1} with returncode = {2}".format(cmd, hostname, ret)
-                if throws:
-                    raise Exception(msg)
-                else:
-                    LOGGER.error(msg)
-        return ssh_stdout, ssh_stderr
+            self._check_returncode(hostname, cmd, result.returncode, valid, throws)
+        return result
+
+    def rmt_stream(self, hostname, cmd, username=None, password=None, timeout=None, callback=None, check=False,
+                   valid=None, throws=True, input=None, tail=TAIL_LINES):
+        """Runs a command on one or more remote hosts and yields their output line by line as it arrives.
+
+        Meant for long running commands like packstack: progress shows up live, and only a bounded
+        amount of output is ever held in memory (see stream_lines).
+
+        :param hostname: a host, or a list of hosts to run the command on at the same time
+        :param cmd: system command which will be ran from a remote shell.
+        :param callback: if given, also called with every RemoteLine
+        :param check: if True, validate the returncode of every host against valid once all have finished
+        :param input: data to send to the stdin of the command
+        :param tail: how many of the last lines the RemoteResults keep in output and error
+        :return: generator of RemoteLine(host, stream, text)
+         ei. for line in rmt_stream(['compute1', 'compute2'], 'yum -y update'): print line.host, line.text
+        """
+        hosts = [hostname] if isinstance(hostname, basestring) else list(hostname)
+        results = [self.rmt_run(host, cmd, username=username, password=password, wait=False, input=input)
+                   for host in hosts]
+        for line in stream_lines(results, timeout=timeout, tail=tail):
+            if callback is not None:
+                callback(line)
+            yield line
+        if check:
+            for res in results:
+                self._check_returncode(res.hostname, cmd, res.returncode, valid, throws)
+
+    @staticmethod
+    def _check_returncode(hostname, cmd, ret, valid=None, throws=True):
+        valid = [0] if valid is None else valid
+        if ret not in valid:
+            msg = "{0} failed on host {1} with returncode = {2}".format(cmd, hostname, ret)
+            if throws:
+                raise Exception(msg)
+            else:
+                LOGGER.error(msg, extra={"host": str(hostname), "command": cmd})
 
     @staticmethod
     def make_backup_file(orig_f, backup_f, o_file):
@@ -217,6 +695,26 @@ class Utils(object):
                   "{0} and {1}".format(o_file, b_file))
             exit()
 
+    def adj_vals(self, edits, o_file, b_file, not_found="ignore", delim=None, doc_type=ConfigDocument, section=None):
+        """Batched version of adj_val.  Changes every key in edits with a single read of o_file and a single
+        write of o_file and b_file.
+
+        :param edits: dict (or sequence of (key, value) pairs) of tokens and their new values
+        :param o_file: current configuration file which to read data.
+        :param b_file: backup configuration file which to write out original data
+            before changing the original file.
+        :param not_found: can be one of 'ignore', 'append', or 'fail' (see adj_val)
+        :param delim: If specified, use delim as the delimiter instead of what is found in the file.
+        :param doc_type: the config_doc class that knows the format of o_file
+        :param section: for IniDocument, only edit keys in this section
+        :return: the edited document
+        """
+        LOGGER.log(TRACE, "Trying to set {0} in file {1}".format(edits, o_file))
+        doc = doc_type.load(o_file)
+        doc.update(edits, not_found=not_found, delim=delim, section=section)
+        doc.save(o_file, backup=b_file)
+        return doc
+
     def gen_file(self, filename, value):
 
         """gen_file will create a new file according to the input provided.
@@ -257,16 +755,13 @@ class Utils(object):
             pwd.write(password)
 
         self.rmt_copy(target, username=username, password=password, send=True, fname="/tmp/pass.txt",
-                      remote_path="/tmp")
+                      remote_path="/tmp", cached=False)
 
         copy_cmd = "sshpass -f /tmp/pass.txt ssh-copy-id -i -o StrictHostKeyChecking=no root@{0}".format(target)
-        out, err = self.rmt_exec(host, copy_cmd, username=username, password=password)
-
-        while not out.channel.exit_status_ready():
-            time.sleep(1)
+        res = self.rmt_run(host, copy_cmd, username=username, password=password)
 
         # clean up the passwords
         os.unlink("/tmp/pass.txt")
-        self.rmt_exec(host, "rm -f /tmp/pass.txt", username=username, password=password)
+        self.rmt_run(host, "rm -f /tmp/pass.txt", username=username, password=password, wait=False)
 
-        return out.channel.recv_exit_status()
+        return res.returncode
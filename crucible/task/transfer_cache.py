@@ -0,0 +1,161 @@
+"""
+Content addressed cache of the files crucible moves to and from the remote hosts.
+
+Every file we fetch or push is stored once under its sha1 in the objects directory, and an index
+remembers, per (host, remote path), the size, mtime and digest the remote file had the last time we
+saw it.  When a remote file still has the same size and mtime, its contents are served from the cache
+instead of being downloaded again, and a push is skipped when the remote file already has the digest
+we are about to send.  On a rerun against hosts that are already configured, almost nothing goes over
+the wire.
+
+The cache directory is only readable by its owner.  Files holding secrets (the password file
+copy_public_keys sends, the packstack answer file) are transferred with cached=False and never stored.
+
+Note that mtimes reported over SFTP have a one second resolution, so a remote file that is changed
+(by someone else) within the same second we last saw it, without its size changing, is not detected.
+"""
+
+import os
+import json
+import errno
+import hashlib
+import threading
+
+from crucible.utils.logger import glob_logger as LOGGER
+
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".crucible", "cache")
+
+
+class TransferCache(object):
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, enabled=True, logger=LOGGER):
+        """
+        :param cache_dir: where the objects and the index are kept.  Created on the first write
+        :param enabled: if False, every lookup misses and nothing is stored
+        """
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.logger = logger
+        self._index = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha1(data).hexdigest()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.cache_dir, "index.json")
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest[2:])
+
+    def _load_index(self):
+        """Must be called with self._lock held"""
+        if self._index is None:
+            try:
+                with open(self.index_path, "r") as index_f:
+                    self._index = json.load(index_f)
+            except (IOError, ValueError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        """Must be called with self._lock held"""
+        tmp = self.index_path + ".tmp"
+        with self._create(tmp, "w") as index_f:
+            json.dump(self._index, index_f)
+        os.rename(tmp, self.index_path)
+
+    @staticmethod
+    def _mkdirs(path):
+        try:
+            os.makedirs(path, 0o700)
+        except OSError as oe:
+            if oe.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def _create(path, mode):
+        """Opens a new file that only its owner can read"""
+        return os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), mode)
+
+    def get_object(self, digest):
+        """Returns the cached contents for digest, or None"""
+        try:
+            with open(self._object_path(digest), "rb") as obj_f:
+                data = obj_f.read()
+        except IOError:
+            return None
+        # a truncated or corrupted object is as good as a miss
+        return data if self.digest(data) == digest else None
+
+    def put_object(self, data):
+        digest = self.digest(data)
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            self._mkdirs(os.path.dirname(path))
+            tmp = "{0}.{1}.tmp".format(path, threading.current_thread().ident)
+            with self._create(tmp, "wb") as obj_f:
+                obj_f.write(data)
+            os.rename(tmp, path)
+        return digest
+
+    def lookup(self, host, path, st):
+        """
+        Returns the digest recorded for host:path if the remote file still has the size and mtime of
+        st (an SFTPAttributes or os.stat_result), otherwise None
+        """
+        if not self.enabled or st is None:
+            return None
+        with self._lock:
+            entry = self._load_index().get(host, {}).get(path)
+        if entry is None or entry["size"] != st.st_size or entry["mtime"] != int(st.st_mtime):
+            return None
+        return entry["digest"]
+
+    def fetch(self, host, path, st):
+        """Returns the cached contents of host:path if it is still current, otherwise None"""
+        digest = self.lookup(host, path, st)
+        if digest is None:
+            return None
+        data = self.get_object(digest)
+        if data is not None:
+            self.logger.debug("Transfer cache hit for {0}:{1}".format(host, path))
+        return data
+
+    def matches(self, host, path, st, data):
+        """True if the remote file host:path is known to already contain data"""
+        digest = self.lookup(host, path, st)
+        return digest is not None and digest == self.digest(data)
+
+    def record(self, host, path, st, data):
+        """Remembers that host:path, with the size and mtime of st, contains data"""
+        if not self.enabled or st is None:
+            return
+        try:
+            digest = self.put_object(data)
+            with self._lock:
+                host_index = self._load_index().setdefault(host, {})
+                host_index[path] = {"size": st.st_size, "mtime": int(st.st_mtime), "digest": digest}
+                self._save_index()
+        except (IOError, OSError) as e:
+            # The cache is an optimization, never a reason to fail a run
+            self.logger.warning("Could not update the transfer cache: {0}".format(e))
+
+    def invalidate(self, host=None, path=None):
+        """Forgets what we know about host:path, every path of host, or everything"""
+        with self._lock:
+            index = self._load_index()
+            for entry_host in list(index.keys()):
+                if host is not None and entry_host != host:
+                    continue
+                if path is None:
+                    del index[entry_host]
+                else:
+                    index[entry_host].pop(path, None)
+            if os.path.isdir(self.cache_dir):
+                self._save_index()
+
+
+glob_cache = TransferCache()
@@ -1,13 +1,41 @@
 """
 Simple logging helper class
 
+Records are not written by the thread that logs them.  A logger made by make_queue_logger only has a
+QueueHandler, which puts the record on a queue, and a QueueListener thread does the formatting and the
+file I/O for the real handlers.  The text log rotates by size, and add_json_log() adds a JSON lines sink
+whose records carry the host, step and command they were logged for.
+
 Author: Sean Toner
 """
 
 import logging
+import logging.handlers
+import threading
+import atexit
+import copy
+import json
 import time
 import sys
 import os
+from Queue import Queue
+
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    QueueHandler = QueueListener = None
+
+# the text log is rotated once it reaches MAX_BYTES, keeping BACKUPS old files
+MAX_BYTES = 10 * 1024 * 1024
+BACKUPS = 5
+
+# the fields every record gets from ContextFilter
+CONTEXT_FIELDS = ("host", "step", "command")
+
+_LISTENERS = {}
+
+# glob_metrics, resolved by the first ContextFilter.filter call (crucible.utils.metrics imports this module)
+_METRICS = None
 
 
 def make_timestamp():
@@ -50,10 +78,22 @@ def make_stream_handler(fmt, stream=sys.stdout, loglevel=logging.INFO):
     return strm_handler
 
 
-def make_file_handler(fmt, filename, loglevel=logging.DEBUG):
+def make_file_handler(fmt, filename, loglevel=logging.DEBUG, delay=True):
     """
+    With delay (the default), filename is only created when the first record is logged, so importing a
+    module that has a logger doesn't leave an empty log file behind
     """
-    file_handler = logging.FileHandler(filename)
+    file_handler = logging.FileHandler(filename, delay=delay)
+    file_handler.setFormatter(fmt)
+    file_handler.setLevel(loglevel)
+    return file_handler
+
+
+def make_rotating_file_handler(fmt, filename, loglevel=logging.DEBUG, max_bytes=MAX_BYTES, backups=BACKUPS,
+                               delay=True):
+    """Like make_file_handler, but filename is rotated to filename.1 ... filename.<backups> at max_bytes"""
+    file_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backups,
+                                                        delay=delay)
     file_handler.setFormatter(fmt)
     file_handler.setLevel(loglevel)
     return file_handler
@@ -66,6 +106,152 @@ def make_formatter(format_str="", date_format="%H:%M:%S"):
     return logging.Formatter(fmt=format_str, datefmt=date_format)
 
 
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one line of JSON, with the host, step and command it was logged for"""
+    def format(self, record):
+        entry = {"time": record.created,
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        for field in CONTEXT_FIELDS:
+            entry[field] = getattr(record, field, None)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, sort_keys=True, default=repr)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Tags every record with the host, step and command of the thread that logs it.  A field passed with
+    extra= wins, otherwise it comes from the metrics context (see Metrics.context), and it is None when
+    neither has it.  Must run in the logging thread, so it goes on the QueueHandler
+    """
+    def filter(self, record):
+        global _METRICS
+        if _METRICS is None:
+            from crucible.utils.metrics import glob_metrics
+            _METRICS = glob_metrics
+        tags = _METRICS.tags()
+        for field in CONTEXT_FIELDS:
+            if getattr(record, field, None) is None:
+                setattr(record, field, tags.get(field))
+        return True
+
+
+if QueueHandler is None:
+    class QueueHandler(logging.Handler):
+        """The logging.handlers.QueueHandler of python 3, for the interpreters that don't have it"""
+        def __init__(self, queue):
+            logging.Handler.__init__(self)
+            self.queue = queue
+
+        def prepare(self, record):
+            return record
+
+        def emit(self, record):
+            try:
+                self.queue.put_nowait(self.prepare(record))
+            except Exception:
+                self.handleError(record)
+
+    class QueueListener(object):
+        """The logging.handlers.QueueListener of python 3, for the interpreters that don't have it"""
+        _sentinel = None
+
+        def __init__(self, queue, *handlers, **kwargs):
+            self.queue = queue
+            self.handlers = handlers
+            self.respect_handler_level = kwargs.get("respect_handler_level", False)
+            self._thread = None
+
+        def start(self):
+            self._thread = threading.Thread(target=self._monitor, name="log-writer")
+            self._thread.daemon = True
+            self._thread.start()
+
+        def handle(self, record):
+            for handler in self.handlers:
+                if not self.respect_handler_level or record.levelno >= handler.level:
+                    handler.handle(record)
+
+        def _monitor(self):
+            while True:
+                record = self.queue.get()
+                if record is self._sentinel:
+                    return
+                self.handle(record)
+
+        def stop(self):
+            if self._thread is not None:
+                self.queue.put_nowait(self._sentinel)
+                self._thread.join()
+                self._thread = None
+
+
+class RecordQueueHandler(QueueHandler):
+    """
+    Puts records on the queue with their args merged into the message, and the traceback formatted into
+    exc_text instead of folded into the message.  The text handlers append it as usual, and JsonFormatter
+    puts it in its own field
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None  # a traceback holds on to every frame, don't keep them alive in the queue
+        return record
+
+
+def make_queue_logger(loggername, handlers=None, loglevel=logging.DEBUG):
+    """
+    Like make_logger, but the handlers run on a background thread.  The logger itself only gets a
+    QueueHandler, so logging from a busy thread costs a put on a queue rather than the file I/O
+    """
+    logr = logging.getLogger(loggername)
+    logr.setLevel(loglevel)
+    queue = Queue(-1)
+    queue_handler = RecordQueueHandler(queue)
+    queue_handler.addFilter(ContextFilter())
+    logr.addHandler(queue_handler)
+
+    listener = QueueListener(queue, *(handlers or []), respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # the records still in the queue are written before exiting
+    _LISTENERS[loggername] = listener
+    return logr
+
+
+def get_handlers(logr):
+    """The handlers that write the records of logr: those of its QueueListener, if it has one"""
+    listener = _LISTENERS.get(logr.name)
+    return list(listener.handlers) if listener is not None else list(logr.handlers)
+
+
+def add_handler(logr, handler):
+    """Adds a handler to logr, on the background thread if logr was made by make_queue_logger"""
+    listener = _LISTENERS.get(logr.name)
+    if listener is None:
+        logr.addHandler(handler)
+    else:
+        listener.handlers = tuple(listener.handlers) + (handler,)
+    return handler
+
+
+def add_json_log(logr, filename, loglevel=logging.DEBUG, max_bytes=MAX_BYTES, backups=BACKUPS):
+    """
+    Also logs every record of logr to filename as JSON lines, with the host, step and command fields
+
+        grep '"host": "10.8.30.141"' crucible.jsonl | grep '"level": "ERROR"'
+    """
+    return add_handler(logr, make_rotating_file_handler(JsonFormatter(), filename, loglevel=loglevel,
+                                                        max_bytes=max_bytes, backups=backups))
+
+
 def get_simple_logger(logname, filename, loglvl=logging.DEBUG):
     """
     Simple wrapper around the other functions to create a basic logger.  This is
@@ -78,10 +264,10 @@ def get_simple_logger(logname, filename, loglvl=logging.DEBUG):
     ## Make the filename, file handler and formatter
     fname = make_timestamped_filename(filename, postfix=".log")
     file_fmt = make_formatter()
-    fh = make_file_handler(file_fmt, fname)
+    fh = make_rotating_file_handler(file_fmt, fname)
 
     ## get the actual logger
-    logr =  make_logger(logname, (sh, fh))
+    logr = make_queue_logger(logname, (sh, fh))
     logr.setLevel(loglvl)
     return logr
 
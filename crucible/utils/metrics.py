@@ -0,0 +1,183 @@
+"""
+Timing and byte count instrumentation of the remote operations crucible does.
+
+Every ssh handshake, remote command, scp/sftp transfer and pipeline step is recorded as a Sample: how
+long it took (split in phases such as exec and wait), how many bytes went in and out, the exit code,
+and the host and step it belongs to.  The step and host tags live in a thread local context, which the
+scheduler sets for every step and FanOut hands over to its worker threads, so a sample recorded deep
+down in Utils.rmt_run knows which step it was run for without it being passed around.
+
+At the end of a run, summary() gives a table per (step, operation) and write() dumps every sample as
+JSON, or in the Prometheus text format if the file name ends with .prom.
+"""
+
+import time
+import json
+import threading
+from contextlib import contextmanager
+
+from crucible.utils.logger import glob_logger as LOGGER
+
+
+class Sample(object):
+    """One timed operation"""
+    def __init__(self, op, host=None, step=None, **fields):
+        self.op = op
+        self.host = host
+        self.step = step
+        self.fields = fields
+        self.start = time.time()
+        self.elapsed = None
+        self.phases = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.returncode = None
+        self.error = None
+        self.thread = threading.current_thread().name
+
+    @contextmanager
+    def phase(self, name):
+        """Times a part of the operation, eg the connect or the wait of a remote command"""
+        start = time.time()
+        try:
+            yield self
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+
+    @property
+    def failed(self):
+        return self.error is not None or self.returncode not in (None, 0)
+
+    def to_dict(self):
+        sample = {"op": self.op, "host": self.host, "step": self.step, "start": self.start,
+                  "elapsed": self.elapsed, "phases": self.phases, "bytes_in": self.bytes_in,
+                  "bytes_out": self.bytes_out, "returncode": self.returncode, "error": self.error,
+                  "thread": self.thread}
+        sample.update(self.fields)
+        return sample
+
+
+class Metrics(object):
+    def __init__(self, enabled=True, logger=LOGGER):
+        self.enabled = enabled
+        self.logger = logger
+        self.samples = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def tags(self):
+        """The step/host tags of the calling thread"""
+        return dict(getattr(self._local, "tags", {}))
+
+    @contextmanager
+    def context(self, **tags):
+        """Tags every sample started by this thread inside the with block, eg with step= or host="""
+        old = getattr(self._local, "tags", {})
+        new = dict(old)
+        new.update((k, v) for k, v in tags.items() if v is not None)
+        self._local.tags = new
+        try:
+            yield
+        finally:
+            self._local.tags = old
+
+    def start(self, op, host=None, **fields):
+        """Starts a Sample tagged with the context of the calling thread.  Hand it to finish() when done"""
+        tags = self.tags()
+        return Sample(op, host=str(host) if host is not None else tags.get("host"), step=tags.get("step"),
+                      **fields)
+
+    def finish(self, sample):
+        if sample.elapsed is None:
+            sample.elapsed = time.time() - sample.start
+        if self.enabled:
+            with self._lock:
+                self.samples.append(sample)
+        return sample
+
+    @contextmanager
+    def timer(self, op, host=None, **fields):
+        """
+        Times the with block as one Sample, which is yielded so bytes, the returncode or phases can be
+        filled in.  An exception escaping the block is recorded as the error of the sample
+        """
+        sample = self.start(op, host=host, **fields)
+        try:
+            yield sample
+        except Exception as e:
+            sample.error = repr(e)
+            raise
+        finally:
+            self.finish(sample)
+
+    def reset(self):
+        with self._lock:
+            self.samples = []
+
+    def _groups(self):
+        groups = {}
+        order = []
+        with self._lock:
+            samples = list(self.samples)
+        for sample in samples:
+            key = (sample.step or "-", sample.op)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append(sample)
+        return order, groups
+
+    def summary(self):
+        """Returns the lines of a table with the count, time, bytes and failures per (step, operation)"""
+        lines = ["{0:<24}{1:<14}{2:>7}{3:>10}{4:>10}{5:>10}{6:>12}{7:>12}{8:>6}".format(
+            "step", "op", "count", "total", "mean", "max", "bytes in", "bytes out", "fail")]
+        order, groups = self._groups()
+        for key in order:
+            samples = groups[key]
+            times = [s.elapsed for s in samples]
+            lines.append("{0:<24}{1:<14}{2:>7}{3:>9.2f}s{4:>9.3f}s{5:>9.3f}s{6:>12}{7:>12}{8:>6}".format(
+                key[0], key[1], len(samples), sum(times), sum(times) / len(times), max(times),
+                sum(s.bytes_in for s in samples), sum(s.bytes_out for s in samples),
+                len([s for s in samples if s.failed])))
+        return lines
+
+    def to_prometheus(self):
+        """Renders the samples, aggregated per (step, op, host), in the Prometheus text format"""
+        agg = {}
+        with self._lock:
+            samples = list(self.samples)
+        for sample in samples:
+            key = (sample.step or "", sample.op, sample.host or "")
+            total = agg.setdefault(key, {"count": 0, "seconds": 0.0, "in": 0, "out": 0, "failures": 0})
+            total["count"] += 1
+            total["seconds"] += sample.elapsed
+            total["in"] += sample.bytes_in
+            total["out"] += sample.bytes_out
+            total["failures"] += 1 if sample.failed else 0
+
+        lines = ["# TYPE crucible_op_seconds summary",
+                 "# TYPE crucible_op_bytes_total counter",
+                 "# TYPE crucible_op_failures_total counter"]
+        for key in sorted(agg):
+            labels = 'step="{0}",op="{1}",host="{2}"'.format(*[k.replace('"', '\\"') for k in key])
+            total = agg[key]
+            lines.append("crucible_op_seconds_sum{{{0}}} {1:.6f}".format(labels, total["seconds"]))
+            lines.append("crucible_op_seconds_count{{{0}}} {1}".format(labels, total["count"]))
+            lines.append('crucible_op_bytes_total{{{0},direction="in"}} {1}'.format(labels, total["in"]))
+            lines.append('crucible_op_bytes_total{{{0},direction="out"}} {1}'.format(labels, total["out"]))
+            lines.append("crucible_op_failures_total{{{0}}} {1}".format(labels, total["failures"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Writes every sample to path, as JSON or, if path ends with .prom, in the Prometheus text format"""
+        with open(path, "w") as metrics_f:
+            if path.endswith(".prom"):
+                metrics_f.write(self.to_prometheus())
+            else:
+                with self._lock:
+                    samples = [s.to_dict() for s in self.samples]
+                json.dump({"samples": samples}, metrics_f, indent=1, sort_keys=True)
+        self.logger.info("Wrote the metrics of this run to {0}".format(path))
+
+
+glob_metrics = Metrics()
@@ -0,0 +1,169 @@
+"""
+Pool of reusable SSH connections shared by the remote helpers
+
+Every remote helper (Utils.rmt_exec, Utils.rmt_copy, require_remote) used to build a new SSHClient,
+do a full key exchange and authenticate, and then drop the client on the floor.  The pool keeps one
+authenticated connection per (host, port, user) around for the rest of the run.
+"""
+
+import time
+import atexit
+import threading
+
+from paramiko import SSHClient
+from paramiko import AutoAddPolicy
+
+from crucible.utils.logger import glob_logger as LOGGER
+from crucible.utils.metrics import glob_metrics as METRICS
+
+
+class _PoolEntry(object):
+    """Book keeping for a single pooled connection"""
+    def __init__(self, client):
+        self.client = client
+        self.last_used = time.time()
+        self.channels = []
+
+    def touch(self):
+        self.last_used = time.time()
+
+    def is_alive(self):
+        transport = self.client.get_transport()
+        return transport is not None and transport.is_active()
+
+    def is_busy(self):
+        """True if a channel we handed out is still open (eg a long running command)"""
+        self.channels = [chan for chan in self.channels if not chan.closed]
+        return len(self.channels) > 0
+
+
+class SSHPool(object):
+    """
+    Thread safe pool of authenticated paramiko SSHClient objects keyed by (host, port, username).
+
+    - keepalive: seconds between transport keepalive packets, so idle connections survive firewalls
+    - idle_timeout: connections that have not been used for this many seconds are closed
+    - max_size: upper bound on the number of open connections.  When the pool is full, the least
+      recently used idle connection is closed to make room
+    """
+    def __init__(self, max_size=32, idle_timeout=300, keepalive=30, port=22, logger=LOGGER):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.port = port
+        self.logger = logger
+        self._entries = {}
+        self._key_locks = {}
+        self._lock = threading.RLock()
+
+    def get(self, host, username=None, password=None, port=None):
+        """
+        Returns a connected SSHClient for the given host, creating it if needed.
+
+        Only one thread performs the handshake for a given key, other threads asking for the same
+        host wait for it and then share the connection.
+
+        :param host: host name or ip address
+        :param username: user to authenticate as
+        :param password: password for username
+        :param port: ssh port, defaults to self.port
+        :return: paramiko.SSHClient
+        """
+        key = self._make_key(host, username, port)
+        with self._lock:
+            self._evict_idle()
+            entry = self._lookup(key)
+            if entry is not None:
+                return entry.client
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    return entry.client
+
+            with METRICS.timer("connect", host):
+                client = self._connect(key, password)
+            with self._lock:
+                self._make_room()
+                self._entries[key] = _PoolEntry(client)
+            return client
+
+    def exec_command(self, host, cmd, username=None, password=None, port=None):
+        """
+        Runs cmd over a pooled connection.  The channel is tracked so that the connection is not
+        evicted while the command is still running
+
+        :return: (stdin, stdout, stderr) just like SSHClient.exec_command
+        """
+        client = self.get(host, username=username, password=password, port=port)
+        ssh_stdin, ssh_stdout, ssh_stderr = client.exec_command(cmd)
+        with self._lock:
+            entry = self._entries.get(self._make_key(host, username, port))
+            if entry is not None and entry.client is client:
+                entry.channels.append(ssh_stdout.channel)
+        return ssh_stdin, ssh_stdout, ssh_stderr
+
+    def discard(self, host, username=None, port=None):
+        """Closes and forgets the connection for host, eg after a reboot"""
+        with self._lock:
+            entry = self._entries.pop(self._make_key(host, username, port), None)
+        if entry is not None:
+            entry.client.close()
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            entry.client.close()
+
+    def _make_key(self, host, username, port):
+        return str(host), self.port if port is None else int(port), username
+
+    def _lookup(self, key):
+        """Must be called with self._lock held"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if not entry.is_alive():
+            self.logger.debug("Pooled connection to {0} is dead, reconnecting".format(key[0]))
+            del self._entries[key]
+            entry.client.close()
+            return None
+        entry.touch()
+        return entry
+
+    def _connect(self, key, password):
+        host, port, username = key
+        self.logger.debug("Opening ssh connection to {0}@{1}:{2}".format(username, host, port))
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(host, port=port, username=username, password=password)
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
+        return client
+
+    def _evict_idle(self):
+        """Must be called with self._lock held"""
+        now = time.time()
+        for key, entry in list(self._entries.items()):
+            if now - entry.last_used > self.idle_timeout and not entry.is_busy():
+                self.logger.debug("Closing idle ssh connection to {0}".format(key[0]))
+                del self._entries[key]
+                entry.client.close()
+
+    def _make_room(self):
+        """Must be called with self._lock held"""
+        while len(self._entries) >= self.max_size:
+            idle = [(entry.last_used, key) for key, entry in self._entries.items() if not entry.is_busy()]
+            if not idle:
+                self.logger.debug("SSH pool is full and every connection is busy, growing past max_size")
+                return
+            _, key = min(idle)
+            self._entries.pop(key).client.close()
+
+
+glob_pool = SSHPool()
+atexit.register(glob_pool.close_all)
@@ -0,0 +1,106 @@
+"""
+Profiling support for --profile.
+
+Profiler runs cProfile in the main thread and, while it is enabled, in every thread started by the
+scheduler and by FanOut (cProfile only ever sees the thread that enabled it), then merges all of them
+into a single .pstats file.
+
+write_chrome_trace() turns the samples collected by crucible.utils.metrics into a trace event file that
+chrome://tracing and https://ui.perfetto.dev can open: one row per thread, with a span for every step,
+every per-host body of a step and every remote operation, so stragglers and serialization points show
+up on a timeline.
+"""
+
+import json
+import pstats
+import cProfile
+import threading
+from functools import wraps
+
+from crucible.utils.logger import glob_logger as LOGGER
+from crucible.utils.metrics import glob_metrics as METRICS
+
+
+class Profiler(object):
+    def __init__(self, logger=LOGGER):
+        self.enabled = False
+        self.logger = logger
+        self._main = None
+        self._profiles = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        self.enabled = True
+        self._main = cProfile.Profile()
+        self._main.enable()
+
+    def stop(self):
+        if self._main is not None:
+            self._main.disable()
+            with self._lock:
+                self._profiles.append(self._main)
+            self._main = None
+        self.enabled = False
+
+    def wrap(self, fn):
+        """Returns fn, profiled if the profiler is running.  Meant for the target of a thread"""
+        @wraps(fn)
+        def profiled(*args, **kwargs):
+            if not self.enabled:
+                return fn(*args, **kwargs)
+            prof = cProfile.Profile()
+            prof.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                prof.disable()
+                with self._lock:
+                    self._profiles.append(prof)
+        return profiled
+
+    def dump(self, path):
+        """Merges the profiles of every thread into path, which pstats.Stats (or snakeviz) can read"""
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0])
+        for prof in profiles[1:]:
+            stats.add(prof)
+        stats.dump_stats(path)
+        self.logger.info("Wrote the profile of this run to {0}".format(path))
+        return stats
+
+
+def trace_events(samples):
+    """Returns the chrome trace events ("X" complete events, in microseconds) for metrics samples"""
+    if not samples:
+        return []
+    origin = min(s.start for s in samples)
+    tids = {}
+    events = []
+    for sample in sorted(samples, key=lambda s: s.start):
+        tid = tids.setdefault(sample.thread, len(tids) + 1)
+        if sample.op == "step":
+            name = sample.step
+        elif sample.op == "host":
+            name = "{0} {1}".format(sample.fields.get("fn", sample.step), sample.host)
+        else:
+            name = "{0} {1}".format(sample.op, sample.host or "")
+        args = dict((k, v) for k, v in sample.to_dict().items()
+                    if k not in ("start", "elapsed", "thread", "op") and v not in (None, {}))
+        events.append({"name": name, "cat": sample.op, "ph": "X", "pid": 1, "tid": tid,
+                       "ts": int((sample.start - origin) * 1e6), "dur": int((sample.elapsed or 0) * 1e6),
+                       "args": args})
+    for thread, tid in tids.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread}})
+    return events
+
+
+def write_chrome_trace(path, metrics=METRICS):
+    with open(path, "w") as trace_f:
+        json.dump({"traceEvents": trace_events(list(metrics.samples)), "displayTimeUnit": "ms"}, trace_f)
+    LOGGER.info("Wrote the trace of this run to {0}, open it in chrome://tracing or ui.perfetto.dev".format(path))
+
+
+glob_profiler = Profiler()
@@ -4,7 +4,18 @@ __credits__ = ['Toure Dunnon', 'Sean Toner']
 __license__ = 'GPL'
 __version__ = '2.1.0'
 
-from crucible.task.live_migrate import Config
+import sys
+
+from crucible.task.cli import get_args
+from crucible.task.scheduler import Scheduler
+from crucible.task.plan import glob_plan as PLAN
+from crucible.task.journal import glob_journal as JOURNAL
+from crucible.task.scheduler import SchedulerException
+from crucible.utils.logger import make_timestamped_filename, add_json_log
+from crucible.utils.logger import glob_logger as LOGGER
+from crucible.utils.metrics import glob_metrics as METRICS
+from crucible.utils.trace import glob_profiler as PROFILER
+from crucible.utils.trace import write_chrome_trace
 
 # Because we have to be backwards compatible with python 2.6 (ugghhhhh), we'll import either
 # argparse or optparse.  We have to limit our usage of the parser object to optparse functionality
@@ -15,27 +26,62 @@ from crucible.task.live_migrate import Config
 # a machine other than the controller other than the controller or compute node, but the machine would
 # have to be identical
 
-config = Config()
-
-
-LIVE_Migrate = [
-    config.system_setup,
-    config.firewall_setup,
-    config.libvirtd_setup,
-    config.nova_setup,
-    config.nfs_server_setup,
-    config.nfs_client_setup,
-    config.configure_etc_hosts,
-    config.finalize_services
-]
-
-successes = []
-for fn in LIVE_Migrate:
-    print "Running {0}".format(fn.__name__)
-    ret = fn()
-    if ret:
-        successes.append(fn.__name__)
-        continue
-    else:
-        raise Exception("Time to call it quits as {} didn't"
-                        " complete its task.".format(fn.__name__))
+
+def pipeline(config):
+    """The steps of a live migration setup, in the order --serial runs them"""
+    return [config.preflight,
+            config.system_setup,
+            config.firewall_setup,
+            config.libvirtd_setup,
+            config.nova_setup,
+            config.nfs_server_setup,
+            config.nfs_client_setup,
+            config.configure_etc_hosts,
+            config.finalize_services]
+
+
+def main(argv=None):
+    # the command line is parsed before live_migrate (and with it paramiko) is even imported, so --help is
+    # instant.  Creating the Config reads the config files but doesn't contact any host
+    args = get_args(args=argv)
+    if args.log_json:
+        add_json_log(LOGGER, args.log_json)
+    from crucible.task.live_migrate import Config
+    config = Config(parsed=args)
+
+    # Each step declares what it depends on (see the @step decorator in live_migrate.py).  The scheduler runs
+    # independent steps at the same time, or all of them in the order above with --serial.  What got done is
+    # recorded in the journal, so that --resume can skip it after a failure
+    JOURNAL.start(resume=args.resume, hosts=config.nova_hosts_list)
+    if args.profile:
+        PROFILER.start()
+    try:
+        try:
+            result = Scheduler(pipeline(config), journal=JOURNAL).run(serial=args.serial)
+        except SchedulerException:
+            if JOURNAL.enabled:
+                config.logger.error("Once the problem is fixed, run again with --resume to only redo what did not "
+                                    "complete")
+            raise
+        for line in result.report():
+            print line
+        if args.plan:
+            plan_name = make_timestamped_filename("crucible-plan", postfix=".diff")
+            PLAN.save(plan_name)
+            for line in PLAN.summary():
+                print line
+            print "The diffs and commands are in {0}".format(plan_name)
+    finally:
+        PROFILER.stop()
+        for line in METRICS.summary():
+            print line
+        METRICS.write(args.metrics or make_timestamped_filename("crucible-metrics", postfix=".json"))
+        if args.profile:
+            profile_name = make_timestamped_filename("crucible-profile", postfix="")
+            PROFILER.dump(profile_name + ".pstats")
+            write_chrome_trace(profile_name + ".trace.json")
+    return result
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])